@@ -21,6 +21,7 @@ RELOADING_CHECK_INTERVAL = 1.0  # in seconds
 
 # logging options:
 LOG_TO_SQLITE = None
+SLOW_QUERY_THRESHOLD = 1.0  # in seconds
 LOGGING_LEVEL = None
 LOGGING_PONY_LEVEL = None
 
@@ -70,6 +71,27 @@ SIMPLE_ALIASES = True  # if True just use entity name like "Course-1"
 
 INNER_JOIN_SYNTAX = False # put conditions to INNER JOIN ... ON ... or to WHERE ...
 
+# maximum number of entries in per-database caches of query translators and constructed SQL,
+# least recently used entries are evicted first; None means unbounded cache
+TRANSLATOR_CACHE_SIZE = 1000
+CONSTRUCTED_SQL_CACHE_SIZE = 1000
+
+# maximum number of decompiled code objects, query strings and extractor sets kept in memory
+DECOMPILER_CACHE_SIZE = 1000
+
+# second-level cache of entities which have _cache_policy_ specified, shared by all db_sessions;
+# memcached client object specified in ALTERNATIVE_ORM_MEMCACHE is used instead of in-process storage
+ENTITY_CACHE_SIZE = 10000
+ENTITY_CACHE_TTL = 300  # in seconds, None means that cached rows do not expire
+
+# storage size and expiration of query results shared between db_sessions (see Database.query_result_cache)
+QUERY_RESULT_CACHE_SIZE = 1000
+QUERY_RESULT_CACHE_TTL = 300
+
+# number of identical single-object loads from the same line of code after which
+# db_session(detect_nplus1=True) issues NPlusOneWarning
+NPLUS1_DETECTION_THRESHOLD = 5
+
 # debugging options
 DEBUGGING_REMOVE_ADDR = True
 DEBUGGING_RESTORE_ESCAPES = True
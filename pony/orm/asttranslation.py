@@ -1,7 +1,8 @@
 from compiler import ast
 from functools import update_wrapper
 
-from pony.utils import throw
+from pony import options
+from pony.utils import throw, LRUCache
 
 class TranslationError(Exception): pass
 
@@ -249,7 +250,7 @@ class PreTranslator(ASTTranslator):
     def postConst(translator, node):
         node.external = node.constant = True
 
-extractors_cache = {}
+extractors_cache = LRUCache(options.DECOMPILER_CACHE_SIZE)
 
 def create_extractors(code_key, tree, additional_internal_names=()):
     result = extractors_cache.get(code_key)
@@ -1,28 +1,29 @@
 from __future__ import with_statement
 
-import re, sys, types, inspect, logging
+import re, os.path, sys, types, inspect, logging, logging.handlers, hashlib, warnings
 from compiler import ast, parse
 from cPickle import loads, dumps
 from operator import attrgetter, itemgetter
 from itertools import count as _count, ifilter, ifilterfalse, imap, izip, chain, starmap
 from time import time
+from math import log
 import datetime
-from random import shuffle, randint
+from random import shuffle, randint, random
 from threading import Lock, currentThread as current_thread, _MainThread
 from __builtin__ import min as _min, max as _max, sum as _sum
 from contextlib import contextmanager
 
 import pony
 from pony import options
-from pony.orm.decompiling import decompile
+from pony.orm.decompiling import decompile, get_code_key
 from pony.orm.ormtypes import AsciiStr, LongStr, LongUnicode, numeric_types, get_normalized_type_of
 from pony.orm.asttranslation import create_extractors, TranslationError
 from pony.orm.dbapiprovider import (
     DBAPIProvider, DBException, Warning, Error, InterfaceError, DatabaseError, DataError,
-    OperationalError, IntegrityError, InternalError, ProgrammingError, NotSupportedError
+    OperationalError, IntegrityError, InternalError, ProgrammingError, NotSupportedError, PoolTimeoutError
     )
 from pony.utils import (
-    localbase, decorator, cut_traceback, throw, deprecated,
+    localbase, decorator, cut_traceback, throw, deprecated, LRUCache, LocalMemcache,
     import_module, parse_expr, is_ident, count, avg as _avg, distinct as _distinct, tostring, strjoin,
     )
 
@@ -32,7 +33,7 @@ __all__ = '''
     DBException RowNotFound MultipleRowsFound TooManyRowsFound
 
     Warning Error InterfaceError DatabaseError DataError OperationalError
-    IntegrityError InternalError ProgrammingError NotSupportedError
+    IntegrityError InternalError ProgrammingError NotSupportedError PoolTimeoutError
 
     OrmError ERDiagramError DBSchemaError MappingError
     TableDoesNotExist TableIsNotEmpty ConstraintError CacheIndexError
@@ -40,6 +41,8 @@ __all__ = '''
     TransactionError TransactionIntegrityError IsolationError CommitException RollbackException
     UnrepeatableReadError UnresolvableCyclicDependency UnexpectedError
 
+    NPlusOneWarning
+
     TranslationError ExprEvalError
 
     Database sql_debug show
@@ -96,7 +99,7 @@ def args2str(args):
         return '{%s}' % ', '.join('%s:%s' % (repr(key), repr(val)) for key, val in sorted(args.iteritems()))
 
 adapted_sql_cache = {}
-string2ast_cache = {}
+string2ast_cache = LRUCache(options.DECOMPILER_CACHE_SIZE)
 
 class OrmError(Exception): pass
 
@@ -170,6 +173,8 @@ class ExprEvalError(TranslationError):
 class OptimizationFailed(Exception):
     pass  # Internal exception, cannot be encountered in user code
 
+class NPlusOneWarning(UserWarning): pass
+
 ###############################################################################
 
 def adapt_sql(sql, paramstyle):
@@ -234,6 +239,8 @@ class Local(localbase):
     def __init__(local):
         local.db2cache = {}
         local.db_context_counter = 0
+        local.db_session = None
+        local.db_session_site = None
 
 local = Local()
 
@@ -294,8 +301,10 @@ def rollback():
 select_re = re.compile(r'\s*select\b', re.IGNORECASE)
 
 class DBSessionContextManager(object):
-    __slots__ = 'retry', 'retry_exceptions', 'allowed_exceptions', 'ddl'
-    def __init__(self, retry=0, retry_exceptions=(TransactionError,), allowed_exceptions=(), ddl=False):
+    __slots__ = 'retry', 'retry_exceptions', 'allowed_exceptions', 'ddl', 'readonly', 'strict', 'max_cache_size', \
+                'detect_nplus1'
+    def __init__(self, retry=0, retry_exceptions=(TransactionError,), allowed_exceptions=(), ddl=False, readonly=False,
+                 strict=False, max_cache_size=None, detect_nplus1=False):
         if retry is not 0:
             if type(retry) is not int: throw(TypeError,
                 "'retry' parameter of db_session must be of integer type. Got: %s" % type(retry))
@@ -309,7 +318,16 @@ class DBSessionContextManager(object):
         self.retry = retry
         self.retry_exceptions = retry_exceptions
         self.allowed_exceptions = allowed_exceptions
+        if max_cache_size is not None:
+            if type(max_cache_size) is not int: throw(TypeError,
+                "'max_cache_size' parameter of db_session must be of integer type. Got: %s" % type(max_cache_size))
+            if max_cache_size < 1: throw(TypeError,
+                "'max_cache_size' parameter of db_session must be positive. Got: %d" % max_cache_size)
         self.ddl = ddl
+        self.readonly = readonly
+        self.strict = strict
+        self.max_cache_size = max_cache_size
+        self.detect_nplus1 = detect_nplus1
     def __call__(self, *args, **kwargs):
         if not args and not kwargs: return self
         if len(args) > 1: throw(TypeError,
@@ -318,12 +336,17 @@ class DBSessionContextManager(object):
         if kwargs: throw(TypeError,
             'Pass only keyword arguments to db_session or use db_session as decorator')
         func = args[0]
+        code = getattr(func, 'func_code', None)
+        site = code and (code.co_filename, code.co_firstlineno, code.co_name)
         def new_func(func, *args, **kwargs):
             if self.ddl and local.db_context_counter:
                 if isinstance(func, types.FunctionType): func = func.__name__ + '()'
                 throw(TransactionError, '%s cannot be called inside of db_session' % func)
             try:
                 for i in xrange(self.retry+1):
+                    if not local.db_context_counter:
+                        local.db_session = self
+                        local.db_session_site = site
                     local.db_context_counter += 1
                     exc_type = exc_value = exc_tb = None
                     try:
@@ -345,26 +368,35 @@ class DBSessionContextManager(object):
             "@db_session can accept 'retry' parameter only when used as decorator and not as context manager")
         if self.ddl: throw(TypeError,
             "@db_session can accept 'ddl' parameter only when used as decorator and not as context manager")
+        if not local.db_context_counter:
+            local.db_session = self
+            frame = sys._getframe(1)
+            local.db_session_site = frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name
         local.db_context_counter += 1
     def __exit__(self, exc_type=None, exc_value=None, traceback=None):
         local.db_context_counter -= 1
         if local.db_context_counter: return
-
-        if exc_type is None: can_commit = True
-        elif not callable(self.allowed_exceptions):
-            can_commit = issubclass(exc_type, tuple(self.allowed_exceptions))
-        else:
-            # exc_value can be None in Python 2.6 even if exc_type is not None
-            try: can_commit = exc_value is not None and self.allowed_exceptions(exc_value)
-            except:
-                rollback()
-                raise
-
-        if can_commit:
-            commit()
-            for cache in _get_caches(): cache.release()
-            assert not local.db2cache
-        else: rollback()
+        local.db_session = None
+        try:
+            if exc_type is None: can_commit = True
+            elif not callable(self.allowed_exceptions):
+                can_commit = issubclass(exc_type, tuple(self.allowed_exceptions))
+            else:
+                # exc_value can be None in Python 2.6 even if exc_type is not None
+                try: can_commit = exc_value is not None and self.allowed_exceptions(exc_value)
+                except:
+                    rollback()
+                    raise
+
+            caches = self.strict and _get_caches()
+            if can_commit:
+                commit()
+                for cache in _get_caches(): cache.release()
+                assert not local.db2cache
+            else: rollback()
+            if caches:
+                for cache in caches: cache.clear()
+        finally: local.db_session_site = None  # is kept until the end, so statements of commit are attributed
 
 db_session = DBSessionContextManager()
 
@@ -383,6 +415,8 @@ def db_decorator(func, *args, **kwargs):
         if web: throw(web.Http404NotFound)
         raise
 
+hook_events = 'connect', 'execute', 'translate', 'hydrate', 'save', 'commit', 'rollback'
+
 class Database(object):
     def __deepcopy__(self, memo):
         return self  # Database cannot be cloned by deepcopy()
@@ -399,29 +433,113 @@ class Database(object):
             provider_cls = provider_module.provider_cls
 
         self.provider = provider = provider_cls(*args, **kwargs)
+        self.replicas = []
+        self.replica_balancing = 'round_robin'
+        self._replica_counter = _count()
+        self._replica_usage = {}
+        self._replica_lock = Lock()
 
         self.priority = 0
         self.optimistic = False
         self._insert_cache = {}
 
         # ER-diagram related stuff:
-        self._translator_cache = {}
-        self._constructed_sql_cache = {}
+        self._translator_cache = LRUCache(options.TRANSLATOR_CACHE_SIZE)
+        self._constructed_sql_cache = LRUCache(options.CONSTRUCTED_SQL_CACHE_SIZE)
+        self.entity_cache = EntityCache()
+        self.query_result_cache = None
         self.entities = {}
         self._unmapped_attrs = {}
         self.schema = None
         self.Entity = type.__new__(EntityMeta, 'Entity', (Entity,), {})
         self.Entity._database_ = self
 
-        self.global_stats = {}
         self.global_stats_lock = Lock()
-        self._dblocal = DbLocal()
+        self._stats_shards = []  # list of (thread, shard) pairs
+        self._stats_base = {}  # stats of finished threads
+        self._dblocal = DbLocal(self)
+        self._has_cached_entities = False
+        self._hooks = {}
+        self._hooks_lock = Lock()  # serializes changes of _hooks, readers don't need it
+    @cut_traceback
+    def add_replica(database, *args, **kwargs):
+        # replica provider is created exactly the same way as the primary one inside of Database.__init__()
+        replica = database.provider.__class__(*args, **kwargs)
+        database._replica_lock.acquire()
+        try:
+            database.replicas = database.replicas + [ replica ]
+            database._replica_usage[replica] = 0
+        finally: database._replica_lock.release()
+        return replica
+    def _acquire_replica(database):
+        replicas = database.replicas
+        if not replicas: return database.provider
+        balancing = database.replica_balancing
+        database._replica_lock.acquire()
+        try:
+            usage = database._replica_usage
+            if balancing == 'round_robin':
+                replica = replicas[database._replica_counter.next() % len(replicas)]
+            elif balancing == 'least_connections':
+                replica = min(replicas, key=usage.__getitem__)
+            else: throw(ValueError, 'Unknown replica balancing strategy: %r' % balancing)
+            usage[replica] += 1
+        finally: database._replica_lock.release()
+        return replica
+    def _release_replica(database, replica):
+        if replica is database.provider: return
+        database._replica_lock.acquire()
+        try: database._replica_usage[replica] -= 1
+        finally: database._replica_lock.release()
     @property
     def last_sql(database):
         return database._dblocal.last_sql
+    @cut_traceback
+    def add_hook(database, event, func):
+        if event not in hook_events: throw(ValueError, 'Unknown hook event: %r' % event)
+        if not callable(func): throw(TypeError, 'Hook must be callable. Got: %r' % func)
+        database._hooks_lock.acquire()
+        try:
+            hooks = database._hooks.copy()  # dict is replaced as a whole, so other threads never see partial changes
+            hooks[event] = hooks.get(event, ()) + (func,)
+            database._hooks = hooks
+        finally: database._hooks_lock.release()
+        return func
+    @cut_traceback
+    def remove_hook(database, event, func):
+        if event not in hook_events: throw(ValueError, 'Unknown hook event: %r' % event)
+        database._hooks_lock.acquire()
+        try:
+            funcs = list(database._hooks.get(event, ()))
+            if func not in funcs: throw(ValueError, 'Hook %r is not registered for %r event' % (func, event))
+            funcs.remove(func)
+            hooks = database._hooks.copy()
+            if funcs: hooks[event] = tuple(funcs)
+            else: del hooks[event]
+            database._hooks = hooks
+        finally: database._hooks_lock.release()
+    def _call_hooks(database, event, data):
+        for func in database._hooks.get(event, ()): func(database, event, data)
+    def get_query_cache_stats(database):
+        return dict(translator=database._translator_cache.get_stats(),
+                    sql=database._constructed_sql_cache.get_stats(),
+                    statements=database.provider.get_statement_cache_stats())
+    def clear_query_cache(database):
+        database._translator_cache.clear()
+        database._constructed_sql_cache.clear()
+    def set_query_cache_size(database, translator_cache_size=None, sql_cache_size=None):
+        if translator_cache_size is not None: database._translator_cache.resize(translator_cache_size)
+        if sql_cache_size is not None: database._constructed_sql_cache.resize(sql_cache_size)
     @property
     def local_stats(database):
         return database._dblocal.stats
+    def _update_local_cache_stat(database, sql):
+        stats = database._dblocal.stats
+        stat = stats.get(sql)
+        if stat is not None: stat.cache_count += 1
+        else: stats[sql] = QueryStat(sql)
+        if 'execute' in database._hooks: database._call_hooks('execute', dict(
+            sql=sql, arguments=None, params_count=0, duration=0.0, rowcount=-1, cached=True, streaming=False))
     def _update_local_stat(database, sql, query_start_time):
         dblocal = database._dblocal
         dblocal.last_sql = sql
@@ -429,15 +547,80 @@ class Database(object):
         stat = stats.get(sql)
         if stat is not None: stat.query_executed(query_start_time)
         else: stats[sql] = QueryStat(sql, query_start_time)
+    def _update_local_fetch_stat(database, sql, rows_count, hydration_time):
+        stat = database._dblocal.stats.get(sql)
+        if stat is not None: stat.rows_fetched(rows_count, hydration_time)
+    def _add_stats_shard(database, shard):
+        database.global_stats_lock.acquire()
+        try:
+            database._fold_stats_shards()
+            database._stats_shards.append((current_thread(), shard))
+        finally: database.global_stats_lock.release()
+    def _fold_stats_shards(database):  # must be called with global_stats_lock acquired
+        # shards of finished threads are not modified anymore, so they can be merged into the base dict
+        base = database._stats_base
+        alive_shards = []
+        for thread, shard in database._stats_shards:
+            if thread.isAlive():
+                alive_shards.append((thread, shard))
+                continue
+            for sql, stat in shard.iteritems():
+                base_stat = base.get(sql)
+                if base_stat is None: base[sql] = stat
+                else: base_stat.merge(stat)
+        database._stats_shards = alive_shards
     def merge_local_stats(database):
-        setdefault = database.global_stats.setdefault
+        # local stats are moved to the shard of current thread, so threads do not contend for a lock;
+        # shards of all threads are combined when global_stats is requested
+        dblocal = database._dblocal
+        shard = dblocal.merged_stats
+        for sql, stat in dblocal.stats.iteritems():
+            merged_stat = shard.get(sql)
+            if merged_stat is None: shard[sql] = stat
+            else: merged_stat.merge(stat)
+        dblocal.stats.clear()
+    def _get_global_stats(database):
         database.global_stats_lock.acquire()
         try:
-            for sql, stat in database._dblocal.stats.iteritems():
-                global_stat = setdefault(sql, stat)
-                if global_stat is not stat: global_stat.merge(stat)
+            database._fold_stats_shards()
+            result = dict((sql, stat.copy()) for sql, stat in database._stats_base.iteritems())
+            for thread, shard in database._stats_shards:
+                for sql, stat in shard.items():
+                    global_stat = result.get(sql)
+                    if global_stat is None: result[sql] = stat.copy()
+                    else: global_stat.merge(stat)
         finally: database.global_stats_lock.release()
+        return result
+    def _set_global_stats(database, stats):
+        database.global_stats_lock.acquire()
+        try:
+            database._fold_stats_shards()
+            for thread, shard in database._stats_shards: shard.clear()
+            database._stats_base = dict(stats)
+        finally: database.global_stats_lock.release()
+    global_stats = property(_get_global_stats, _set_global_stats)
+    @cut_traceback
+    def reset_stats(database):
+        database._set_global_stats({})
         database._dblocal.stats.clear()
+    def get_top_stats(database, limit=10, sort_by='sum_time'):
+        if sort_by not in stat_sort_keys: throw(ValueError, 'Unknown sort key: %r' % sort_by)
+        stats = [ stat for stat in database.global_stats.itervalues() if stat.db_count ]
+        if sort_by in ('p95', 'p99'):
+            percent = int(sort_by[1:])
+            key = lambda stat: stat.percentile(percent)
+        else: key = attrgetter(sort_by)
+        stats.sort(key=key, reverse=True)
+        return stats[:limit]
+    def stats_report(database, limit=10, sort_by='sum_time'):
+        lines = [ '%8s %10s %10s %10s %10s %10s %10s %10s  %s' % (
+            'count', 'total ms', 'avg ms', 'p95 ms', 'p99 ms', 'max ms', 'rows', 'hydr ms', 'sql') ]
+        for stat in database.get_top_stats(limit, sort_by):
+            lines.append('%8d %10.3f %10.3f %10.3f %10.3f %10.3f %10d %10.3f  %s' % (
+                stat.db_count, stat.sum_time * 1000, stat.avg_time * 1000, stat.percentile(95) * 1000,
+                stat.percentile(99) * 1000, stat.max_time * 1000, stat.rows_count, stat.hydration_time * 1000,
+                ' '.join(stat.sql.split())))
+        return '\n'.join(lines)
     @cut_traceback
     def get_connection(database):
         cache = database._get_cache()
@@ -452,6 +635,7 @@ class Database(object):
         if cache is not None: cache.rollback()
         if debug: log_orm('DISCONNECT')
         database.provider.disconnect()
+        for replica in database.replicas: replica.disconnect()
     def _get_cache(database):
         cache = local.db2cache.get(database)
         if cache is not None: return cache
@@ -472,8 +656,18 @@ class Database(object):
         cache = local.db2cache.get(database)
         if cache is not None: cache.rollback()
     @cut_traceback
+    def evict(database, objects):
+        return database._get_cache().evict(objects)
+    @cut_traceback
     def execute(database, sql, globals=None, locals=None):
-        database._get_cache().flush()
+        cache = database._get_cache()
+        cache.flush()
+        cache.modified_tables.add(ANY_TABLE)  # tables changed by raw SQL are unknown
+        if database._has_cached_entities:
+            for entity in database.entities.itervalues():
+                if entity._root_ is not entity or entity._cache_policy_ is None: continue
+                cache.entity_cache_dirty.add(entity)
+                cache.entity_cache_pkvals[entity] = None  # all cached rows of the entity become invalid
         return database._exec_raw_sql(sql, globals, locals, frame_depth=3)
     def _exec_raw_sql(database, sql, globals, locals, frame_depth):
         sql = sql[:]  # sql = templating.plainstr(sql)
@@ -530,7 +724,9 @@ class Database(object):
         else: sql, adapter = cached_sql
         arguments = adapter(kwargs.values())  # order of values same as order of keys
         cache = database._get_cache()
+        if cache.readonly: throw(TransactionError, 'Cannot insert rows inside of read-only db_session')
         if cache.optimistic: cache.flush()
+        cache.modified_tables.add(table_name)
         if returning is not None:
             return database._exec_sql(sql, arguments, returning_id=True)
         cursor = database._exec_sql(sql, arguments)
@@ -538,13 +734,42 @@ class Database(object):
     def _ast2sql(database, sql_ast):
         sql, adapter = database.provider.ast2sql(sql_ast)
         return sql, adapter
-    def _exec_sql(database, sql, arguments=None, returning_id=False):
+    def _explain(database, sql, arguments=None, analyze=False):
+        cache = database._get_cache()
+        if not cache.noflush_counter and not cache.optimistic and cache.modified: cache.flush()
+        connection = cache.connection or cache.establish_connection()
+        if debug: log_sql('EXPLAIN ' + sql, arguments)
+        return cache.provider.explain(connection, sql, arguments, analyze)
+    @cut_traceback
+    def capture_slow_plans(database, threshold, analyze=False):
+        # plans are captured by EXPLAIN of the same connection once per statement of a thread;
+        # a failed EXPLAIN is stored in stat.plan_error and must not break the query itself
+        def hook(database, event, data):
+            if data['cached'] or data['streaming'] or data['duration'] < threshold: return
+            sql = data['sql']
+            if not select_re.match(sql): return
+            stat = database._dblocal.stats.get(sql)
+            if stat is None or stat.plan is not None or stat.plan_error is not None: return
+            cache = database._get_cache()
+            try: stat.plan = cache.provider.explain(cache.connection, sql, data['arguments'], analyze)
+            except (NotImplementedError, DatabaseError), e: stat.plan_error = e
+        return database.add_hook('execute', hook)
+    @cut_traceback
+    def log_slow_queries(database, threshold=None, filename=None, sqlite_filename=None, **kwargs):
+        log = SlowQueryLog(threshold, filename, sqlite_filename, **kwargs)
+        log.database = database
+        database.add_hook('execute', log)
+        return log
+    def _exec_sql(database, sql, arguments=None, returning_id=False, chunk_size=None):
         cache = database._get_cache()
         if not cache.noflush_counter and not cache.optimistic and cache.modified: cache.flush()
         connection = cache.connection or cache.establish_connection()
-        cursor = connection.cursor()
+        provider = cache.provider
+        if chunk_size is None: cursor = provider.statement_cursor(connection, sql)
+        else: cursor = provider.stream_cursor(connection, chunk_size)
+        if cache.entity_cache_generation is None and database._has_cached_entities:
+            cache.entity_cache_generation = database.entity_cache.get_generation()
         if debug: log_sql(sql, arguments)
-        provider = database.provider
         t = time()
         try: new_id = provider.execute(cursor, sql, arguments, returning_id)
         except Exception, e:
@@ -553,10 +778,14 @@ class Database(object):
             cache.connection = None
             provider.drop(connection)
             connection = cache.establish_connection()
-            cursor = connection.cursor()
+            if chunk_size is None: cursor = provider.statement_cursor(connection, sql)
+            else: cursor = provider.stream_cursor(connection, chunk_size)
             t = time()
             new_id = provider.execute(cursor, sql, arguments, returning_id)
         database._update_local_stat(sql, t)
+        if 'execute' in database._hooks: database._call_hooks('execute', dict(
+            sql=sql, arguments=arguments, params_count=arguments and len(arguments) or 0, duration=time() - t,
+            rowcount=getattr(cursor, 'rowcount', -1), cached=False, streaming=chunk_size is not None))
         if not returning_id: return cursor
         if type(new_id) is long: new_id = int(new_id)
         return new_id
@@ -785,23 +1014,46 @@ class Database(object):
         database.schema.create_tables(database.provider, connection)
 
 class DbLocal(localbase):
-    def __init__(dblocal):
+    def __init__(dblocal, database):
         dblocal.stats = {}
+        dblocal.merged_stats = {}
         dblocal.last_sql = None
+        database._add_stats_shard(dblocal.merged_stats)
+
+histogram_buckets_per_octave = 4  # upper bounds of adjacent buckets differ by ~19%
+stat_sort_keys = 'sum_time', 'avg_time', 'max_time', 'p95', 'p99', 'db_count', 'rows_count', 'hydration_time'
+
+def get_histogram_bucket(duration):
+    # bucket 0 holds durations up to 1 microsecond, bucket i holds durations up to 2**(i/4) microseconds
+    if duration <= 0.000001: return 0
+    return int(log(duration * 1000000, 2) * histogram_buckets_per_octave) + 1
+
+def get_histogram_bucket_bound(bucket):
+    return 2 ** (float(bucket) / histogram_buckets_per_octave) / 1000000
 
 class QueryStat(object):
     def __init__(stat, sql, query_start_time=None):
+        stat.histogram = {}
         if query_start_time is not None:
             query_end_time = time()
             duration = query_end_time - query_start_time
             stat.min_time = stat.max_time = stat.sum_time = duration
             stat.db_count = 1
             stat.cache_count = 0
+            stat.histogram[get_histogram_bucket(duration)] = 1
         else:
             stat.min_time = stat.max_time = stat.sum_time = None
             stat.db_count = 0
             stat.cache_count = 1
+        stat.rows_count = 0
+        stat.hydration_time = 0.0
+        stat.plan = stat.plan_error = None
         stat.sql = sql
+    def copy(stat):
+        stat2 = object.__new__(QueryStat)
+        stat2.__dict__.update(stat.__dict__)
+        stat2.histogram = stat.histogram.copy()
+        return stat2
     def query_executed(stat, query_start_time):
         query_end_time = time()
         duration = query_end_time - query_start_time
@@ -811,6 +1063,12 @@ class QueryStat(object):
             stat.sum_time += duration
         else: stat.min_time = stat.max_time = stat.sum_time = duration
         stat.db_count += 1
+        bucket = get_histogram_bucket(duration)
+        histogram = stat.histogram
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    def rows_fetched(stat, rows_count, hydration_time):
+        stat.rows_count += rows_count
+        stat.hydration_time += hydration_time
     def merge(stat, stat2):
         assert stat.sql == stat2.sql
         if not stat2.db_count: pass
@@ -824,10 +1082,26 @@ class QueryStat(object):
             stat.sum_time = stat2.sum_time
         stat.db_count += stat2.db_count
         stat.cache_count += stat2.cache_count
+        stat.rows_count += stat2.rows_count
+        stat.hydration_time += stat2.hydration_time
+        if stat.plan is None and stat.plan_error is None: stat.plan, stat.plan_error = stat2.plan, stat2.plan_error
+        histogram = stat.histogram
+        for bucket, count in stat2.histogram.items():
+            histogram[bucket] = histogram.get(bucket, 0) + count
     @property
     def avg_time(stat):
         if not stat.db_count: return None
         return stat.sum_time / stat.db_count
+    def percentile(stat, percent):
+        # result is the upper bound of histogram bucket, so its relative error does not exceed ~19%
+        if not stat.db_count: return None
+        threshold = stat.db_count * percent / 100.0
+        histogram = stat.histogram
+        total = 0
+        for bucket in sorted(histogram):
+            total += histogram[bucket]
+            if total >= threshold: break
+        return _max(_min(get_histogram_bucket_bound(bucket), stat.max_time), stat.min_time)
 
 ###############################################################################
 
@@ -1049,11 +1323,35 @@ class Attribute(object):
                 val = None
             else: val = attr.py_type._get_by_raw_pkval_(vals)
         return val
+    def batch_load(attr, objects):
+        reverse = attr.reverse
+        assert reverse is not None and not attr.is_collection
+        entity = attr.entity
+        rentity = reverse.entity
+        database = entity._database_
+        objects = [ obj for obj in objects if obj._status_ not in del_statuses ]
+        if attr.columns: entity._load_many_(objects)  # value of attribute is loaded together with object
+        else:
+            objects_to_load = [ obj for obj in objects if attr.name not in obj._vals_ ]
+            max_batch_size = database.provider.max_params_count // len(entity._pk_columns_)
+            for start in xrange(0, len(objects_to_load), max_batch_size):
+                batch = objects_to_load[start:start+max_batch_size]
+                sql, adapter, attr_offsets = rentity._construct_batchload_sql_(len(batch), reverse)
+                cursor = database._exec_sql(sql, adapter(batch))
+                rentity._fetch_objects(cursor, attr_offsets)
+                for obj in batch: obj._vals_.setdefault(attr.name, None)
+        result = set()
+        for obj in objects:
+            val = obj._vals_.get(attr.name)
+            if val is not None and val is not NOT_LOADED: result.add(val)
+        return result
     def load(attr, obj):
         if not attr.columns:
             reverse = attr.reverse
             assert reverse is not None and reverse.columns
             objects = reverse.entity._find_in_db_({reverse : obj}, 1)
+            detector = obj._cache_.nplus1_detector
+            if detector is not None: detector.register('attribute', attr, obj._database_.last_sql)
             if not objects:
                 obj._vals_[attr.name] = None
                 return None
@@ -1082,6 +1380,8 @@ class Attribute(object):
             row = cursor.fetchone()
             dbval = attr.parse_value(row, offsets)
             attr.db_set(obj, dbval)
+            detector = obj._cache_.nplus1_detector
+            if detector is not None: detector.register('attribute', attr, sql)
         else: obj._load_()
         return obj._vals_[attr.name]
     @cut_traceback
@@ -1515,6 +1815,13 @@ def construct_criteria_list(alias, columns, converters, row_value_syntax, count=
                        for i in xrange(count) ]
         return [ [ 'OR' ] + conditions ]
 
+def get_table_names(sql_ast, result=None):
+    if result is None: result = set()
+    if len(sql_ast) >= 3 and sql_ast[1] == 'TABLE': result.add(sql_ast[2])  # [ alias, 'TABLE', table_name, ... ]
+    for item in sql_ast:
+        if type(item) is list: get_table_names(item, result)
+    return result
+
 class Set(Collection):
     __slots__ = []
     def check(attr, val, obj=None, entity=None, from_db=False):
@@ -1589,7 +1896,6 @@ class Set(Collection):
             return setdata
 
         objects = [ obj ]
-        setdata_list = [ setdata ]
         if prefetching:
             pk_index = cache.indexes.get(entity.__dict__['_pk_'])
             max_batch_size = database.provider.max_params_count // len(entity._pk_columns_)
@@ -1597,50 +1903,70 @@ class Set(Collection):
                 if obj2 is obj: continue
                 if obj2._status_ in created_or_deleted_statuses: continue
                 setdata2 = obj2._vals_.get(attr.name)
-                if setdata2 is None: setdata2 = obj2._vals_[attr.name] = SetData()
-                elif setdata2.is_fully_loaded: continue
+                if setdata2 is not None and setdata2.is_fully_loaded: continue
                 objects.append(obj2)
-                setdata_list.append(setdata2)
                 if len(objects) >= max_batch_size: break
-
-        if not reverse.is_collection:
-            sql, adapter, attr_offsets = rentity._construct_batchload_sql_(len(objects), reverse)
-            arguments = adapter(objects)
-            cursor = database._exec_sql(sql, arguments)
-            items = rentity._fetch_objects(cursor, attr_offsets)
-        else:
-            sql, adapter = attr.construct_sql_m2m(len(objects))
-            arguments = adapter(objects)
-            cursor = database._exec_sql(sql, arguments)
-            pk_len = len(entity._pk_columns_)
-            d = {}
-            if len(objects) > 1:
-                for row in cursor.fetchall():
-                    obj2 = entity._get_by_raw_pkval_(row[:pk_len])
-                    item = rentity._get_by_raw_pkval_(row[pk_len:])
-                    items = d.get(obj2)
-                    if items is None: items = d[obj2] = set()
-                    items.add(item)
-            else: d[obj] = set(imap(rentity._get_by_raw_pkval_, cursor.fetchall()))
-            for obj2, items in d.iteritems():
-                setdata2 = obj2._vals_.get(attr.name)
-                if setdata2 is None: setdata2 = obj._vals_[attr.name] = SetData()
-                else:
-                    phantoms = setdata2 - items
-                    if setdata2.added: phantoms -= setdata2.added
-                    if phantoms: throw(UnrepeatableReadError,
-                        'Phantom object %s disappeared from collection %s.%s'
-                        % (safe_repr(phantoms.pop()), safe_repr(obj), attr.name))
-                items -= setdata2
-                if setdata2.removed: items -= setdata2.removed
-                setdata2 |= items
-                reverse.db_reverse_add(items, obj2)
-
-        for setdata2 in setdata_list:
-            setdata2.is_fully_loaded = True
-            setdata2.count = len(setdata2)
+        attr.batch_load(objects)
+        if cache.nplus1_detector is not None and len(objects) == 1:
+            cache.nplus1_detector.register('collection', attr, database.last_sql)
         cache.collection_statistics[attr] = counter + 1
         return setdata
+    def batch_load(attr, objects):
+        entity = attr.entity
+        reverse = attr.reverse
+        rentity = reverse.entity
+        database = entity._database_
+        objects_to_load = []
+        for obj in objects:
+            if obj._status_ in created_or_deleted_statuses: continue
+            setdata = obj._vals_.get(attr.name)
+            if setdata is None: setdata = obj._vals_[attr.name] = SetData()
+            elif setdata.is_fully_loaded: continue
+            objects_to_load.append(obj)
+        max_batch_size = database.provider.max_params_count // len(entity._pk_columns_)
+        for start in xrange(0, len(objects_to_load), max_batch_size):
+            batch = objects_to_load[start:start+max_batch_size]
+            if not reverse.is_collection:
+                sql, adapter, attr_offsets = rentity._construct_batchload_sql_(len(batch), reverse)
+                arguments = adapter(batch)
+                cursor = database._exec_sql(sql, arguments)
+                rentity._fetch_objects(cursor, attr_offsets)
+            else:
+                sql, adapter = attr.construct_sql_m2m(len(batch))
+                arguments = adapter(batch)
+                cursor = database._exec_sql(sql, arguments)
+                pk_len = len(entity._pk_columns_)
+                d = {}
+                if len(batch) > 1:
+                    for row in cursor.fetchall():
+                        obj2 = entity._get_by_raw_pkval_(row[:pk_len])
+                        item = rentity._get_by_raw_pkval_(row[pk_len:])
+                        items = d.get(obj2)
+                        if items is None: items = d[obj2] = set()
+                        items.add(item)
+                else: d[batch[0]] = set(imap(rentity._get_by_raw_pkval_, cursor.fetchall()))
+                for obj2, items in d.iteritems():
+                    setdata2 = obj2._vals_.get(attr.name)
+                    if setdata2 is None: setdata2 = obj2._vals_[attr.name] = SetData()
+                    else:
+                        phantoms = setdata2 - items
+                        if setdata2.added: phantoms -= setdata2.added
+                        if phantoms: throw(UnrepeatableReadError,
+                            'Phantom object %s disappeared from collection %s.%s'
+                            % (safe_repr(phantoms.pop()), safe_repr(obj2), attr.name))
+                    items -= setdata2
+                    if setdata2.removed: items -= setdata2.removed
+                    setdata2 |= items
+                    reverse.db_reverse_add(items, obj2)
+            for obj in batch:
+                setdata = obj._vals_[attr.name]
+                setdata.is_fully_loaded = True
+                setdata.count = len(setdata)
+        result = set()
+        for obj in objects:
+            setdata = obj._vals_.get(attr.name)
+            if setdata is not None: result.update(setdata)
+        return result
     def construct_sql_m2m(attr, batch_size=1, items_count=0):
         if items_count:
             assert batch_size == 1
@@ -2409,16 +2735,34 @@ class EntityMeta(type):
                         'Each part of table name must be a string. Got: %r' % name_part)
                 entity._table_ = table_name = tuple(table_name)
 
+        if '_cache_policy_' in entity.__dict__:
+            cache_policy = entity._cache_policy_
+            if entity._root_ is not entity: throw(TypeError,
+                '_cache_policy_ can be specified for root entity only, not for %s' % entity.__name__)
+            if cache_policy not in (None, 'readonly', 'readwrite'): throw(TypeError,
+                "%s._cache_policy_ must be 'readonly' or 'readwrite'. Got: %r" % (entity.__name__, cache_policy))
+            if cache_policy is not None:
+                for attr in entity._pk_attrs_:
+                    if isinstance(attr.py_type, (basestring, EntityMeta)): throw(TypeError,
+                        'Entity %s cannot be cached because its primary key contains reference attribute %s'
+                        % (entity.__name__, attr.name))
+                database._has_cached_entities = True
+        elif entity._root_ is entity: entity._cache_policy_ = None
+        entity._entity_cache_layout_ = None
+
         database.entities[entity.__name__] = entity
         setattr(database, entity.__name__, entity)
         entity._link_reverse_attrs_()
 
         entity._cached_create_sql_ = None
         entity._cached_create_sql_auto_pk_ = None
+        entity._create_many_sql_cache_ = {}
         entity._cached_max_id_sql_ = None
         entity._find_sql_cache_ = {}
         entity._batchload_sql_cache_ = {}
+        entity._hydrator_cache_ = {}
         entity._update_sql_cache_ = {}
+        entity._update_many_sql_cache_ = {}
         entity._delete_sql_cache_ = {}
         entity._to_be_checked_sql_cache_ = {}
 
@@ -2583,6 +2927,11 @@ class EntityMeta(type):
         locals = sys._getframe(3).f_locals
         return entity._query_from_lambda_(func, globals, locals)
     @cut_traceback
+    def prepare(entity, func):
+        if not isinstance(func, types.FunctionType):
+            throw(TypeError, 'Lambda function or function with single return statement expected. Got: %r' % func)
+        return PreparedQuery(entity, func)
+    @cut_traceback
     def select_by_sql(entity, sql, globals=None, locals=None):
         return entity._find_by_sql_(None, sql, globals, locals, frame_depth=3)
     @cut_traceback
@@ -2666,9 +3015,15 @@ class EntityMeta(type):
             objects = entity._find_in_cache_(pkval, avdict)
         except KeyError:  # not found in cache, can exist in db
             objects = entity._find_in_db_(avdict, max_fetch_count)
+            if max_fetch_count == 1:
+                database = entity._database_
+                detector = database._get_cache().nplus1_detector
+                if detector is not None: detector.register(
+                    'find', (entity, tuple(sorted(attr.name for attr in avdict))), database.last_sql)
         if rbits:
             for obj in objects:
                 if obj._rbits_ is not None: obj._rbits_ |= rbits
+        if objects and objects[0]._cache_.lru is not None: objects[0]._cache_._touch(objects)
         return objects
     def _find_in_cache_(entity, pkval, avdict):
         cache = entity._database_._get_cache()
@@ -2715,6 +3070,8 @@ class EntityMeta(type):
                         filtered_objects.sort(key=entity._get_raw_pkval_)
                         return filtered_objects
                     else: throw(NotImplementedError)
+        if obj is None and entity._cache_policy_ is not None:
+            obj = entity._root_._find_in_entity_cache_(pkval, avdict)
         if obj is not None:
             if obj._discriminator_ is not None:
                 if obj._subclasses_:
@@ -2787,6 +3144,116 @@ class EntityMeta(type):
         discr_values = [ [ 'VALUE', cls._discriminator_ ] for cls in entity._subclasses_ ]
         discr_values.append([ 'VALUE', entity._discriminator_])
         return [ 'IN', [ 'COLUMN', alias, discr_attr.column ], discr_values ]
+    def _construct_create_many_sql_(entity, batch_size):
+        cached_sql = entity._create_many_sql_cache_.get(batch_size)
+        if cached_sql is not None: return cached_sql
+        rows = [ [ [ 'PARAM', (i, j), converter ] for j, converter in enumerate(entity._converters_) ]
+                 for i in xrange(batch_size) ]
+        sql_ast = [ 'INSERT_MANY', entity._table_, entity._columns_, rows ]
+        cached_sql = entity._database_._ast2sql(sql_ast)
+        entity._create_many_sql_cache_[batch_size] = cached_sql
+        return cached_sql
+    def _save_created_many_(entity, objects):
+        for obj in objects:
+            if obj._status_ == 'created': obj._save_principal_objects_(None)
+        objects = [ obj for obj in objects if obj._status_ == 'created' ]
+        pk_objects = [ obj for obj in objects if obj._pkval_ is not None ]
+        if pk_objects: entity._insert_many_(pk_objects)
+        auto_pk_objects = [ obj for obj in objects if obj._pkval_ is None ]
+        if len(auto_pk_objects) > 1 and entity._reserve_ids_(auto_pk_objects):
+            entity._insert_many_(auto_pk_objects)
+        else:  # multi-row INSERT does not say which generated id belongs to which row
+            for obj in auto_pk_objects: obj._save_created_()
+    def _reserve_ids_(entity, objects):
+        database = entity._database_
+        reserved = database.provider.reserve_ids_sql(entity._table_, entity._pk_columns_[0], len(objects))
+        if reserved is None: return False
+        sql, arguments = reserved
+        new_ids = [ row[0] for row in database._exec_sql(sql, arguments).fetchall() ]
+        if len(new_ids) != len(objects) or None in new_ids: return False  # column has no sequence
+        for obj, new_id in izip(objects, new_ids):
+            if type(new_id) is long: new_id = int(new_id)
+            obj._set_new_id_(new_id)
+        return True
+    def _insert_many_(entity, objects):
+        if len(objects) == 1: return objects[0]._save_created_()
+        database = entity._database_
+        provider = database.provider
+        rows = [ tuple(obj._get_insert_values_(False)) for obj in objects ]
+        try:
+            if not provider.multi_row_insert_syntax:
+                sql, adapter = entity._construct_create_many_sql_(1)
+                database._exec_sql(sql, [ adapter((row,)) for row in rows ])
+            else:
+                batch_size = max(1, provider.max_params_count // len(rows[0]))
+                for start in xrange(0, len(rows), batch_size):
+                    batch = rows[start:start+batch_size]
+                    sql, adapter = entity._construct_create_many_sql_(len(batch))
+                    database._exec_sql(sql, adapter(batch))
+        except DatabaseError, e:
+            msg = " ".join(tostring(arg) for arg in e.args)
+            objects_repr = ', '.join(safe_repr(obj) for obj in objects[:3]) + (len(objects) > 3 and ', ...' or '')
+            if isinstance(e, IntegrityError): throw(TransactionIntegrityError,
+                'Objects %s cannot be stored in the database (probably one of them already exists). %s: %s'
+                % (objects_repr, e.__class__.__name__, msg), e)
+            throw(UnexpectedError, 'Objects %s cannot be stored in the database. %s: %s'
+                                   % (objects_repr, e.__class__.__name__, msg), e)
+        for obj in objects: obj._update_after_insert_()
+    def _construct_update_many_sql_(entity, query_key, batch_size):
+        cached_sql = entity._update_many_sql_cache_.get((query_key, batch_size))
+        if cached_sql is not None: return cached_sql
+        update_columns, optimistic_columns, optimistic_flags = query_key
+        converters, column_types = {}, {}
+        for attr in entity._attrs_:
+            if attr.is_collection or not attr.columns: continue
+            for column, converter in izip(attr.columns, attr.converters):
+                converters[column] = converter
+                column_types[column] = len(attr.columns) == 1 and attr.sql_type or converter.sql_type()
+        # layout of values is the same as in UPDATE of single object: updated columns, pk, optimistic checks
+        offsets = range(len(update_columns) + len(entity._pk_columns_))
+        key_columns = list(entity._pk_columns_)
+        null_columns = []
+        for column, flag in izip(optimistic_columns, optimistic_flags):
+            if not flag: null_columns.append(column); continue
+            offsets.append(len(offsets) + len(null_columns))
+            key_columns.append(column)
+        value_columns = list(update_columns) + key_columns
+        rows = [ [ [ 'PARAM', (i, j), converters[column] ] for j, column in izip(offsets, value_columns) ]
+                 for i in xrange(batch_size) ]
+        sql_types = [ column_types[column] for column in value_columns ]
+        sql_ast = [ 'UPDATE_MANY', entity._table_, update_columns, key_columns, null_columns, rows, sql_types ]
+        cached_sql = entity._database_._ast2sql(sql_ast)
+        entity._update_many_sql_cache_[query_key, batch_size] = cached_sql
+        return cached_sql
+    def _is_self_referenced_(entity):
+        for attr in entity._attrs_:
+            if attr.reverse and attr.columns and not attr.is_collection \
+               and attr.py_type._root_ is entity._root_: return True
+        return False
+    def _delete_many_(entity, objects, optimistic_columns, optimistic_converters, optimistic_values):
+        if len(objects) == 1: return objects[0]._save_deleted_()
+        database = entity._database_
+        provider = database.provider
+        max_batch_size = (provider.max_params_count - len(optimistic_columns)) // len(entity._pk_columns_)
+        for start in xrange(0, len(objects), max_batch_size):
+            batch = objects[start:start+max_batch_size]
+            query_key = (len(batch), optimistic_columns,
+                         tuple(converter is not None for converter in optimistic_converters))
+            cached_sql = entity._delete_sql_cache_.get(query_key)
+            if cached_sql is None:
+                row_value_syntax = provider.translator_cls.row_value_syntax
+                where_list = [ 'WHERE' ] + construct_criteria_list(None, entity._pk_columns_, entity._pk_converters_,
+                                                                   row_value_syntax, len(batch))
+                populate_criteria_list(where_list, optimistic_columns, optimistic_converters, len(batch))
+                sql_ast = [ 'DELETE', entity._table_, where_list ]
+                cached_sql = entity._delete_sql_cache_[query_key] = database._ast2sql(sql_ast)
+            sql, adapter = cached_sql
+            cursor = database._exec_sql(sql, adapter(batch + list(optimistic_values)))
+            if cursor.rowcount != len(batch):
+                objects_repr = ', '.join(safe_repr(obj) for obj in batch[:3]) + (len(batch) > 3 and ', ...' or '')
+                throw(UnrepeatableReadError, 'Some of objects %s were deleted outside of current transaction'
+                                             % objects_repr)
+            for obj in batch: obj._update_after_delete_()
     def _construct_batchload_sql_(entity, batch_size, attr=None):
         query_key = batch_size, attr
         cached_sql = entity._batchload_sql_cache_.get(query_key)
@@ -2847,6 +3314,13 @@ class EntityMeta(type):
         entity._find_sql_cache_[query_key] = cached_sql
         return cached_sql
     def _fetch_objects(entity, cursor, attr_offsets, max_fetch_count=None, rbits=None, for_update=False):
+        rows = entity._fetch_rows_(cursor, max_fetch_count)
+        t = time()
+        objects = entity._objects_from_fetched_rows_(rows, attr_offsets, rbits, for_update)
+        database = entity._database_
+        database._update_local_fetch_stat(database._dblocal.last_sql, len(rows), time() - t)
+        return objects
+    def _fetch_rows_(entity, cursor, max_fetch_count=None):
         if max_fetch_count is None: max_fetch_count = options.MAX_FETCH_COUNT
         if max_fetch_count is not None:
             rows = cursor.fetchmany(max_fetch_count + 1)
@@ -2856,20 +3330,191 @@ class EntityMeta(type):
                 throw(TooManyObjectsFoundError,
                     'Found more then pony.options.MAX_FETCH_COUNT=%d objects' % options.MAX_FETCH_COUNT)
         else: rows = cursor.fetchall()
+        return rows
+    def _objects_from_fetched_rows_(entity, rows, attr_offsets, rbits=None, for_update=False):
+        if entity._cache_policy_ is not None and attr_offsets is not None and not for_update:
+            entity._root_._put_to_entity_cache_(rows, attr_offsets)
+        return entity._objects_from_rows_(rows, attr_offsets, rbits, for_update)
+    def _get_entity_cache_layout_(entity):
+        layout = entity._entity_cache_layout_
+        if layout is None:
+            select_list, attr_offsets = entity._construct_select_clause_()
+            attrs = sorted(attr_offsets, key=lambda attr: attr_offsets[attr][0])
+            pk_attrs = [ (attr, attr_offsets[attr][0]) for attr in entity._pk_attrs_ ]
+            keys = [ key_attrs for key_attrs in chain(((attr,) for attr in entity._simple_keys_),
+                                                      entity._composite_keys_)
+                     if not [ attr for attr in key_attrs if attr.reverse or attr not in attr_offsets ] ]
+            layout = entity._entity_cache_layout_ = attrs, attr_offsets, pk_attrs, keys
+        return layout
+    def _put_to_entity_cache_(entity, rows, attr_offsets):
+        database = entity._database_
+        cache = database._get_cache()
+        if entity in cache.entity_cache_dirty: return  # rows can contain uncommitted changes
+        if cache.provider is not database.provider: return  # replica can lag behind the primary database
+        entity_cache = database.entity_cache
+        generation = cache.entity_cache_generation
+        if generation is None or generation != entity_cache.get_generation():
+            return  # rows were selected before concurrent commit invalidated some of them
+        attrs, layout_offsets, pk_attrs, keys = entity._get_entity_cache_layout_()
+        try: offsets = [ offset for attr in attrs for offset in attr_offsets[attr] ]
+        except KeyError: return  # rows do not contain all columns
+        items = []
+        for row in rows:
+            pkval = tuple(attr.check(row[attr_offsets[attr][0]], None, entity, from_db=True)
+                          for attr, offset in pk_attrs)
+            key_items = []
+            for key_attrs in keys:
+                vals = tuple(attr.check(row[attr_offsets[attr][0]], None, entity, from_db=True)
+                             for attr in key_attrs)
+                if None not in vals: key_items.append((key_attrs, vals))
+            items.append((pkval, tuple(row[offset] for offset in offsets), key_items))
+        entity_cache.put_many(entity, items)
+    def _find_in_entity_cache_(entity, pkval, avdict):
+        database = entity._database_
+        cache = database._get_cache()
+        if entity in cache.entity_cache_dirty: return None
+        entity_cache = database.entity_cache
+        attrs, attr_offsets, pk_attrs, keys = entity._get_entity_cache_layout_()
+        key_attrs = None
+        if pkval is not None: pkval = entity._pk_is_composite_ and pkval or (pkval,)
+        else:
+            for key_attrs in keys:
+                for attr in key_attrs:
+                    if attr not in avdict: break
+                else: break
+            else: return None
+            vals = tuple(avdict[attr] for attr in key_attrs)
+            pkval = entity_cache.get_pkval(entity, key_attrs, vals)
+            if pkval is None: return None
+        row = entity_cache.get_row(entity, pkval)
+        if row is None: return None
+        objects = entity._objects_from_rows_([ row ], attr_offsets)
+        if not objects: return None
+        obj = objects[0]
+        if key_attrs is not None and vals != tuple(attr.__get__(obj) for attr in key_attrs):
+            return None  # value of the key was changed, so another object can have it now
+        return obj
+    def _load_from_entity_cache_(entity, obj):
+        database = entity._database_
+        if entity in obj._cache_.entity_cache_dirty: return False
+        attrs, attr_offsets, pk_attrs, keys = entity._get_entity_cache_layout_()
+        pkval = obj._pk_is_composite_ and obj._pkval_ or (obj._pkval_,)
+        row = database.entity_cache.get_row(entity, pkval)
+        if row is None: return False
+        return obj in entity._objects_from_rows_([ row ], attr_offsets)
+    def _objects_from_rows_(entity, rows, attr_offsets, rbits=None, for_update=False):
+        database = entity._database_
+        hooks = database._hooks.get('hydrate')  # read once, because other thread can add hook meanwhile
+        if hooks: t = time()
         objects = []
         if attr_offsets is None:
             objects = [ entity._get_by_raw_pkval_(row, for_update) for row in rows ]
             entity._load_many_(objects)
         else:
-            for row in rows:
-                real_entity_subclass, pkval, avdict = entity._parse_row_(row, attr_offsets)
-                obj = real_entity_subclass._new_(pkval, 'loaded', for_update)
-                if obj._status_ in del_statuses: continue
-                obj._db_set_(avdict)
-                objects.append(obj)
+            hydrator = entity._get_hydrator_(attr_offsets)
+            if hydrator is not None: objects = hydrator(entity._database_._get_cache(), rows, for_update)
+            else:
+                for row in rows:
+                    real_entity_subclass, pkval, avdict = entity._parse_row_(row, attr_offsets)
+                    obj = real_entity_subclass._new_(pkval, 'loaded', for_update)
+                    if obj._status_ in del_statuses: continue
+                    obj._db_set_(avdict)
+                    objects.append(obj)
         if rbits is not None:
             for obj in objects: obj._rbits_ |= rbits
+        if objects and objects[0]._cache_.lru is not None: objects[0]._cache_._touch(objects)
+        if hooks:
+            data = dict(entity=entity, rows_count=len(rows), objects_count=len(objects), duration=time() - t)
+            for func in hooks: func(database, 'hydrate', data)
         return objects
+    def _get_hydrator_(entity, attr_offsets):
+        key = frozenset((attr, tuple(offsets)) for attr, offsets in attr_offsets.iteritems())
+        try: return entity._hydrator_cache_[key]
+        except KeyError: pass
+        hydrator = entity._hydrator_cache_[key] = entity._compile_hydrator_(attr_offsets)
+        return hydrator
+    def _compile_hydrator_(entity, attr_offsets):
+        # Generates function which converts rows to objects without per-row dictionary lookups.
+        # Objects which are not in the identity map yet are constructed directly,
+        # already loaded objects go through the regular _db_set_() path.
+        if entity._discriminator_attr_ is not None: return None
+        for attr in entity._pk_attrs_:
+            if attr.reverse or attr not in attr_offsets: return None
+        namespace = dict(entity=entity, pk=entity.__dict__['_pk_'], new=object.__new__,
+                         NOT_LOADED=NOT_LOADED, del_statuses=del_statuses)
+        lines = [ 'def hydrate(cache, rows, for_update):',
+                  '    index = cache.indexes.setdefault(pk, {})',
+                  '    objects = []',
+                  '    with cache.flush_disabled():',
+                  '        for row in rows:' ]
+        var_names = {}
+        def convert(attr, i):
+            offsets = attr_offsets[attr]
+            var_name = var_names[attr] = 'v%d' % i
+            namespace['attr%d' % i] = attr
+            if attr.reverse:
+                namespace['rentity%d' % i] = attr.py_type
+                if len(offsets) == 1:
+                    lines.append('            %s = row[%d]' % (var_name, offsets[0]))
+                    lines.append('            if %s is not None: %s = rentity%d._get_by_raw_pkval_((%s,))'
+                                 % (var_name, var_name, i, var_name))
+                else:
+                    lines.append('            %s = (%s)' % (var_name, ', '.join('row[%d]' % j for j in offsets)))
+                    lines.append('            %s = None in %s and None or rentity%d._get_by_raw_pkval_(%s)'
+                                 % (var_name, var_name, i, var_name))
+                return
+            if len(offsets) > 1: throw(NotImplementedError)
+            lines.append('            %s = row[%d]' % (var_name, offsets[0]))
+            converter = attr.converters and attr.converters[0] or None
+            if converter is not None:
+                namespace['sql2py%d' % i] = converter.sql2py
+                lines.append('            if %s is not None: %s = sql2py%d(%s)' % (var_name, var_name, i, var_name))
+            else: lines.append('            %s = attr%d.check(%s, None, entity, from_db=True)' % (var_name, i, var_name))
+        attrs = [ attr for attr in entity._attrs_ if attr in attr_offsets ]
+        for i, attr in enumerate(attrs): convert(attr, i)
+        pk_attrs = entity._pk_attrs_
+        if not entity._pk_is_composite_: pkval_expr = var_names[pk_attrs[0]]
+        else: pkval_expr = '(%s)' % ', '.join(var_names[attr] for attr in pk_attrs)
+        attrs = [ attr for attr in attrs if attr.pk_offset is None ]
+        if not attrs: return None  # object without loaded attributes remains a seed
+        lines.extend([
+            '            pkval = %s' % pkval_expr,
+            '            obj = index.get(pkval)',
+            '            if obj is None:',
+            '                obj = new(entity)',
+            '                obj._dbvals_ = { %s }' % ', '.join('%r: %s' % (attr.name, var_names[attr]) for attr in attrs),
+            '                obj._vals_ = { %s }' % ', '.join('%r: %s' % (attr.name, var_names[attr])
+                                                          for attr in chain(pk_attrs, attrs)),
+            '                obj._cache_ = cache',
+            '                obj._status_ = "loaded"',
+            '                obj._pkval_ = pkval',
+            '                obj._newid_ = None',
+            '                obj._rbits_ = obj._wbits_ = 0',
+            '                index[pkval] = obj' ])
+        for attr in attrs:
+            var_name = var_names[attr]
+            if attr.reverse: lines.append('                if %s is not None: %s.db_update_reverse(obj, NOT_LOADED, %s)'
+                                          % (var_name, 'attr' + var_name[1:], var_name))
+            if attr.is_unique: lines.append('                cache.db_update_simple_index(obj, %s, NOT_LOADED, %s)'
+                                            % ('attr' + var_name[1:], var_name))
+        for j, key_attrs in enumerate(entity._composite_keys_):
+            if not any(attr in var_names and attr.pk_offset is None for attr in key_attrs): continue
+            namespace['key%d' % j] = key_attrs
+            currents = [ attr.pk_offset is not None and var_names[attr] or 'NOT_LOADED' for attr in key_attrs ]
+            vals = [ var_names.get(attr, 'NOT_LOADED') for attr in key_attrs ]
+            lines.append('                cache.db_update_composite_index(obj, key%d, (%s,), (%s,))'
+                         % (j, ', '.join(currents), ', '.join(vals)))
+        lines.extend([
+            '                if for_update: cache.for_update.add(obj)',
+            '            else:',
+            '                if for_update: cache.for_update.add(obj)',
+            '                if obj._status_ in del_statuses: continue',
+            '                obj._db_set_({ %s })' % ', '.join('attr%s: %s' % (var_names[attr][1:], var_names[attr])
+                                                          for attr in attrs),
+            '            objects.append(obj)',
+            '    return objects' ])
+        exec '\n'.join(lines) in namespace
+        return namespace['hydrate']
     def _parse_row_(entity, row, attr_offsets):
         discr_attr = entity._discriminator_attr_
         if not discr_attr: real_entity_subclass = entity
@@ -2926,9 +3571,10 @@ class EntityMeta(type):
                 'Got: %d parameters' % (entity.__name__, entity.__name__[0].lower(), len(names)))
             if argsname or keyargsname: throw(TypeError)
             if defaults: throw(TypeError)
-            code_key = id(lambda_func.func_code)
+            key = get_code_key(lambda_func.func_code)
+            code_key = 'lambda', key  # the same code can be passed to filter(), but it gives another tree
             name = names[0]
-            cond_expr, external_names = decompile(lambda_func)
+            cond_expr, external_names = decompile(lambda_func, key)
         elif isinstance(lambda_func, basestring):
             lambda_text = lambda_func
             lambda_expr = string2ast(lambda_text)
@@ -3238,6 +3884,7 @@ class Entity(object):
         database = entity._database_
         if cache is not database._get_cache():
             throw(TransactionError, "Object %s doesn't belong to current transaction" % safe_repr(obj))
+        if entity._cache_policy_ is not None and entity._root_._load_from_entity_cache_(obj): return
         pk = entity.__dict__['_pk_']
         seeds = cache.seeds[pk]
         max_batch_size = database.provider.max_params_count // len(entity._pk_columns_)
@@ -3248,6 +3895,8 @@ class Entity(object):
         sql, adapter, attr_offsets = entity._construct_batchload_sql_(len(objects))
         arguments = adapter(objects)
         cursor = database._exec_sql(sql, arguments)
+        if cache.nplus1_detector is not None and len(objects) == 1:
+            cache.nplus1_detector.register('object', entity, sql)
         objects = entity._fetch_objects(cursor, attr_offsets)
         if obj not in objects: throw(UnrepeatableReadError,
                                      'Phantom object %s disappeared' % safe_repr(obj))
@@ -3533,16 +4182,19 @@ class Entity(object):
             if val._status_ == 'created':
                 val._save_(dependent_objects)
                 assert val._status_ == 'saved'
-    def _save_created_(obj):
+    def _get_insert_values_(obj, auto_pk):
         values = []
-        auto_pk = (obj._pkval_ is None)
-        if auto_pk: pk = obj.__class__.__dict__['_pk_']
         for attr in obj._attrs_:
             if not attr.columns: continue
             if attr.is_collection: continue
             val = obj._vals_[attr.name]
             if auto_pk and attr.is_pk: continue
             values.extend(attr.get_raw_values(val))
+        return values
+    def _save_created_(obj):
+        auto_pk = (obj._pkval_ is None)
+        if auto_pk: pk = obj.__class__.__dict__['_pk_']
+        values = obj._get_insert_values_(auto_pk)
         database = obj._database_
         if auto_pk: cached_sql = obj._cached_create_sql_auto_pk_
         else: cached_sql = obj._cached_create_sql_
@@ -3578,23 +4230,39 @@ class Entity(object):
             msg = " ".join(tostring(arg) for arg in e.args)
             throw(UnexpectedError, 'Object %r cannot be stored in the database. %s: %s'
                                    % (obj, e.__class__.__name__, msg), e)
-
-        if auto_pk:
-            index = obj._cache_.indexes.setdefault(pk, {})
-            obj2 = index.setdefault(new_id, obj)
-            if obj2 is not obj: throw(TransactionIntegrityError,
-                'Newly auto-generated id value %s was already used in transaction cache for another object' % new_id)
-            obj._pkval_ = obj._vals_[pk.name] = new_id
-            obj._newid_ = None
+        if auto_pk: obj._update_after_insert_(new_id)
+        else: obj._update_after_insert_()
+    def _set_new_id_(obj, new_id):
+        pk = obj.__class__.__dict__['_pk_']
+        index = obj._cache_.indexes.setdefault(pk, {})
+        obj2 = index.setdefault(new_id, obj)
+        if obj2 is not obj: throw(TransactionIntegrityError,
+            'Newly auto-generated id value %s was already used in transaction cache for another object' % new_id)
+        obj._pkval_ = obj._vals_[pk.name] = new_id
+        obj._newid_ = None
+    def _update_after_insert_(obj, new_id=None):
+        if new_id is not None: obj._set_new_id_(new_id)
 
         obj._status_ = 'saved'
         obj._rbits_ = obj._all_bits_
         obj._wbits_ = 0
+        cache = obj._cache_
+        cache.modified_tables.add(obj._table_)
+        if obj._cache_policy_ is not None: cache.entity_cache_dirty.add(obj._root_)
+        if cache.lru is not None: cache.lru[obj] = None
         bits = obj._bits_
         for attr in obj._attrs_:
             if attr not in bits: continue
             obj._dbvals_[attr.name] = obj._vals_[attr.name]
     def _save_updated_(obj):
+        prepared = obj._prepare_update_()
+        if prepared is not None:
+            sql, arguments, query_key, values = prepared
+            cursor = obj._database_._exec_sql(sql, arguments)
+            if cursor.rowcount != 1:
+                throw(UnrepeatableReadError, 'Object %s was updated outside of current transaction' % safe_repr(obj))
+        obj._update_after_update_()
+    def _prepare_update_(obj):
         update_columns = []
         values = []
         for attr in obj._attrs_with_bit_(obj._wbits_):
@@ -3634,11 +4302,14 @@ class Entity(object):
                 sql, adapter = database._ast2sql(sql_ast)
                 obj._update_sql_cache_[query_key] = sql, adapter
             else: sql, adapter = cached_sql
-            arguments = adapter(values)
-            cursor = database._exec_sql(sql, arguments)
-            if cursor.rowcount != 1:
-                throw(UnrepeatableReadError, 'Object %s was updated outside of current transaction' % safe_repr(obj))
+            return sql, adapter(values), query_key, values
+        return None
+    def _update_after_update_(obj):
         obj._status_ = 'saved'
+        cache = obj._cache_
+        cache.modified_tables.add(obj._table_)
+        if cache.lru is not None: cache.lru[obj] = None  # moves obj to the most recently used end
+        if obj._cache_policy_ is not None: obj._cache_._invalidate_in_entity_cache(obj)
         obj._rbits_ |= obj._wbits_
         obj._wbits_ = 0
         for attr in obj._attrs_with_bit_():
@@ -3668,9 +4339,13 @@ class Entity(object):
         else: sql, adapter = cached_sql
         arguments = adapter(values)
         database._exec_sql(sql, arguments)
+        obj._update_after_delete_()
+    def _update_after_delete_(obj):
         obj._status_ = 'deleted'
+        obj._cache_.modified_tables.add(obj._table_)
+        if obj._cache_policy_ is not None: obj._cache_._invalidate_in_entity_cache(obj)
         pk = obj.__class__.__dict__['_pk_']
-        cache.indexes[pk].pop(obj._pkval_)
+        obj._cache_.indexes[pk].pop(obj._pkval_)
     def _save_(obj, dependent_objects=None):
         cache = obj._cache_
         assert cache.is_alive
@@ -3684,6 +4359,215 @@ class Entity(object):
         elif status == 'marked_to_delete': obj._save_deleted_()
         else: assert False
 
+class EntityCache(object):
+    # Second-level cache of rows of entities with _cache_policy_, shared by all db_sessions.
+    # Storage must implement get(), set() and delete() methods of memcached client
+    def __init__(entity_cache, storage=None, ttl=DEFAULT, prefix='pony:'):
+        if storage is None: storage = options.ALTERNATIVE_ORM_MEMCACHE
+        if storage is None: storage = LocalMemcache(options.ENTITY_CACHE_SIZE)
+        if ttl is DEFAULT: ttl = options.ENTITY_CACHE_TTL
+        entity_cache.storage = storage
+        entity_cache.ttl = ttl or 0
+        entity_cache.prefix = prefix
+    def _get_key_prefix(entity_cache, entity):
+        # version is incremented when all rows of the entity become invalid, e.g. after bulk update
+        version_key = entity_cache.prefix + entity.__name__
+        version = entity_cache.storage.get(version_key) or 0
+        return '%s:%d:' % (version_key, version)
+    def get_row(entity_cache, entity, pkval):
+        return entity_cache.storage.get(entity_cache._get_key_prefix(entity) + repr(pkval))
+    def get_pkval(entity_cache, entity, attrs, vals):
+        key = '%s%s=%r' % (entity_cache._get_key_prefix(entity), ','.join(attr.name for attr in attrs), vals)
+        return entity_cache.storage.get(key)
+    def put_many(entity_cache, entity, items):
+        storage = entity_cache.storage
+        ttl = entity_cache.ttl
+        prefix = entity_cache._get_key_prefix(entity)
+        for pkval, row, key_items in items:
+            storage.set(prefix + repr(pkval), row, ttl)
+            for attrs, vals in key_items:
+                storage.set('%s%s=%r' % (prefix, ','.join(attr.name for attr in attrs), vals), pkval, ttl)
+    def get_generation(entity_cache):
+        # generation is incremented on each invalidation, rows selected in a transaction
+        # which started before that are not put to the cache
+        return entity_cache.storage.get(entity_cache.prefix + ':generation') or 0
+    def _increment_generation(entity_cache):
+        key = entity_cache.prefix + ':generation'
+        entity_cache.storage.set(key, (entity_cache.storage.get(key) or 0) + 1)
+    def invalidate(entity_cache, entity, pkvals):
+        storage = entity_cache.storage
+        prefix = entity_cache._get_key_prefix(entity)
+        for pkval in pkvals: storage.delete(prefix + repr(pkval))
+        entity_cache._increment_generation()
+    def invalidate_all(entity_cache, entity):
+        storage = entity_cache.storage
+        version_key = entity_cache.prefix + entity.__name__
+        storage.set(version_key, (storage.get(version_key) or 0) + 1)
+        entity_cache._increment_generation()
+
+ANY_TABLE = '*'
+
+class QueryResultCache(object):
+    # Rows of query results shared by all db_sessions. Each entry is tagged with versions of tables
+    # used in the query, and version of a table is incremented after commit which changes it
+    def __init__(result_cache, storage=None, ttl=DEFAULT, prefix='pony-query:'):
+        if storage is None: storage = options.ALTERNATIVE_ORM_MEMCACHE
+        if storage is None: storage = LocalMemcache(options.QUERY_RESULT_CACHE_SIZE)
+        if ttl is DEFAULT: ttl = options.QUERY_RESULT_CACHE_TTL
+        result_cache.storage = storage
+        result_cache.ttl = ttl or 0
+        result_cache.prefix = prefix
+    def _get_table_key(result_cache, table_name):
+        if not isinstance(table_name, basestring): table_name = '.'.join(table_name)
+        return '%stable:%s' % (result_cache.prefix, table_name)
+    def _get_key(result_cache, sql, arguments):
+        # rows are stored as they were received from the database, so they depend on SQL and arguments only
+        if type(arguments) is dict: arguments = sorted(arguments.iteritems())
+        return result_cache.prefix + hashlib.md5(repr((sql, arguments))).hexdigest()
+    def get_versions(result_cache, tables):
+        storage = result_cache.storage
+        return tuple(storage.get(result_cache._get_table_key(table_name)) or 0
+                     for table_name in (ANY_TABLE,) + tables)
+    def get(result_cache, sql, arguments, versions):
+        entry = result_cache.storage.get(result_cache._get_key(sql, arguments))
+        if entry is None or entry[0] != versions: return None
+        return entry[1]
+    def put(result_cache, sql, arguments, versions, rows):
+        result_cache.storage.set(result_cache._get_key(sql, arguments), (versions, rows), result_cache.ttl)
+    def invalidate(result_cache, tables):
+        storage = result_cache.storage
+        for table_name in tables:
+            key = result_cache._get_table_key(table_name)
+            storage.set(key, (storage.get(key) or 0) + 1)
+
+orm_dir = os.path.dirname(os.path.abspath(__file__))
+orm_dirs = set([ os.path.dirname(orm_dir), orm_dir, os.path.join(orm_dir, 'dbproviders') ])
+
+def get_call_site():
+    # returns location of the first frame which does not belong to Pony itself
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith('<auto generated wrapper') \
+           and os.path.dirname(os.path.abspath(filename)) not in orm_dirs: break
+        frame = frame.f_back
+    if frame is None: return None
+    return frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name
+
+class NPlusOneDetector(object):
+    # counts loads of single objects and collections made by separate queries,
+    # the same SQL executed many times from the same line of code signals about N+1 problem
+    def __init__(detector):
+        detector.threshold = options.NPLUS1_DETECTION_THRESHOLD
+        detector.counters = {}
+    def register(detector, kind, target, sql):
+        call_site = get_call_site()
+        key = kind, target, sql, call_site
+        counter = detector.counters.get(key, 0) + 1
+        detector.counters[key] = counter
+        if counter != detector.threshold: return
+        if kind == 'collection':
+            msg = 'collection %s is loaded separately for each object' % target
+            suggestion = 'query.prefetch(%s)' % target
+        elif kind == 'attribute':
+            msg = 'attribute %s is loaded separately for each object' % target
+            if target.reverse: suggestion = 'query.prefetch(%s)' % target
+            else: suggestion = 'selecting %s together with objects or removing lazy=True' % target
+        elif kind == 'object':
+            msg = 'objects of %s are loaded one by one' % target.__name__
+            attrs = [ attr for entity in sorted(target._database_.entities.itervalues(), key=attrgetter('_id_'))
+                           for attr in entity._new_attrs_
+                           if attr.py_type is target and not attr.is_collection ]
+            if attrs: suggestion = ' or '.join('query.include(lambda x: x.%s)' % attr.name for attr in attrs)
+            else: suggestion = 'loading them with a single select()'
+        else:
+            msg = 'objects of %s are retrieved one by one by %s' % (target[0].__name__, ', '.join(target[1]))
+            suggestion = 'retrieving them with a single select()'
+        if call_site is None: location = 'unknown location'
+        else: location = '%s:%d (in %s)' % call_site
+        msg = 'Possible N+1 problem: %s (%d queries from %s). Consider %s. SQL: %s' \
+              % (msg, counter, location, suggestion, ' '.join(sql.split()))
+        if call_site is None: warnings.warn(msg, NPlusOneWarning, 4)
+        else: warnings.warn_explicit(msg, NPlusOneWarning, call_site[0], call_site[1])
+
+class SlowQueryLog(object):
+    # records statements which took more than threshold seconds into a rotating file or into an SQLite table
+    def __init__(log, threshold=None, filename=None, sqlite_filename=None, max_bytes=10*1024*1024, backup_count=5,
+                 redact=False, arguments_sample_rate=1.0, max_argument_length=100):
+        if threshold is None: threshold = options.SLOW_QUERY_THRESHOLD
+        if filename is None and sqlite_filename is None: sqlite_filename = options.LOG_TO_SQLITE
+        if filename is None and sqlite_filename is None: throw(TypeError,
+            'Either filename or sqlite_filename must be specified for slow query log')
+        if filename is not None and sqlite_filename is not None: throw(TypeError,
+            'Only one of filename and sqlite_filename can be specified for slow query log')
+        if not (redact is True or redact is False or callable(redact)): throw(TypeError,
+            "'redact' parameter must be True, False or callable. Got: %r" % redact)
+        log.threshold = threshold
+        log.redact = redact
+        log.arguments_sample_rate = arguments_sample_rate
+        log.max_argument_length = max_argument_length
+        log.count = 0
+        log.database = None
+        log.lock = Lock()
+        log.handler = log.connection = None
+        if filename is not None:
+            log.handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+            log.handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        else:
+            import sqlite3
+            log.connection = sqlite3.connect(sqlite_filename, check_same_thread=False)
+            log.connection.execute('''create table if not exists pony_slow_queries (
+                id integer primary key, timestamp real not null, duration real not null, sql text not null,
+                arguments text, rowcount integer, call_site text, db_session text, thread text)''')
+            log.connection.commit()
+    def __call__(log, database, event, data):
+        duration = data['duration']
+        if data['cached'] or duration < log.threshold: return
+        call_site = get_call_site()
+        record = dict(timestamp=time(), duration=duration, sql=data['sql'], arguments=log._format_arguments(data['arguments']),
+                      rowcount=data['rowcount'] if data['rowcount'] >= 0 else None,
+                      call_site=call_site and '%s:%d (in %s)' % call_site,
+                      db_session=local.db_session_site and '%s:%d (in %s)' % local.db_session_site,
+                      thread=current_thread().getName())
+        with log.lock:
+            log.count += 1
+            if log.handler is not None: log._write_to_file(record)
+            elif log.connection is not None: log._write_to_sqlite(record)
+    def _format_arguments(log, arguments):
+        if not arguments: return None
+        if log.redact is True: return '<%d redacted>' % len(arguments)
+        if log.arguments_sample_rate < 1.0 and random() >= log.arguments_sample_rate: return '<not sampled>'
+        if type(arguments) is list: return '\n'.join(map(log._args2str, arguments))
+        return log._args2str(arguments)
+    def _args2str(log, args):
+        if log.redact is not False: args = log.redact(args)
+        limit = log.max_argument_length
+        def truncate(x):
+            x = repr(x)
+            return x if len(x) <= limit else x[:limit] + '...'
+        if isinstance(args, dict):
+            return '{%s}' % ', '.join('%r:%s' % (key, truncate(val)) for key, val in sorted(args.iteritems()))
+        return '[%s]' % ', '.join(map(truncate, args))
+    def _write_to_file(log, record):
+        msg = '%.3fs %s\n  arguments: %s\n  rowcount: %s\n  call site: %s\n  db_session: %s\n  thread: %s' \
+              % (record['duration'], ' '.join(record['sql'].split()), record['arguments'], record['rowcount'],
+                 record['call_site'], record['db_session'], record['thread'])
+        log.handler.handle(logging.makeLogRecord(dict(name='pony.orm.slow_query', levelno=logging.WARNING,
+                                                      levelname='WARNING', msg=msg)))
+    def _write_to_sqlite(log, record):
+        log.connection.execute('insert into pony_slow_queries (timestamp, duration, sql, arguments, rowcount, '
+                               'call_site, db_session, thread) values (?, ?, ?, ?, ?, ?, ?, ?)',
+                               [ record[key] for key in ('timestamp', 'duration', 'sql', 'arguments', 'rowcount',
+                                                         'call_site', 'db_session', 'thread') ])
+        log.connection.commit()
+    def close(log):
+        if log.database is not None and log in log.database._hooks.get('execute', ()):
+            log.database.remove_hook('execute', log)
+        with log.lock:
+            if log.handler is not None: log.handler.close()
+            if log.connection is not None: log.connection.close()
+            log.handler = log.connection = None
+
 class Cache(object):
     def __init__(cache, database):
         cache.is_alive = True
@@ -3700,8 +4584,22 @@ class Cache(object):
         cache.modified_collections = {}
         cache.objects_to_save = []
         cache.query_results = {}
+        cache.entity_cache_dirty = set()
+        cache.entity_cache_pkvals = {}
+        cache.entity_cache_generation = None  # generation of entity cache at the start of transaction
+        cache.modified_tables = set()
         cache.modified = False
-        cache.connection = cache.establish_connection(False)
+        session = local.db_session
+        cache.readonly = session is not None and session.readonly
+        cache.max_size = session is not None and session.max_cache_size or None
+        cache.lru = LRUCache(None) if cache.max_size else None  # objects from least recently used
+        cache.nplus1_detector = session is not None and session.detect_nplus1 and NPlusOneDetector() or None
+        if cache.readonly: cache.provider = database._acquire_replica()
+        else: cache.provider = database.provider
+        try: cache.connection = cache.establish_connection(False)
+        except:
+            database._release_replica(cache.provider)
+            raise
     def establish_connection(cache, reestablish=True):
         if reestablish:
             assert not cache.connection
@@ -3710,21 +4608,25 @@ class Cache(object):
             elif cache.noflush_counter: throw(ConnectionClosedError,
                 'Optimistic transaction cannot be completed because database connection failed during saving changes')
             if debug: log_orm('RECONNECT')
-        provider = cache.database.provider
+        provider = cache.provider
+        database = cache.database
+        t = time()
         connection = provider.connect()
         cache.connection = connection
         provider.set_transaction_mode(connection, cache.optimistic)
+        if 'connect' in database._hooks: database._call_hooks('connect', dict(
+            provider=provider, reconnect=reestablish, duration=time() - t))
         return connection
     def _switch_from_optimistic_mode(cache):
         assert cache.optimistic
         connection = cache.connection or cache.establish_connection()
         cache.optimistic = False
-        provider = cache.database.provider
+        provider = cache.provider
         provider.set_transaction_mode(cache.connection, optimistic=False)
     def commit(cache):
         assert cache.is_alive
         database = cache.database
-        provider = database.provider
+        provider = cache.provider
         connection = cache.connection or cache.establish_connection()
         if cache.optimistic:
             try:
@@ -3734,8 +4636,10 @@ class Cache(object):
                 cache.is_alive = False
                 cache.connection = None
                 x = local.db2cache.pop(database); assert x is cache
+                database._release_replica(provider)
                 provider.drop(connection)
                 raise
+        t = time()
         try:
             modified = cache.modified
             if modified:
@@ -3747,6 +4651,12 @@ class Cache(object):
             if modified or not cache.optimistic:
                 if debug: log_orm('COMMIT')
                 provider.commit(connection)
+            if cache.entity_cache_dirty: cache._commit_entity_cache()
+            cache.entity_cache_generation = None
+            if cache.modified_tables:
+                result_cache = database.query_result_cache
+                if result_cache is not None: result_cache.invalidate(cache.modified_tables)
+                cache.modified_tables.clear()
             if database.optimistic:
                 cache.optimistic = True
                 provider.set_transaction_mode(connection, optimistic=True)
@@ -3755,15 +4665,18 @@ class Cache(object):
         except:
             cache.rollback()
             raise
+        if 'commit' in database._hooks: database._call_hooks('commit', dict(modified=modified, duration=time() - t))
     def rollback(cache):
         assert cache.is_alive
         database = cache.database
         x = local.db2cache.pop(database); assert x is cache
         cache.is_alive = False
-        provider = database.provider
+        provider = cache.provider
+        database._release_replica(provider)
         connection = cache.connection
         if connection is None: return
         cache.connection = None
+        t = time()
         try:
             if debug: log_orm('ROLLBACK')
             provider.rollback(connection)
@@ -3773,12 +4686,14 @@ class Cache(object):
             if debug: log_orm('CLOSE_CONNECTION')
             provider.drop(connection)
             raise
+        if 'rollback' in database._hooks: database._call_hooks('rollback', dict(duration=time() - t))
     def release(cache):
         assert cache.is_alive
         database = cache.database
         x = local.db2cache.pop(database); assert x is cache
         cache.is_alive = False
-        provider = database.provider
+        provider = cache.provider
+        database._release_replica(provider)
         connection = cache.connection
         if connection is None: return
         cache.connection = None
@@ -3789,7 +4704,8 @@ class Cache(object):
         database = cache.database
         x = local.db2cache.pop(database); assert x is cache
         cache.is_alive = False
-        provider = database.provider
+        provider = cache.provider
+        database._release_replica(provider)
         connection = cache.connection
         if connection is None: return
         cache.connection = None
@@ -3807,14 +4723,24 @@ class Cache(object):
     def save(cache):
         assert cache.is_alive
         if not cache.modified: return
+        if cache.readonly: throw(TransactionError, 'Cannot save changes inside of read-only db_session')
+        t = time()
+        objects_count = len(cache.objects_to_save)
         with cache.flush_disabled():
             cache.query_results.clear()
             modified_m2m = cache._calc_modified_m2m()
+            cache.modified_tables.update(attr.table for attr in modified_m2m)
             for attr, (added, removed) in modified_m2m.iteritems():
                 if not removed: continue
                 attr.remove_m2m(removed)
+            batch, batch_status = [], None
             for obj in cache.objects_to_save:
-                obj._save_()
+                status = obj._status_
+                if status != batch_status:
+                    cache._save_objects(batch_status, batch)
+                    batch, batch_status = [], status
+                batch.append(obj)
+            cache._save_objects(batch_status, batch)
             for attr, (added, removed) in modified_m2m.iteritems():
                 if not added: continue
                 attr.add_m2m(added)
@@ -3822,6 +4748,191 @@ class Cache(object):
         cache.modified_collections.clear()
         cache.objects_to_save[:] = []
         cache.modified = False
+        database = cache.database
+        if 'save' in database._hooks: database._call_hooks('save', dict(
+            objects_count=objects_count, duration=time() - t))
+        if cache.lru is not None and len(cache.lru) > cache.max_size: cache._evict_lru()
+    def evict(cache, objects):
+        evicted = 0
+        for obj in objects:
+            if obj._cache_ is not cache or obj._status_ not in ('loaded', 'saved') \
+               or obj._wbits_ or obj in cache.for_update: continue
+            vals = obj._vals_
+            for attr in obj._attrs_:
+                if not attr.reverse: continue
+                val = vals.get(attr.name)
+                if attr.is_collection:
+                    if val: break  # other cached objects refer to obj
+                elif not attr.reverse.is_collection and val is not None and val is not NOT_LOADED: break
+            else:
+                cache._detach(obj)
+                evicted += 1
+        if evicted: cache.query_results.clear()
+        return evicted
+    def _touch(cache, objects):
+        lru = cache.lru
+        for obj in objects: lru[obj] = None
+        if len(lru) > cache.max_size: cache._evict_lru()
+    def _evict_lru(cache):
+        lru = cache.lru
+        candidates = lru.keys()[:len(lru) - cache.max_size]
+        cache.evict(candidates)
+        for obj in candidates:  # objects which cannot be evicted yet become most recently used
+            if lru.pop(obj, NOT_LOADED) is not NOT_LOADED: lru[obj] = None
+    def clear(cache):
+        assert not cache.is_alive
+        for index in cache.indexes.itervalues():
+            for obj in index.itervalues(): obj._vals_ = obj._dbvals_ = {}
+        for obj in cache.objects_to_save: obj._vals_ = obj._dbvals_ = {}
+        cache.indexes.clear()
+        cache.seeds.clear()
+        cache.for_update.clear()
+        cache.query_results.clear()
+        cache.objects_to_save[:] = []
+        if cache.lru is not None: cache.lru.clear()
+    def _detach(cache, obj):
+        vals = obj._vals_
+        if cache.lru is not None: cache.lru.pop(obj, None)
+        pk = obj.__class__.__dict__['_pk_']
+        index = cache.indexes.get(pk)
+        if index is not None and index.get(obj._pkval_) is obj: del index[obj._pkval_]
+        seeds = cache.seeds.get(pk)
+        if seeds: seeds.discard(obj)
+        for attr in obj._simple_keys_:
+            index = cache.indexes.get(attr)
+            val = vals.get(attr.name)
+            if index is not None and index.get(val) is obj: del index[val]
+        for attrs in obj._composite_keys_:
+            index = cache.indexes.get(attrs)
+            key = tuple(vals.get(attr.name) for attr in attrs)
+            if index is not None and index.get(key) is obj: del index[key]
+        for attr in obj._attrs_:
+            reverse = attr.reverse
+            if not reverse or attr.is_collection: continue
+            val = vals.get(attr.name)
+            if val is None or val is NOT_LOADED: continue
+            setdata = val._vals_.get(reverse.name)
+            if setdata is None: continue
+            setdata.discard(obj)
+            setdata.is_fully_loaded = False
+    def _invalidate_in_entity_cache(cache, obj):
+        root = obj._root_
+        cache.entity_cache_dirty.add(root)
+        pkvals = cache.entity_cache_pkvals.setdefault(root, set())
+        if pkvals is not None: pkvals.add(obj._pk_is_composite_ and obj._pkval_ or (obj._pkval_,))
+    def _commit_entity_cache(cache):
+        entity_cache = cache.database.entity_cache
+        pkvals = cache.entity_cache_pkvals
+        for entity in cache.entity_cache_dirty:
+            if entity in pkvals:
+                if pkvals[entity] is None: entity_cache.invalidate_all(entity)
+                else: entity_cache.invalidate(entity, pkvals[entity])
+        cache.entity_cache_dirty.clear()
+        pkvals.clear()
+    def _save_objects(cache, status, objects):
+        if not objects: return
+        if status in ('updated', 'marked_to_delete'):
+            for obj in objects:
+                if obj._cache_policy_ == 'readonly': throw(TransactionError,
+                    'Object %s cannot be modified because entity %s has read-only cache policy'
+                    % (safe_repr(obj), obj.__class__.__name__))
+        if status == 'created': cache._save_created_objects(objects)
+        elif status == 'updated': cache._save_updated_objects(objects)
+        elif status == 'marked_to_delete': cache._save_deleted_objects(objects)
+        else:
+            for obj in objects: obj._save_()
+    def _save_updated_objects(cache, objects):
+        # consecutive updates with the same SQL text are sent with single executemany() call
+        # or, where executemany() takes a round trip per row, as single UPDATE ... FROM (VALUES ...)
+        for obj in objects:
+            if obj._status_ == 'updated': obj._save_principal_objects_(None)
+        batch_sql, batch_key, batch = None, None, []
+        for obj in objects:
+            if obj._status_ != 'updated': continue
+            prepared = obj._prepare_update_()
+            if prepared is None:
+                obj._update_after_update_()
+                continue
+            sql, arguments, query_key, values = prepared
+            if sql != batch_sql:
+                cache._execute_updates(batch_sql, batch_key, batch)
+                batch_sql, batch_key, batch = sql, query_key, []
+            batch.append((obj, arguments, values))
+        cache._execute_updates(batch_sql, batch_key, batch)
+    def _execute_updates(cache, sql, query_key, batch):
+        if not batch: return
+        database = cache.database
+        provider = cache.provider
+        if len(batch) > 1 and provider.update_from_values_syntax:
+            entity = batch[0][0].__class__
+            max_batch_size = max(1, provider.max_params_count // len(batch[0][2]))
+            for start in xrange(0, len(batch), max_batch_size):
+                chunk = batch[start:start+max_batch_size]
+                if len(chunk) == 1: cache._execute_updates(sql, query_key, chunk); continue
+                sql2, adapter = entity._construct_update_many_sql_(query_key, len(chunk))
+                cursor = database._exec_sql(sql2, adapter([ tuple(values) for obj, arguments, values in chunk ]))
+                if cursor.rowcount != len(chunk):
+                    objects_repr = ', '.join(safe_repr(obj) for obj, arguments, values in chunk[:3]) \
+                                   + (len(chunk) > 3 and ', ...' or '')
+                    throw(UnrepeatableReadError,
+                          'Some of objects %s were updated outside of current transaction' % objects_repr)
+                for obj, arguments, values in chunk: obj._update_after_update_()
+            return
+        if len(batch) == 1 or not provider.executemany_rowcount:
+            for obj, arguments, values in batch:
+                cursor = database._exec_sql(sql, arguments)
+                if cursor.rowcount != 1:
+                    throw(UnrepeatableReadError, 'Object %s was updated outside of current transaction' % safe_repr(obj))
+                obj._update_after_update_()
+            return
+        cursor = database._exec_sql(sql, [ arguments for obj, arguments, values in batch ])
+        if cursor.rowcount != len(batch):
+            objects_repr = ', '.join(safe_repr(obj) for obj, arguments, values in batch[:3]) \
+                           + (len(batch) > 3 and ', ...' or '')
+            throw(UnrepeatableReadError, 'Some of objects %s were updated outside of current transaction' % objects_repr)
+        for obj, arguments, values in batch: obj._update_after_update_()
+    def _save_deleted_objects(cache, objects):
+        # consecutive deletes of the same entity with equal optimistic checks (e.g. cascade delete
+        # of collection items) are sent as single DELETE ... WHERE pk IN (...) statement
+        batch, batch_key = [], None
+        for obj in objects:
+            if obj._status_ != 'marked_to_delete': continue
+            entity = obj.__class__
+            if entity._is_self_referenced_(): key = None
+            elif not cache.optimistic and obj in cache.for_update: key = entity, (), (), ()
+            else:
+                columns, converters, values = obj._construct_optimistic_criteria_()
+                key = entity, tuple(columns), tuple(converters), tuple(values)
+            if key != batch_key:
+                if batch: batch_key[0]._delete_many_(batch, *batch_key[1:])
+                batch, batch_key = [], key
+            if key is None: obj._save_deleted_()
+            else: batch.append(obj)
+        if batch: batch_key[0]._delete_many_(batch, *batch_key[1:])
+    def _save_created_objects(cache, objects):
+        # consecutive created objects are grouped by entity and the groups are saved
+        # in such order that referenced objects are inserted before objects which refer to them
+        groups = {}
+        entities = []
+        for obj in objects:
+            entity = obj.__class__
+            group = groups.get(entity)
+            if group is None:
+                group = groups[entity] = []
+                entities.append(entity)
+            group.append(obj)
+        ordered = []
+        visited = set()
+        def visit(entity):
+            if entity in visited: return
+            visited.add(entity)
+            for attr in entity._attrs_:
+                if not attr.reverse or attr.is_collection or not attr.columns: continue
+                for entity2 in entities:
+                    if issubclass(entity2, attr.py_type): visit(entity2)
+            ordered.append(entity)
+        for entity in entities: visit(entity)
+        for entity in ordered: entity._save_created_many_(groups[entity])
     def _calc_modified_m2m(cache):
         modified_m2m = {}
         for attr, objects in sorted(cache.modified_collections.iteritems(),
@@ -3925,8 +5036,8 @@ def string2ast(s):
 @cut_traceback
 def select(gen, frame_depth=0, left_join=False):
     if isinstance(gen, types.GeneratorType):
-        tree, external_names = decompile(gen)
-        code_key = id(gen.gi_frame.f_code)
+        code_key = get_code_key(gen.gi_frame.f_code)
+        tree, external_names = decompile(gen, code_key)
         globals = gen.gi_frame.f_globals
         locals = gen.gi_frame.f_locals
     elif isinstance(gen, basestring):
@@ -4014,6 +5125,8 @@ def extract_vars(extractors, globals, locals):
 def unpickle_query(query_result):
     return query_result
 
+LIMIT_PARAM, OFFSET_PARAM, SEEK_PARAM, UPDATE_PARAM = '.limit', '.offset', '.seek', '.update'  # cannot clash with sources of external expressions
+
 class Query(object):
     def __init__(query, code_key, tree, globals, locals, left_join=False):
         assert isinstance(tree, ast.GenExprInner)
@@ -4044,6 +5157,7 @@ class Query(object):
 
         translator = database._translator_cache.get(query._key)
         if translator is None:
+            t = time()
             pickled_tree = query._pickled_tree = dumps(tree, 2)
             tree = loads(pickled_tree)  # tree = deepcopy(tree)
             translator_cls = database.provider.translator_cls
@@ -4054,26 +5168,42 @@ class Query(object):
                 try: translator = translator_cls(tree, extractors, vartypes, left_join=True, optimize=name_path)
                 except OptimizationFailed: translator.optimization_failed = True
             database._translator_cache[query._key] = translator
-        query._translator = translator
+            if 'translate' in database._hooks: database._call_hooks('translate', dict(
+                key=query._key, cached=False, duration=time() - t))
+        elif 'translate' in database._hooks: database._call_hooks('translate', dict(
+            key=query._key, cached=True, duration=0.0))
+        query._translator = query._root_translator = translator
         query._filters = []
         query._for_update = query._nowait = False
+        query._prefetch = query._include = ()
     def __reduce__(query):
         return unpickle_query, (query._fetch(),)
     def _construct_sql_and_arguments(query, range=None, distinct=None, aggr_func_name=None):
         translator = query._translator
-        sql_key = query._key + (range, distinct, aggr_func_name, query._for_update, query._nowait,
-                                options.INNER_JOIN_SYNTAX)
+        if range is None: range_key = None
+        else: range_key = range[0] and 'LIMIT_OFFSET' or 'LIMIT'
+        sql_key = query._key + (range_key, distinct, aggr_func_name, query._for_update, query._nowait,
+                                options.INNER_JOIN_SYNTAX, query._include)
         database = query._database
         cache_entry = database._constructed_sql_cache.get(sql_key)
         if cache_entry is None:
             sql_ast, attr_offsets = translator.construct_sql_ast(
                 range, distinct, aggr_func_name, query._for_update, query._nowait)
+            if query._include and attr_offsets is not None:
+                sql_ast, include_offsets = translator.construct_include_joins(sql_ast, query._include)
+            else: include_offsets = None
             cache = database._get_cache()
             sql, adapter = database.provider.ast2sql(sql_ast)
-            cache_entry = sql, adapter, attr_offsets
+            cache_entry = sql, adapter, attr_offsets, include_offsets, tuple(sorted(get_table_names(sql_ast)))
             database._constructed_sql_cache[sql_key] = cache_entry
-        else: sql, adapter, attr_offsets = cache_entry
-        arguments = adapter(query._vars)
+        sql, adapter, attr_offsets, include_offsets, tables = cache_entry
+        values = query._vars
+        if range is not None:
+            start, stop = range
+            values = values.copy()
+            values[LIMIT_PARAM] = stop - start
+            if start: values[OFFSET_PARAM] = start
+        arguments = adapter(values)
         if query._translator.query_result_is_cacheable:
             arguments_type = type(arguments)
             if arguments_type is tuple: arguments_key = arguments
@@ -4082,13 +5212,23 @@ class Query(object):
             except: query_key = None  # arguments are unhashable
             else: query_key = sql_key + (arguments_key)
         else: query_key = None
-        return sql, arguments, attr_offsets, query_key
+        return sql, arguments, attr_offsets, include_offsets, query_key, tables
+    def _get_shared_result_cache(query, tables):
+        result_cache = query._database.query_result_cache
+        if result_cache is None or query._for_update: return None
+        if query._cache.provider is not query._database.provider: return None  # replica can lag behind
+        modified_tables = query._cache.modified_tables
+        if ANY_TABLE in modified_tables or not modified_tables.isdisjoint(tables):
+            return None  # results can contain uncommitted changes
+        return result_cache
     def _fetch(query, range=None, distinct=None):
         translator = query._translator
-        sql, arguments, attr_offsets, query_key = query._construct_sql_and_arguments(range, distinct)
+        sql, arguments, attr_offsets, include_offsets, query_key, tables = \
+            query._construct_sql_and_arguments(range, distinct)
         cache = query._cache
         database = query._database
         if query._for_update:
+            if cache.readonly: throw(TransactionError, 'SELECT FOR UPDATE cannot be used inside of read-only db_session')
             cache.flush()
             if database.provider.dialect == 'SQLite':
                 # Emulation of SELECT FOR UPDATE functionality. Since SQLite doesn't have table locks
@@ -4112,29 +5252,101 @@ class Query(object):
                 database._exec_sql(lock_sql)
         try: result = cache.query_results[query_key]
         except KeyError:
-            cursor = database._exec_sql(sql, arguments)
-            if isinstance(translator.expr_type, EntityMeta):
-                entity = translator.expr_type
-                result = entity._fetch_objects(cursor, attr_offsets, rbits=translator.tableref.rbits,
-                                               for_update=query._for_update)
-            elif len(translator.row_layout) == 1:
-                func, slice_or_offset, src = translator.row_layout[0]
-                result = list(starmap(func, cursor.fetchall()))
+            expr_type = translator.expr_type
+            result_cache = query_key is not None and query._get_shared_result_cache(tables) or None
+            if result_cache is not None:
+                versions = result_cache.get_versions(tables)
+                rows = result_cache.get(sql, arguments, versions)
+            else: rows = None
+            from_db = rows is None
+            if not from_db: database._update_local_cache_stat(sql)
             else:
-                result = [ tuple(func(sql_row[slice_or_offset])
-                                 for func, slice_or_offset, src in translator.row_layout)
-                           for sql_row in cursor.fetchall() ]
-                for i, t in enumerate(translator.expr_type):
-                    if isinstance(t, EntityMeta) and t._discriminator_ is not None and t._subclasses_:
-                        t._load_many_(row[i] for row in result)
+                cursor = database._exec_sql(sql, arguments)
+                if isinstance(expr_type, EntityMeta): rows = expr_type._fetch_rows_(cursor)
+                else: rows = cursor.fetchall()
+                if result_cache is not None: result_cache.put(sql, arguments, versions, rows)
+            t = time()
+            if isinstance(expr_type, EntityMeta):
+                result = expr_type._objects_from_fetched_rows_(rows, attr_offsets, rbits=translator.tableref.rbits,
+                                                               for_update=query._for_update)
+                if include_offsets: query._load_included(result, rows, include_offsets)
+            else: result = query._convert_rows(rows)
+            if from_db: database._update_local_fetch_stat(sql, len(rows), time() - t)
             if query_key is not None:
                 query._cache.query_results[query_key] = result
-        else:
-            stats = database._dblocal.stats
-            stat = stats.get(sql)
-            if stat is not None: stat.cache_count += 1
-            else: stats[sql] = QueryStat(sql)
+        else: database._update_local_cache_stat(sql)
+        if query._prefetch: query._prefetch_related(result)
         return QueryResult(result, translator.expr_type, translator.col_names)
+    def _prefetch_related(query, result):
+        if isinstance(query._translator.expr_type, EntityMeta): objects = set(result)
+        else: objects = set(item for row in result for item in row if isinstance(item, Entity))
+        for attr in query._prefetch:
+            entity = attr.entity
+            loaded = attr.batch_load([ obj for obj in objects if isinstance(obj, entity) ])
+            attr.py_type._load_many_(loaded)
+            objects |= loaded
+    def _load_included(query, objects, rows, include_offsets):
+        loaded = { () : objects }
+        for path, entity, attr_offsets in include_offsets:
+            pk_offsets = [ offset for attr in entity._pk_attrs_ for offset in attr_offsets[attr] ]
+            subrows = []
+            seen = set()
+            for row in rows:
+                pkval = tuple(row[offset] for offset in pk_offsets)
+                if pkval[0] is None or pkval in seen: continue
+                seen.add(pkval)
+                subrows.append(row)
+            loaded[path] = entity._objects_from_fetched_rows_(subrows, attr_offsets)
+            attr = path[-1]
+            if not attr.columns:
+                for obj in loaded[path[:-1]]:
+                    if attr.name not in obj._vals_: obj._vals_[attr.name] = None
+    def _convert_rows(query, rows):
+        translator = query._translator
+        if len(translator.row_layout) == 1:
+            func, slice_or_offset, src = translator.row_layout[0]
+            return list(starmap(func, rows))
+        result = [ tuple(func(sql_row[slice_or_offset])
+                         for func, slice_or_offset, src in translator.row_layout)
+                   for sql_row in rows ]
+        for i, t in enumerate(translator.expr_type):
+            if isinstance(t, EntityMeta) and t._discriminator_ is not None and t._subclasses_:
+                t._load_many_(row[i] for row in result)
+        return result
+    @cut_traceback
+    def iter_chunks(query, size=1000, evict=False):
+        if size < 1: throw(ValueError, 'Chunk size must be positive number. Got: %r' % size)
+        if query._for_update: throw(TypeError, 'Query with SELECT FOR UPDATE cannot be streamed')
+        provider = query._database.provider
+        if query._prefetch and provider.stream_blocks_connection: throw(TypeError,
+            'Query with prefetch() cannot be streamed in %s, because the connection cannot execute '
+            'other queries until the streamed result is read to the end' % provider.dialect)
+        return query._iter_chunks(size, evict)
+    def _iter_chunks(query, size, evict):
+        translator = query._translator
+        expr_type = translator.expr_type
+        is_entity = isinstance(expr_type, EntityMeta)
+        sql, arguments, attr_offsets, include_offsets, query_key, tables = query._construct_sql_and_arguments()
+        cache = query._cache
+        database = query._database
+        cursor = database._exec_sql(sql, arguments, chunk_size=size)
+        try:
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows: break
+                t = time()
+                if is_entity:
+                    chunk = expr_type._objects_from_rows_(rows, attr_offsets, translator.tableref.rbits)
+                    if include_offsets: query._load_included(chunk, rows, include_offsets)
+                else: chunk = query._convert_rows(rows)
+                database._update_local_fetch_stat(sql, len(rows), time() - t)
+                if query._prefetch: query._prefetch_related(chunk)
+                yield QueryResult(chunk, expr_type, translator.col_names)
+                if evict and is_entity: cache.evict(chunk)
+        finally: cursor.close()
+    @cut_traceback
+    def stream(query, size=1000, evict=False):
+        return chain.from_iterable(query.iter_chunks(size, evict))
     @cut_traceback
     def show(query, width=None):
         query._fetch().show(width)
@@ -4170,7 +5382,9 @@ class Query(object):
 
         new_query._aggr_func_name = 'EXISTS'
         new_query._aggr_select = [ 'ALL', [ 'VALUE', 1 ] ]
-        sql, arguments, attr_offsets, query_key = new_query._construct_sql_and_arguments(range=(0, 1))
+        new_query._include = ()
+        sql, arguments, attr_offsets, include_offsets, query_key, tables = \
+            new_query._construct_sql_and_arguments(range=(0, 1))
         cache = new_query._cache
         try: result = cache.query_results[query_key]
         except KeyError:
@@ -4227,16 +5441,13 @@ class Query(object):
             for name in func.func_code.co_varnames:
                 if name not in query._translator.subquery:
                     throw(TranslationError, 'Unknown name %s' % name)
-            func_id = id(func.func_code)
-            func_ast = decompile(func)[0]
+            func_id = get_code_key(func.func_code)
+            func_ast = decompile(func, func_id)[0]
         else: assert False
         return query._process_lambda(func_id, func_ast, globals, locals, order_by=True)
     def _without_order_by(query):
         query._key = query._key[:3]
-        database = query._database
-        translator = database._translator_cache.get(query._key)
-        assert translator is not None  # Translator for query without order_by must be in cache already
-        query._translator = translator
+        query._translator = query._root_translator  # it may be already evicted from the translator cache
         return query
     def _process_lambda(query, func_id, func_ast, globals, locals, order_by):
         extractors, varnames, func_ast = create_extractors(func_id, func_ast, query._translator.subquery)
@@ -4289,8 +5500,8 @@ class Query(object):
             for name in func.func_code.co_varnames:
                 if name not in query._translator.subquery:
                     throw(TranslationError, 'Unknown name %s' % name)
-            func_id = id(func.func_code)
-            func_ast = decompile(func)[0]
+            func_id = get_code_key(func.func_code)
+            func_ast = decompile(func, func_id)[0]
         else: throw(TypeError, 'Argument of filter() method must be a lambda functon or its text. Got: %r' % func)
         return query._process_lambda(func_id, func_ast, globals, locals, order_by=False)
     @cut_traceback
@@ -4308,6 +5519,41 @@ class Query(object):
         else: throw(TypeError, 'If you want apply index to query, convert it to list first')
         if start >= stop: return []
         return query._fetch(range=(start, stop))
+    def _seek_query(query, key):
+        database = query._database
+        new_key = query._key + (('keyset', key is not None),)
+        translator = database._translator_cache.get(new_key)
+        if translator is None:
+            translator = query._translator.order_by_key(seek=key is not None)
+            database._translator_cache[new_key] = translator
+        new_query = object.__new__(Query)
+        new_query.__dict__.update(query.__dict__)
+        new_query._key = new_key
+        new_query._translator = translator
+        if key is None: return new_query
+        key_order = translator.key_order
+        entity = translator.expr_type
+        if isinstance(key, entity):
+            key = translator.get_key_values(key)
+        elif type(key) is not tuple: throw(TypeError,
+            'Keyset pagination key must be instance of %s or tuple. Got: %r' % (entity.__name__, key))
+        elif len(key) != len(key_order): throw(TypeError,
+            'Keyset pagination key must contain %d values. Got: %r' % (len(key_order), key))
+        for (column_ast, desc, attr, i), value in izip(key_order, key):
+            if value is None: throw(ValueError, 'Keyset pagination cannot continue after NULL value of %s' % attr)
+        new_query._vars = query._vars.copy()
+        new_query._vars[SEEK_PARAM] = key
+        return new_query
+    @cut_traceback
+    def after(query, key, limit):
+        return query._seek_query(key)._fetch(range=(0, limit))
+    @cut_traceback
+    def page_by_key(query, pagesize, key=None):
+        new_query = query._seek_query(key)
+        objects = new_query._fetch(range=(0, pagesize + 1))
+        if len(objects) <= pagesize: return objects, None
+        del objects[pagesize:]
+        return objects, new_query._translator.get_key_values(objects[-1])
     @cut_traceback
     def limit(query, limit, offset=None):
         start = offset or 0
@@ -4320,13 +5566,22 @@ class Query(object):
         return query[start:stop]
     def _aggregate(query, aggr_func_name):
         translator = query._translator
-        sql, arguments, attr_offsets, query_key = query._construct_sql_and_arguments(aggr_func_name=aggr_func_name)
+        sql, arguments, attr_offsets, include_offsets, query_key, tables = \
+            query._construct_sql_and_arguments(aggr_func_name=aggr_func_name)
         cache = query._cache
         try: result = cache.query_results[query_key]
         except KeyError:
-            cursor = query._database._exec_sql(sql, arguments)
-            row = cursor.fetchone()
-            if row is not None: result = row[0]
+            result_cache = query_key is not None and query._get_shared_result_cache(tables) or None
+            if result_cache is not None:
+                versions = result_cache.get_versions(tables)
+                rows = result_cache.get(sql, arguments, versions)
+            else: rows = None
+            if rows is not None: query._database._update_local_cache_stat(sql)
+            else:
+                cursor = query._database._exec_sql(sql, arguments)
+                rows = cursor.fetchmany(1)
+                if result_cache is not None: result_cache.put(sql, arguments, versions, rows)
+            if rows: result = rows[0][0]
             else: result = None
             if result is None and aggr_func_name == 'SUM': result = 0
             if result is None: pass
@@ -4354,6 +5609,54 @@ class Query(object):
     def count(query):
         return query._aggregate('COUNT')
     @cut_traceback
+    def explain(query, analyze=False):
+        sql, arguments, attr_offsets, include_offsets, query_key, tables = query._construct_sql_and_arguments()
+        return query._database._explain(sql, arguments, analyze)
+    @cut_traceback
+    def include(query, *funcs):
+        expr_type = query._translator.expr_type
+        if not isinstance(expr_type, EntityMeta): throw(TypeError,
+            'Eager loading via include() is limited to queries which return simple list of objects')
+        paths = []
+        for func in funcs:
+            if isinstance(func, basestring): func_ast = string2ast(func)
+            elif type(func) is types.FunctionType: func_ast = decompile(func)[0]
+            else: throw(TypeError, 'Argument of include() method must be a lambda function or its text. Got: %r' % func)
+            if isinstance(func_ast, ast.Lambda): func_ast = func_ast.code
+            names = []
+            while isinstance(func_ast, ast.Getattr):
+                names.append(func_ast.attrname)
+                func_ast = func_ast.expr
+            if not names or not isinstance(func_ast, ast.Name): throw(TypeError,
+                'Argument of include() method must be a chain of attributes (e.g. lambda o: o.customer.address)')
+            entity = expr_type
+            path = []
+            for name in reversed(names):
+                attr = entity._adict_.get(name)
+                if attr is None: throw(AttributeError, 'Entity %s does not have attribute %s' % (entity.__name__, name))
+                if attr.is_collection or not isinstance(attr.py_type, EntityMeta): throw(TypeError,
+                    'Attribute %s cannot be included: only to-one relationships can be loaded using JOIN' % attr)
+                path.append(attr)
+                entity = attr.py_type
+            paths.append(tuple(path))
+        query._include = query._include + tuple(paths)
+        return query
+    @cut_traceback
+    def prefetch(query, *attrs):
+        expr_type = query._translator.expr_type
+        if type(expr_type) is not tuple: expr_type = (expr_type,)
+        entities = [ t for t in expr_type if isinstance(t, EntityMeta) ]
+        if not entities: throw(TypeError, 'Prefetching is possible only for queries which return objects')
+        for attr in attrs:
+            if not isinstance(attr, Attribute) or not attr.reverse: throw(TypeError,
+                'Relationship attribute expected. Got: %r' % attr)
+            if not [ entity for entity in entities if issubclass(entity, attr.entity) or issubclass(attr.entity, entity) ]:
+                throw(TypeError, 'Attribute %s cannot be prefetched because query does not return objects of %s'
+                                 % (attr, attr.entity.__name__))
+            entities.append(attr.py_type)
+        query._prefetch = query._prefetch + attrs
+        return query
+    @cut_traceback
     def for_update(query, nowait=False):
         provider = query._database.provider
         if nowait and not provider.select_for_update_nowait_syntax: throw(TranslationError,
@@ -4363,6 +5666,130 @@ class Query(object):
         return query
     def random(query, limit):
         return query.order_by('random()')[:limit]
+    def _prepare_bulk_operation(query):
+        cache = query._cache
+        if cache.readonly: throw(TransactionError, 'Cannot save changes inside of read-only db_session')
+        if query._for_update: throw(TypeError, 'Bulk update and delete cannot be combined with SELECT FOR UPDATE')
+        cache.flush()
+        cache.query_results.clear()
+        translator = query._translator
+        entity = translator.expr_type
+        if isinstance(entity, EntityMeta): cache.modified_tables.add(entity._table_)
+        if isinstance(entity, EntityMeta) and entity._cache_policy_ is not None:
+            if entity._cache_policy_ == 'readonly': throw(TransactionError,
+                'Objects of entity %s cannot be modified because it has read-only cache policy' % entity.__name__)
+            root = entity._root_
+            cache.entity_cache_dirty.add(root)
+            cache.entity_cache_pkvals[root] = None  # all cached rows of the entity become invalid
+        sql_key = query._key + ('PK_SUBQUERY', options.INNER_JOIN_SYNTAX)
+        database = query._database
+        pk_subquery_ast = database._constructed_sql_cache.get(sql_key)
+        if pk_subquery_ast is None:
+            pk_subquery_ast = database._constructed_sql_cache[sql_key] = translator.construct_pk_subquery_ast()
+        return translator.expr_type, sql_key, pk_subquery_ast
+    def _construct_bulk_where(query, entity, pk_subquery_ast):
+        pk_columns = entity._pk_columns_
+        if len(pk_columns) == 1: return [ 'WHERE', [ 'IN', [ 'COLUMN', None, pk_columns[0] ], pk_subquery_ast ] ]
+        if query._database.provider.translator_cls.row_value_syntax:
+            return [ 'WHERE', [ 'IN', [ 'ROW' ] + [ [ 'COLUMN', None, column ] for column in pk_columns ],
+                                      pk_subquery_ast ] ]
+        table_name = entity._table_
+        criteria = [ [ 'EQ', [ 'COLUMN', 't', column ], [ 'COLUMN', table_name, column ] ] for column in pk_columns ]
+        return [ 'WHERE', [ 'EXISTS' ] + pk_subquery_ast[2:] + [ [ 'WHERE' ] + criteria ] ]
+    def _find_cached_objects(query, entity, sql_key, pk_subquery_ast):
+        # only objects which are already in the cache need to be found,
+        # so the matching rows are searched among their primary keys
+        index = query._cache.indexes.get(entity._pk_)
+        if not index: return []
+        objects = [ obj for obj in index.itervalues()
+                    if isinstance(obj, entity) and obj._status_ not in del_statuses ]
+        if not objects: return []
+        database = query._database
+        provider = database.provider
+        pk_columns = entity._pk_columns_
+        max_batch_size = provider.max_params_count // len(pk_columns)
+        result = []
+        for start in xrange(0, len(objects), max_batch_size):
+            batch = objects[start:start+max_batch_size]
+            batch_key = sql_key + ('CACHED', len(batch))
+            cached_sql = database._constructed_sql_cache.get(batch_key)
+            if cached_sql is None:
+                row_value_syntax = provider.translator_cls.row_value_syntax
+                criteria_list = construct_criteria_list('t', pk_columns, entity._pk_converters_,
+                                                        row_value_syntax, len(batch))
+                sql_ast = pk_subquery_ast + [ [ 'WHERE' ] + criteria_list ]
+                cached_sql = database._constructed_sql_cache[batch_key] = database._ast2sql(sql_ast)
+            sql, adapter = cached_sql
+            values = query._vars.copy()
+            values.update(enumerate(batch))
+            cursor = database._exec_sql(sql, adapter(values))
+            result.extend(entity._get_by_raw_pkval_(row) for row in cursor.fetchall())
+        return result
+    @cut_traceback
+    def update(query, **kwargs):
+        if not kwargs: throw(TypeError, 'At least one attribute value should be specified')
+        entity, sql_key, pk_subquery_ast = query._prepare_bulk_operation()
+        avdict = {}
+        for name, val in kwargs.iteritems():
+            attr = entity._adict_.get(name)
+            if attr is None: throw(TypeError, 'Unknown attribute %r' % name)
+            if attr.is_collection: throw(TypeError,
+                'Collection attribute %s cannot be updated in bulk' % attr)
+            if attr.pk_offset is not None: throw(TypeError,
+                'Primary key attribute %s cannot be updated in bulk' % attr)
+            avdict[attr] = attr.check(val, None, entity)
+        attrs = sorted(avdict, key=attrgetter('id'))
+        database = query._database
+        update_key = sql_key + ('UPDATE', tuple(attrs))
+        cached_sql = database._constructed_sql_cache.get(update_key)
+        if cached_sql is None:
+            pairs = []
+            for attr in attrs:
+                for column, converter in izip(attr.columns, attr.converters):
+                    pairs.append((column, [ 'PARAM', (UPDATE_PARAM, len(pairs)), converter ]))
+            where_list = query._construct_bulk_where(entity, pk_subquery_ast)
+            sql_ast = [ 'UPDATE', entity._table_, pairs, where_list ]
+            cached_sql = database._constructed_sql_cache[update_key] = database._ast2sql(sql_ast)
+        sql, adapter = cached_sql
+        objects = query._find_cached_objects(entity, sql_key, pk_subquery_ast)
+        values = query._vars.copy()
+        values[UPDATE_PARAM] = tuple(raw_val for attr in attrs for raw_val in attr.get_raw_values(avdict[attr]))
+        cursor = database._exec_sql(sql, adapter(values))
+        for obj in objects:
+            obj._rbits_ &= ~sum(obj._bits_[attr] for attr in attrs)
+            obj._db_set_(avdict.copy())
+        return cursor.rowcount
+    @cut_traceback
+    def delete(query, bulk=False):
+        if not bulk:
+            objects = query._fetch()
+            for obj in objects: obj.delete()
+            return len(objects)
+        entity = query._translator.expr_type
+        if isinstance(entity, EntityMeta):
+            for cls in [ entity ] + list(entity._subclasses_):
+                for attr in cls._attrs_:
+                    # rows which refer to deleted ones (link rows of many-to-many, children of one-to-many)
+                    # are deleted or updated by delete() of each object only
+                    if attr.reverse and (attr.is_collection or not attr.columns or attr.cascade_delete):
+                        throw(TypeError, 'Bulk delete cannot be used for %s, because of relationship attribute %s. '
+                                         'Use delete() without bulk=True' % (entity.__name__, attr))
+        entity, sql_key, pk_subquery_ast = query._prepare_bulk_operation()
+        database = query._database
+        delete_key = sql_key + ('DELETE',)
+        cached_sql = database._constructed_sql_cache.get(delete_key)
+        if cached_sql is None:
+            where_list = query._construct_bulk_where(entity, pk_subquery_ast)
+            sql_ast = [ 'DELETE', entity._table_, where_list ]
+            cached_sql = database._constructed_sql_cache[delete_key] = database._ast2sql(sql_ast)
+        sql, adapter = cached_sql
+        objects = query._find_cached_objects(entity, sql_key, pk_subquery_ast)
+        cursor = database._exec_sql(sql, adapter(query._vars))
+        cache = query._cache
+        for obj in objects:
+            cache._detach(obj)
+            obj._status_ = 'deleted'
+        return cursor.rowcount
 
 def strcut(s, width):
     if len(s) <= width:
@@ -4370,6 +5797,91 @@ def strcut(s, width):
     else:
         return s[:width-3] + '...'
 
+class PreparedQuery(object):
+    # the query is translated once per combination of parameter types,
+    # after that each call only evaluates parameters, executes SQL and builds objects
+    def __init__(prepared, entity, func):
+        names, argsname, keyargsname, defaults = inspect.getargspec(func)
+        if not names: throw(TypeError,
+            'Prepared query requires at least one parameter name, like %s.prepare(lambda %s, x: ...)'
+            % (entity.__name__, entity.__name__[0].lower()))
+        if argsname or keyargsname or defaults: throw(TypeError,
+            'Prepared query cannot have default values or *args and **kwargs parameters')
+        code = func.func_code
+        prepared.entity = entity
+        prepared.name = names[0]
+        prepared.params = tuple(names[1:])
+        prepared.func = func
+        key = get_code_key(code)
+        prepared.code_key = 'prepared', key
+        cond_expr, external_names = decompile(func, key)
+        if_expr = ast.GenExprIf(cond_expr)
+        for_expr = ast.GenExprFor(ast.AssName(prepared.name, 'OP_ASSIGN'), ast.Name('.0'), [ if_expr ])
+        prepared.tree = ast.GenExprInner(ast.Name(prepared.name), [ for_expr ])
+        extractors, varnames, tree = create_extractors(prepared.code_key, prepared.tree)
+        param_indexes = dict((name, i) for i, name in enumerate(prepared.params))
+        prepared.extractors = [ (src, param_indexes.get(src), code) for src, code in sorted(extractors.iteritems())
+                                                                     if src != '.0' ]
+        prepared.compiled = {}
+    def _get_locals(prepared, args):
+        func = prepared.func
+        locals = dict(izip(func.func_code.co_freevars, (cell.cell_contents for cell in func.func_closure or ())))
+        locals.update(izip(prepared.params, args))
+        return locals
+    def _extract_vars(prepared, args):
+        vars = { '.0' : prepared.entity }
+        vartypes = []
+        locals = None
+        is_oracle = prepared.entity._database_.provider.dialect == 'Oracle'
+        for src, i, code in prepared.extractors:
+            if i is not None: value = args[i]
+            else:
+                if locals is None: locals = prepared._get_locals(args)
+                try: value = eval(code, prepared.func.func_globals, locals)
+                except Exception, cause: raise ExprEvalError(src, cause)
+            if is_oracle and value == '': value = None
+            try: vartype = get_normalized_type_of(value)
+            except TypeError:
+                if isinstance(value, dict): throw(TypeError, 'Expression %s has unsupported type %r'
+                                                             % (src, type(value).__name__))
+                value = tuple(value)
+                vartype = get_normalized_type_of(value)
+            vars[src] = value
+            vartypes.append(vartype)
+        return vars, tuple(vartypes)
+    def _compile(prepared, args):
+        entity = prepared.entity
+        locals = prepared._get_locals(args)
+        locals['.0'] = entity
+        query = Query(prepared.code_key, prepared.tree, prepared.func.func_globals, locals)
+        translator = query._translator
+        sql_ast, attr_offsets = translator.construct_sql_ast()
+        sql, adapter = entity._database_.provider.ast2sql(sql_ast)
+        return sql, adapter, attr_offsets, translator.tableref.rbits, translator.col_names
+    @cut_traceback
+    def __call__(prepared, *args):
+        if len(args) != len(prepared.params): throw(TypeError, 'Prepared query takes exactly %d argument%s (%d given)'
+                                                    % (len(prepared.params), len(prepared.params) != 1 and 's' or '', len(args)))
+        entity = prepared.entity
+        database = entity._database_
+        vars, vartypes = prepared._extract_vars(args)
+        compiled = prepared.compiled.get(vartypes)
+        if compiled is None: compiled = prepared.compiled[vartypes] = prepared._compile(args)
+        sql, adapter, attr_offsets, rbits, col_names = compiled
+        cursor = database._exec_sql(sql, adapter(vars))
+        rows = entity._fetch_rows_(cursor)
+        t = time()
+        objects = entity._objects_from_fetched_rows_(rows, attr_offsets, rbits)
+        database._update_local_fetch_stat(sql, len(rows), time() - t)
+        return QueryResult(objects, entity, col_names)
+    @cut_traceback
+    def get(prepared, *args):
+        objects = prepared(*args)
+        if not objects: return None
+        if len(objects) > 1: throw(MultipleObjectsFoundError,
+            'Multiple objects were found. Use %s.select(...) to retrieve them' % prepared.entity.__name__)
+        return objects[0]
+
 class QueryResult(list):
     __slots__ = '_expr_type', '_col_names'
     def __init__(result, list, expr_type, col_names):
@@ -1,9 +1,11 @@
 from decimal import Decimal, InvalidOperation
 from datetime import datetime, date, time
 from uuid import uuid4, UUID
-import re
+from threading import Condition, Event, Thread
+from time import time as _time
+import re, weakref
 
-from pony.utils import is_utf8, decorator, throw, localbase
+from pony.utils import is_utf8, decorator, throw, localbase, LRUCache
 from pony.converting import str2date, str2datetime
 from pony.orm.ormtypes import LongStr, LongUnicode
 
@@ -36,6 +38,8 @@ class     InternalError(DatabaseError): pass
 class     ProgrammingError(DatabaseError): pass
 class     NotSupportedError(DatabaseError): pass
 
+class PoolTimeoutError(OperationalError): pass
+
 @decorator
 def wrap_dbapi_exceptions(func, provider, *args, **kwargs):
     dbapi_module = provider.dbapi_module
@@ -54,6 +58,10 @@ def wrap_dbapi_exceptions(func, provider, *args, **kwargs):
     except dbapi_module.Error, e: raise Error(e)
     except dbapi_module.Warning, e: raise Warning(e)
 
+def fetch_dicts(cursor):
+    names = [ column_info[0].lower() for column_info in cursor.description ]
+    return [ dict(zip(names, row)) for row in cursor.fetchall() ]
+
 def unexpected_args(attr, args):
     throw(TypeError,
         'Unexpected positional argument%s for attribute %s: %r'
@@ -77,6 +85,10 @@ class DBAPIProvider(object):
     index_if_not_exists_syntax = True
     max_time_precision = default_time_precision = 6
     select_for_update_nowait_syntax = True
+    multi_row_insert_syntax = True
+    executemany_rowcount = True
+    update_from_values_syntax = False
+    stream_blocks_connection = False
 
     dialect = None
     dbapi_module = None
@@ -91,6 +103,9 @@ class DBAPIProvider(object):
         pool_mockup = kwargs.pop('pony_pool_mockup', None)
         if pool_mockup: provider.pool = pool_mockup
         else: provider.pool = provider.get_pool(*args, **kwargs)
+        provider.statement_cache_size = getattr(provider.pool, 'statement_cache_size', None)
+        if provider.statement_cache_size is not None and provider.statement_cache_size < 1:
+            throw(ValueError, 'pony_statement_cache_size must be positive number')
         connection = provider.connect()
         provider.inspect_connection(connection)
         provider.release(connection)
@@ -195,6 +210,7 @@ class DBAPIProvider(object):
 
     @wrap_dbapi_exceptions
     def execute(provider, cursor, sql, arguments=None, returning_id=False):
+        if provider.statement_cache_size is not None: provider._register_statement(cursor.connection, sql)
         if type(arguments) is list:
             assert arguments and not returning_id
             cursor.executemany(sql, arguments)
@@ -203,6 +219,33 @@ class DBAPIProvider(object):
             else: cursor.execute(sql, arguments)
             if returning_id: return cursor.lastrowid
 
+    @wrap_dbapi_exceptions
+    def statement_cursor(provider, connection, sql):
+        return connection.cursor()
+
+    @wrap_dbapi_exceptions
+    def stream_cursor(provider, connection, chunk_size):
+        cursor = connection.cursor()
+        cursor.arraysize = chunk_size
+        return cursor
+
+    def explain(provider, connection, sql, arguments=None, analyze=False):
+        throw(NotImplementedError, 'EXPLAIN is not supported for %s' % provider.dialect)
+
+    def reserve_ids_sql(provider, table_name, column_name, count):
+        return None  # returns (sql, arguments) of query which allocates count new values of auto pk column
+
+    def _register_statement(provider, connection, sql):
+        # the driver keeps its own LRU cache of prepared statements with the same size,
+        # so this cache only mirrors it in order to count hits and misses. The counts are estimates:
+        # the driver does not report its own hits, and it may evict statements on its own
+        statement_cache = provider.pool.get_statement_cache(connection)
+        if statement_cache.get(sql) is None: statement_cache[sql] = True
+
+    def get_statement_cache_stats(provider):
+        if provider.statement_cache_size is None: return None
+        return provider.pool.get_statement_cache_stats()
+
     converter_classes = []
 
     def _get_converter_type_by_py_type(provider, py_type):
@@ -221,7 +264,7 @@ class DBAPIProvider(object):
         return converter_cls(py_type, attr)
 
     def get_pool(provider, *args, **kwargs):
-        return Pool(provider.dbapi_module, *args, **kwargs)
+        return ConnectionPool(provider.dbapi_module, *args, **kwargs)
 
     def set_transaction_mode(provider, connection, optimistic):
         pass
@@ -256,16 +299,34 @@ class DBAPIProvider(object):
         sql = 'DROP TABLE %s' % table_name
         cursor.execute(sql)
 
+def merge_statement_cache_stats(maxsize, statement_caches, stats=None):
+    result = dict(connections=len(statement_caches), maxsize=maxsize, size=0, hits=0, misses=0, evictions=0)
+    for statement_cache in statement_caches:
+        stats2 = statement_cache.get_stats()
+        for key in 'size', 'hits', 'misses', 'evictions': result[key] += stats2[key]
+    if stats is not None:
+        for key in 'hits', 'misses', 'evictions': result[key] += stats[key]
+    return result
+
 class Pool(localbase):
     def __init__(pool, dbapi_module, *args, **kwargs): # called separately in each thread
+        pool.statement_cache_size = kwargs.pop('pony_statement_cache_size', None)
         pool.dbapi_module = dbapi_module
         pool.args = args
         pool.kwargs = kwargs
         pool.con = None
+        pool.statement_cache = None
     def connect(pool):
         if pool.con is None:
             pool.con = pool.dbapi_module.connect(*pool.args, **pool.kwargs)
         return pool.con
+    def get_statement_cache(pool, con):
+        assert con is pool.con
+        if pool.statement_cache is None: pool.statement_cache = LRUCache(pool.statement_cache_size)
+        return pool.statement_cache
+    def get_statement_cache_stats(pool):  # only connection of the current thread is taken into account
+        statement_caches = [ pool.statement_cache ] if pool.statement_cache is not None else []
+        return merge_statement_cache_stats(pool.statement_cache_size, statement_caches)
     def release(pool, con):
         assert con is pool.con
         try: con.rollback()
@@ -274,13 +335,255 @@ class Pool(localbase):
             raise
     def drop(pool, con):
         assert con is pool.con
-        pool.con = None
+        pool.con = pool.statement_cache = None
         con.close()
     def disconnect(pool):
         con = pool.con
-        pool.con = None
+        pool.con = pool.statement_cache = None
         if con is not None: con.close()
 
+class ConnectionPool(object):
+    def __init__(pool, dbapi_module, *args, **kwargs): # shared between all threads
+        pool.min_size = kwargs.pop('pony_pool_min_size', 0)
+        pool.max_size = kwargs.pop('pony_pool_max_size', 20)
+        pool.timeout = kwargs.pop('pony_pool_timeout', None)
+        pool.max_idle_time = kwargs.pop('pony_pool_max_idle_time', None)
+        pool.max_lifetime = kwargs.pop('pony_pool_max_lifetime', None)
+        pool.pre_ping = kwargs.pop('pony_pool_pre_ping', None)
+        validation_interval = kwargs.pop('pony_pool_validation_interval', None)
+        pool.statement_cache_size = kwargs.pop('pony_statement_cache_size', None)
+        if pool.max_size < 1: throw(ValueError, 'pony_pool_max_size must be positive number')
+        if not 0 <= pool.min_size <= pool.max_size: throw(ValueError,
+            'pony_pool_min_size must be in range 0..%d' % pool.max_size)
+        pool.dbapi_module = dbapi_module
+        pool.args = args
+        pool.kwargs = kwargs
+        pool.lock = Condition()
+        pool.free = []  # list of (connection, release time) pairs, most recently released last
+        pool.created_at = {}  # connection -> creation time
+        pool.statement_caches = {}  # connection -> LRU cache of statements prepared on it
+        pool.closed_statement_stats = dict(hits=0, misses=0, evictions=0)
+        pool.size = 0  # number of open connections, both idle and checked out
+        pool.connects = pool.checkouts = pool.waits = pool.timeouts = 0
+        pool.wait_time = 0.0
+        pool.idle_evictions = pool.lifetime_evictions = pool.drops = 0
+        pool.pings = pool.ping_failures = 0
+        pool.validation_thread = None
+        if validation_interval: pool.start_validation(validation_interval)
+    ping_sql = 'SELECT 1'
+    def _connect(pool):
+        return pool.dbapi_module.connect(*pool.args, **pool.kwargs)
+    def _reset(pool, con):
+        con.rollback()
+    def _close(pool, con):  # must be called without lock
+        pool.created_at.pop(con, None)
+        statement_cache = pool.statement_caches.pop(con, None)
+        if statement_cache is not None:
+            stats = statement_cache.get_stats()
+            closed_stats = pool.closed_statement_stats
+            pool.lock.acquire()
+            try:
+                for key in closed_stats: closed_stats[key] += stats[key]
+            finally: pool.lock.release()
+        try: con.close()
+        except pool.dbapi_module.Error: pass
+    def _is_expired(pool, con, now):
+        max_lifetime = pool.max_lifetime
+        return max_lifetime is not None and now - pool.created_at.get(con, now) > max_lifetime
+    def _pop_stale(pool, now):  # must be called with lock acquired
+        stale = []
+        free = pool.free
+        max_idle_time = pool.max_idle_time
+        if max_idle_time is not None:
+            while free and pool.size - len(stale) > pool.min_size and now - free[0][1] > max_idle_time:
+                stale.append(free.pop(0)[0])
+                pool.idle_evictions += 1
+        if pool.max_lifetime is not None:
+            for con, released in free[:]:
+                if pool._is_expired(con, now):
+                    free.remove((con, released))
+                    stale.append(con)
+                    pool.lifetime_evictions += 1
+        pool.size -= len(stale)
+        return stale
+    def connect(pool):
+        pre_ping = pool.pre_ping
+        while True:
+            con, released = pool._acquire()
+            if con is None: return pool._create()
+            if pre_ping is None or _time() - released < pre_ping or pool._validate(con): return con
+    def _acquire(pool):
+        lock = pool.lock
+        timeout = pool.timeout
+        start = deadline = None
+        stale = []
+        lock.acquire()
+        try:
+            while True:
+                now = _time()
+                stale.extend(pool._pop_stale(now))
+                if pool.free:
+                    pool.checkouts += 1
+                    return pool.free.pop()
+                if pool.size < pool.max_size:
+                    pool.size += 1
+                    return None, None
+                if start is None:
+                    pool.waits += 1
+                    start = now
+                    if timeout is not None: deadline = now + timeout
+                if deadline is None: lock.wait()
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        pool.timeouts += 1
+                        throw(PoolTimeoutError, None, 'Cannot get connection from pool in %s seconds '
+                                                      '(all %d connections are in use)' % (timeout, pool.max_size))
+                    lock.wait(remaining)
+        finally:
+            if start is not None: pool.wait_time += _time() - start
+            lock.release()
+            for con in stale: pool._close(con)
+    def _create(pool):  # a slot for the new connection is already reserved by _acquire()
+        lock = pool.lock
+        try: con = pool._connect()
+        except:
+            lock.acquire()
+            try:
+                pool.size -= 1
+                lock.notify()
+            finally: lock.release()
+            raise
+        lock.acquire()
+        try:
+            pool.created_at[con] = _time()
+            pool.connects += 1
+            pool.checkouts += 1
+        finally: lock.release()
+        return con
+    def _ping(pool, con):
+        cursor = con.cursor()
+        cursor.execute(pool.ping_sql)
+        cursor.fetchone()
+        cursor.close()
+        con.rollback()
+    def _validate(pool, con):  # connection must not be in the free list
+        try: pool._ping(con)
+        except Exception:
+            lock = pool.lock
+            lock.acquire()
+            try:
+                pool.pings += 1
+                pool.ping_failures += 1
+                pool.size -= 1
+                lock.notify()
+            finally: lock.release()
+            pool._close(con)
+            return False
+        pool.pings += 1
+        return True
+    def validate_idle(pool, min_idle_time=0):
+        lock = pool.lock
+        lock.acquire()
+        try:
+            now = _time()
+            stale = pool._pop_stale(now)
+            candidates = [ item for item in pool.free if now - item[1] >= min_idle_time ]
+            for item in candidates: pool.free.remove(item)
+        finally: lock.release()
+        for con in stale: pool._close(con)
+        validated = [ (con, released) for con, released in candidates if pool._validate(con) ]
+        if validated:
+            lock.acquire()
+            try:
+                pool.free[:0] = validated
+                lock.notify_all()
+            finally: lock.release()
+        return len(candidates) - len(validated)
+    def start_validation(pool, interval):
+        if pool.validation_thread is not None: throw(TypeError, 'Validation of idle connections is already started')
+        stop_event = Event()
+        pool_ref = weakref.ref(pool)
+        def validation_loop():
+            while True:
+                stop_event.wait(interval)  # returns None before Python 2.7
+                if stop_event.isSet(): break
+                pool = pool_ref()
+                if pool is None: break
+                try: pool.validate_idle(interval)
+                except Exception: pass
+                del pool
+        thread = Thread(target=validation_loop, name='PonyPoolValidation')
+        thread.setDaemon(True)
+        thread.stop_event = stop_event
+        pool.validation_thread = thread
+        thread.start()
+    def stop_validation(pool):
+        thread = pool.validation_thread
+        if thread is None: return
+        pool.validation_thread = None
+        thread.stop_event.set()
+    def release(pool, con):
+        try: pool._reset(con)
+        except:
+            pool.drop(con)
+            raise
+        now = _time()
+        lock = pool.lock
+        lock.acquire()
+        try:
+            expired = pool._is_expired(con, now)
+            if expired:
+                pool.size -= 1
+                pool.lifetime_evictions += 1
+            else: pool.free.append((con, now))
+            lock.notify()
+        finally: lock.release()
+        if expired: pool._close(con)
+    def drop(pool, con):
+        lock = pool.lock
+        lock.acquire()
+        try:
+            pool.size -= 1
+            pool.drops += 1
+            lock.notify()
+        finally: lock.release()
+        pool._close(con)
+    def disconnect(pool):
+        lock = pool.lock
+        lock.acquire()
+        try:
+            free = pool.free
+            pool.free = []
+            pool.size -= len(free)
+            lock.notify_all()
+        finally: lock.release()
+        for con, released in free: pool._close(con)
+    def _create_statement_cache(pool, con):
+        return LRUCache(pool.statement_cache_size)
+    def get_statement_cache(pool, con):  # connection is used by a single thread, so there is no race
+        statement_cache = pool.statement_caches.get(con)
+        if statement_cache is None:
+            statement_cache = pool.statement_caches[con] = pool._create_statement_cache(con)
+        return statement_cache
+    def get_statement_cache_stats(pool):
+        lock = pool.lock
+        lock.acquire()
+        try:
+            statement_caches = pool.statement_caches.values()
+            stats = pool.closed_statement_stats.copy()
+        finally: lock.release()
+        return merge_statement_cache_stats(pool.statement_cache_size, statement_caches, stats)
+    def get_stats(pool):
+        lock = pool.lock
+        lock.acquire()
+        try: return dict(size=pool.size, idle=len(pool.free), in_use=pool.size - len(pool.free),
+                         max_size=pool.max_size, connects=pool.connects, checkouts=pool.checkouts,
+                         waits=pool.waits, wait_time=pool.wait_time, timeouts=pool.timeouts,
+                         idle_evictions=pool.idle_evictions, lifetime_evictions=pool.lifetime_evictions,
+                         drops=pool.drops, pings=pool.pings, ping_failures=pool.ping_failures)
+        finally: lock.release()
+
 class Converter(object):
     def __deepcopy__(converter, memo):
         return converter  # Converter instances are "immutable"
@@ -7,11 +7,12 @@ warnings.filterwarnings('ignore', '^Table.+already exists$', Warning, '^pony\\.o
 
 import MySQLdb
 import MySQLdb.converters
+import MySQLdb.cursors
 from MySQLdb.constants import FIELD_TYPE, FLAG, CLIENT
 
 from pony.orm import core, dbschema, dbapiprovider
 from pony.orm.core import log_orm, log_sql, OperationalError
-from pony.orm.dbapiprovider import DBAPIProvider, Pool, get_version_tuple
+from pony.orm.dbapiprovider import DBAPIProvider, ConnectionPool, get_version_tuple, wrap_dbapi_exceptions, fetch_dicts
 from pony.orm.sqltranslation import SQLTranslator
 from pony.orm.sqlbuilding import SQLBuilder, join
 from pony.utils import throw
@@ -81,6 +82,10 @@ class MySQLUuidConverter(dbapiprovider.UuidConverter):
     def sql_type(converter):
         return 'BINARY(16)'
 
+class MySQLPool(ConnectionPool):
+    def _ping(pool, con):
+        con.ping()
+
 class MySQLProvider(DBAPIProvider):
     dialect = 'MySQL'
     paramstyle = 'format'
@@ -90,6 +95,8 @@ class MySQLProvider(DBAPIProvider):
     index_if_not_exists_syntax = False
     select_for_update_nowait_syntax = False
     max_time_precision = default_time_precision = 0
+    executemany_rowcount = False  # MySQLdb executes UPDATE rows one by one and keeps rowcount of the last one
+    stream_blocks_connection = True  # see stream_cursor()
 
     dbapi_module = MySQLdb
     dbschema_cls = MySQLSchema
@@ -125,6 +132,9 @@ class MySQLProvider(DBAPIProvider):
         return isinstance(exc, MySQLdb.OperationalError) and exc.args[0] == 2006
 
     def get_pool(provider, *args, **kwargs):
+        # MySQLdb has no server-side prepared statements, and emulation by PREPARE and EXECUTE USING @var
+        # takes an extra round trip per query, so the statement cache is not supported for MySQL
+        kwargs.pop('pony_statement_cache_size', None)
         if 'conv' not in kwargs:
             conv = MySQLdb.converters.conversions.copy()
             conv[FIELD_TYPE.BLOB] = [(FLAG.BINARY, buffer)]
@@ -135,7 +145,23 @@ class MySQLProvider(DBAPIProvider):
         if 'charset' not in kwargs:
             kwargs['charset'] = 'utf8'
         kwargs['client_flag'] = kwargs.get('client_flag', 0) | CLIENT.FOUND_ROWS 
-        return Pool(MySQLdb, *args, **kwargs)
+        return MySQLPool(MySQLdb, *args, **kwargs)
+
+    @wrap_dbapi_exceptions
+    def stream_cursor(provider, connection, chunk_size):
+        # unbuffered result of SSCursor occupies the connection until all rows are fetched, and any other
+        # statement fails with 'Commands out of sync' error. So the code which consumes the stream
+        # must not query the database: no prefetch, lazy loading of attributes or flush of changes
+        return connection.cursor(MySQLdb.cursors.SSCursor)
+
+    @wrap_dbapi_exceptions
+    def explain(provider, connection, sql, arguments=None, analyze=False):
+        # EXPLAIN ANALYZE is available since MySQL 8.0.18 and returns the plan as a text tree
+        cursor = connection.cursor()
+        sql = (analyze and 'EXPLAIN ANALYZE ' or 'EXPLAIN ') + sql
+        if arguments is None: cursor.execute(sql)
+        else: cursor.execute(sql, arguments)
+        return fetch_dicts(cursor)
 
     def table_exists(provider, connection, table_name):
         db_name, table_name = provider.split_table_name(table_name)
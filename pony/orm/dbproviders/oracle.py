@@ -1,7 +1,9 @@
-import os
+import os, re
 os.environ["NLS_LANG"] = "AMERICAN_AMERICA.UTF8"
 
 from types import NoneType
+from itertools import count
+from threading import Lock
 from datetime import date, datetime
 from decimal import Decimal
 from uuid import UUID
@@ -11,8 +13,10 @@ import cx_Oracle
 from pony.orm import core, sqlbuilding, dbapiprovider, sqltranslation
 from pony.orm.core import log_orm, log_sql, DatabaseError
 from pony.orm.dbschema import DBSchema, DBObject, Table, Column
-from pony.orm.dbapiprovider import DBAPIProvider, wrap_dbapi_exceptions, get_version_tuple
-from pony.utils import throw
+from pony.orm.dbapiprovider import (
+    DBAPIProvider, wrap_dbapi_exceptions, get_version_tuple, fetch_dicts, merge_statement_cache_stats
+    )
+from pony.utils import throw, LRUCache
 
 class OraTable(Table):
     def get_objects_to_create(table, created_tables=None):
@@ -229,6 +233,7 @@ class OraProvider(DBAPIProvider):
     max_name_len = 30
     table_if_not_exists_syntax = False
     index_if_not_exists_syntax = False
+    multi_row_insert_syntax = False
 
     dbapi_module = cx_Oracle
     dbschema_cls = OraSchema
@@ -269,8 +274,16 @@ class OraProvider(DBAPIProvider):
     def normalize_name(provider, name):
         return name[:provider.max_name_len].upper()
 
+    @wrap_dbapi_exceptions
+    def statement_cursor(provider, connection, sql):
+        # cursor which executes the same statement again skips even the lookup in the statement cache.
+        # Only DML cursors are reused, because rows of a SELECT may be still fetched by the caller
+        if provider.statement_cache_size is None or not dml_re.match(sql): return connection.cursor()
+        return provider.pool.get_statement_cursor(connection, sql)
+
     @wrap_dbapi_exceptions
     def execute(provider, cursor, sql, arguments=None, returning_id=False):
+        if provider.statement_cache_size is not None: provider._register_statement(cursor.connection, sql)
         if type(arguments) is list:
             assert arguments and not returning_id
             set_input_sizes(cursor, arguments[0])
@@ -286,6 +299,23 @@ class OraProvider(DBAPIProvider):
             if arguments is None: cursor.execute(sql)
             else: cursor.execute(sql, arguments)
 
+    explain_counter = count(1)
+
+    @wrap_dbapi_exceptions
+    def explain(provider, connection, sql, arguments=None, analyze=False):
+        if analyze: throw(NotImplementedError, 'EXPLAIN PLAN of Oracle does not execute the statement')
+        statement_id = 'pony_%d' % next(provider.explain_counter)
+        cursor = connection.cursor()
+        sql = "EXPLAIN PLAN SET STATEMENT_ID = '%s' FOR %s" % (statement_id, sql)
+        if arguments is None: cursor.execute(sql)
+        else: cursor.execute(sql, arguments)
+        cursor.execute('SELECT id, parent_id, depth, operation, options, object_owner, object_name, '
+                       'cost, cardinality, bytes, access_predicates, filter_predicates '
+                       'FROM plan_table WHERE statement_id = :s ORDER BY id', dict(s=statement_id))
+        plan = fetch_dicts(cursor)
+        cursor.execute('DELETE FROM plan_table WHERE statement_id = :s', dict(s=statement_id))
+        return plan
+
     def get_pool(provider, *args, **kwargs):
         user = password = dsn = None
         if len(args) == 1:
@@ -308,7 +338,8 @@ class OraProvider(DBAPIProvider):
         kwargs.setdefault('min', 1)
         kwargs.setdefault('max', 10)
         kwargs.setdefault('increment', 1)
-        return OraPool(**kwargs)
+        statement_cache_size = kwargs.pop('pony_statement_cache_size', None)
+        return OraPool(statement_cache_size, **kwargs)
 
     def table_exists(provider, connection, table_name):
         owner_name, table_name = provider.split_table_name(table_name)
@@ -368,19 +399,56 @@ def output_type_handler(cursor, name, defaultType, size, precision, scale):
         return cursor.var(unicode, size, cursor.arraysize)  # from cx_Oracle example
     return None
 
+dml_re = re.compile(r'\s*(?:insert|update|delete)\b', re.IGNORECASE)
+
 class OraPool(object):
-    def __init__(pool, **kwargs):
+    def __init__(pool, statement_cache_size=None, **kwargs):
         pool._pool = cx_Oracle.SessionPool(**kwargs)
+        pool.statement_cache_size = statement_cache_size
+        pool.statement_caches = {}  # connection -> LRU cache which mirrors statement cache of cx_Oracle
+        pool.statement_cursors = {}  # connection -> LRU cache of DML cursors
+        pool.closed_statement_stats = dict(hits=0, misses=0, evictions=0)
+        pool.lock = Lock()
     def connect(pool):
         con = pool._pool.acquire()
         con.outputtypehandler = output_type_handler
+        if pool.statement_cache_size is not None: con.stmtcachesize = pool.statement_cache_size
         return con
     def release(pool, con):
         pool._pool.release(con)
     def drop(pool, con):
+        pool.statement_cursors.pop(con, None)
+        statement_cache = pool.statement_caches.pop(con, None)
+        if statement_cache is not None:
+            stats = statement_cache.get_stats()
+            closed_stats = pool.closed_statement_stats
+            pool.lock.acquire()
+            try:
+                for key in closed_stats: closed_stats[key] += stats[key]
+            finally: pool.lock.release()
         pool._pool.drop(con)
     def disconnect(pool):
         pass
+    def get_statement_cache(pool, con):
+        statement_cache = pool.statement_caches.get(con)
+        if statement_cache is None:
+            statement_cache = pool.statement_caches[con] = LRUCache(pool.statement_cache_size)
+        return statement_cache
+    def get_statement_cursor(pool, con, sql):
+        cursors = pool.statement_cursors.get(con)
+        if cursors is None:
+            cursors = pool.statement_cursors[con] = LRUCache(pool.statement_cache_size,
+                                                             on_evict=lambda sql, cursor: cursor.close())
+        cursor = cursors.get(sql)
+        if cursor is None: cursor = cursors[sql] = con.cursor()
+        return cursor
+    def get_statement_cache_stats(pool):
+        pool.lock.acquire()
+        try:
+            statement_caches = pool.statement_caches.values()
+            stats = pool.closed_statement_stats.copy()
+        finally: pool.lock.release()
+        return merge_statement_cache_stats(pool.statement_cache_size, statement_caches, stats)
 
 def get_inputsize(arg):
     if isinstance(arg, datetime):
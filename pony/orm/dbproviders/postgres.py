@@ -1,6 +1,8 @@
 from decimal import Decimal
 from datetime import datetime, date
 from uuid import UUID
+from itertools import count
+import re, json
 
 import psycopg2
 from psycopg2 import extensions
@@ -9,10 +11,10 @@ import psycopg2.extras
 psycopg2.extras.register_uuid()
 
 from pony.orm import core, dbschema, sqlbuilding, dbapiprovider
-from pony.orm.dbapiprovider import DBAPIProvider, Pool, ProgrammingError, wrap_dbapi_exceptions
+from pony.orm.dbapiprovider import DBAPIProvider, ConnectionPool, ProgrammingError, wrap_dbapi_exceptions
 from pony.orm.sqltranslation import SQLTranslator
 from pony.orm.sqlbuilding import Value
-from pony.utils import throw
+from pony.utils import throw, LRUCache
 
 class PGColumn(dbschema.Column):
     auto_template = 'SERIAL PRIMARY KEY'
@@ -81,29 +83,35 @@ class PGUuidConverter(dbapiprovider.UuidConverter):
     def py2sql(converter, val):
         return val
 
-class PGPool(Pool):
-    def connect(pool):
-        if pool.con is None:
-            pool.con = pool.dbapi_module.connect(*pool.args, **pool.kwargs)
-            if 'client_encoding' not in pool.kwargs:
-                pool.con.set_client_encoding('UTF8')
-        return pool.con
-    def release(pool, con):
-        assert con is pool.con
-        try:
-            con.rollback()
-            con.autocommit = True
-            cursor = con.cursor()
-            cursor.execute('DISCARD ALL')
-        except:
-            pool.drop(con)
-            raise
+class PGPool(ConnectionPool):
+    def _connect(pool):
+        con = pool.dbapi_module.connect(*pool.args, **pool.kwargs)
+        if 'client_encoding' not in pool.kwargs:
+            con.set_client_encoding('UTF8')
+        return con
+    def _reset(pool, con):
+        con.rollback()
+        con.autocommit = True
+        cursor = con.cursor()
+        if pool.statement_cache_size is None: cursor.execute('DISCARD ALL')
+        else:  # the same as DISCARD ALL, but prepared statements are kept
+            cursor.execute('CLOSE ALL; SET SESSION AUTHORIZATION DEFAULT; RESET ALL; UNLISTEN *; '
+                           'SELECT pg_advisory_unlock_all(); DISCARD TEMP')
+    def _create_statement_cache(pool, con):
+        def deallocate(sql, statement):
+            name, execute_sql = statement
+            con.cursor().execute('DEALLOCATE ' + name)
+        return LRUCache(pool.statement_cache_size, on_evict=deallocate)
+
+prepare_re = re.compile(r'\s*(?:select|insert|update|delete)\b', re.IGNORECASE)
+param_re = re.compile(r'%\((\w+)\)s|%%')
 
 class PGProvider(DBAPIProvider):
     dialect = 'PostgreSQL'
     paramstyle = 'pyformat'
     max_name_len = 63
     index_if_not_exists_syntax = False
+    update_from_values_syntax = True  # executemany() of psycopg2 takes a round trip per row
 
     dbapi_module = psycopg2
     dbschema_cls = PGSchema
@@ -145,10 +153,66 @@ class PGProvider(DBAPIProvider):
             assert arguments and not returning_id
             cursor.executemany(sql, arguments)
         else:
+            if provider.statement_cache_size is not None and cursor.name is None and prepare_re.match(sql):
+                sql = provider._prepare(cursor, sql, arguments is not None)
             if arguments is None: cursor.execute(sql)
             else: cursor.execute(sql, arguments)
             if returning_id: return cursor.fetchone()[0]
 
+    prepared_statement_counter = count(1)
+
+    def _prepare(provider, cursor, sql, has_arguments):
+        # returns EXECUTE statement for the server-side prepared statement of the current connection
+        statement_cache = provider.pool.get_statement_cache(cursor.connection)
+        statement = statement_cache.get(sql)
+        if statement is not None: return statement[1]
+        name = 'pony_%d' % next(provider.prepared_statement_counter)
+        params = []
+        def replace(match):
+            param = match.group(1)
+            if param is None: return '%'
+            if param not in params: params.append(param)
+            return '$%d' % (params.index(param) + 1)
+        cursor.execute('PREPARE %s AS %s' % (name, param_re.sub(replace, sql) if has_arguments else sql))
+        if not params: execute_sql = 'EXECUTE ' + name
+        else: execute_sql = 'EXECUTE %s(%s)' % (name, ', '.join('%%(%s)s' % param for param in params))
+        statement_cache[sql] = name, execute_sql
+        return execute_sql
+
+    def reserve_ids_sql(provider, table_name, column_name, count):
+        # ids are taken from the sequence of SERIAL column before the multi-row INSERT,
+        # because rows of INSERT ... RETURNING are not guaranteed to come in the order of VALUES
+        return ('SELECT nextval(pg_get_serial_sequence(%(table)s, %(column)s)) FROM generate_series(1, %(count)s)',
+                dict(table=provider.quote_name(table_name), column=column_name, count=count))
+
+    stream_cursor_counter = count(1)
+
+    @wrap_dbapi_exceptions
+    def stream_cursor(provider, connection, chunk_size):
+        name = 'pony_stream_%d' % next(provider.stream_cursor_counter)
+        # in autocommit mode named cursor must outlive the transaction of DECLARE statement
+        cursor = connection.cursor(name, withhold=connection.autocommit)
+        cursor.itersize = chunk_size
+        return cursor
+
+    @wrap_dbapi_exceptions
+    def explain(provider, connection, sql, arguments=None, analyze=False):
+        cursor = connection.cursor()
+        sql = 'EXPLAIN (FORMAT JSON%s) %s' % (analyze and ', ANALYZE' or '', sql)
+        # failed statement aborts the whole transaction, so EXPLAIN is isolated by savepoint
+        use_savepoint = not connection.autocommit
+        if use_savepoint: cursor.execute('SAVEPOINT pony_explain')
+        try:
+            if arguments is None: cursor.execute(sql)
+            else: cursor.execute(sql, arguments)
+            plan = cursor.fetchone()[0]
+        except:
+            if use_savepoint: cursor.execute('ROLLBACK TO SAVEPOINT pony_explain')
+            raise
+        if use_savepoint: cursor.execute('RELEASE SAVEPOINT pony_explain')
+        if isinstance(plan, basestring): plan = json.loads(plan)  # json type is not registered for old servers
+        return plan[0]
+
     def table_exists(provider, connection, table_name):
         schema_name, table_name = provider.split_table_name(table_name)
         cursor = connection.cursor()
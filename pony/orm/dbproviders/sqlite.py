@@ -8,7 +8,7 @@ from uuid import UUID
 
 from pony.orm import dbschema, sqltranslation, dbapiprovider
 from pony.orm.sqlbuilding import SQLBuilder, join
-from pony.orm.dbapiprovider import DBAPIProvider, Pool
+from pony.orm.dbapiprovider import DBAPIProvider, Pool, wrap_dbapi_exceptions, fetch_dicts
 from pony.utils import localbase, datetime2timestamp, timestamp2datetime, decorator, absolutize_path, throw
 
 class SQLiteForeignKey(dbschema.ForeignKey):
@@ -106,6 +106,7 @@ class SQLiteProvider(DBAPIProvider):
     name_before_table = 'db_name'
 
     server_version = sqlite.sqlite_version_info
+    multi_row_insert_syntax = server_version >= (3, 7, 11)
 
     converter_classes = [
         (bool, dbapiprovider.BoolConverter),
@@ -120,7 +121,7 @@ class SQLiteProvider(DBAPIProvider):
         (UUID, dbapiprovider.UuidConverter),
     ]
 
-    def get_pool(provider, filename, create_db=False):
+    def get_pool(provider, filename, create_db=False, pony_statement_cache_size=None):
         if filename != ':memory:':
             # When relative filename is specified, it is considered
             # not relative to cwd, but to user module where
@@ -134,7 +135,15 @@ class SQLiteProvider(DBAPIProvider):
             # 1 - pony.dbapiprovider.DBAPIProvider.__init__()
             # 0 - pony.dbproviders.sqlite.get_pool()
             filename = absolutize_path(filename, frame_depth=5)
-        return SQLitePool(filename, create_db)
+        return SQLitePool(filename, create_db, pony_statement_cache_size)
+
+    @wrap_dbapi_exceptions
+    def explain(provider, connection, sql, arguments=None, analyze=False):
+        if analyze: throw(NotImplementedError, 'SQLite does not support EXPLAIN ANALYZE')
+        cursor = connection.cursor()
+        if arguments is None: cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        else: cursor.execute('EXPLAIN QUERY PLAN ' + sql, arguments)
+        return fetch_dicts(cursor)
 
     def table_exists(provider, connection, table_name):
         return provider._exists(connection, table_name)
@@ -182,17 +191,19 @@ def _text_factory(s):
     return s.decode('utf8', 'replace')
 
 class SQLitePool(Pool):
-    def __init__(pool, filename, create_db): # called separately in each thread
+    def __init__(pool, filename, create_db, statement_cache_size=None): # called separately in each thread
         pool.filename = filename
         pool.create_db = create_db
-        pool.con = None
+        pool.statement_cache_size = statement_cache_size
+        pool.con = pool.statement_cache = None
     def connect(pool):
         con = pool.con
         if con is not None: return con
         filename = pool.filename
         if filename != ':memory:' and not pool.create_db and not os.path.exists(filename):
             throw(IOError, "Database file is not found: %r" % filename)
-        pool.con = con = sqlite.connect(filename)
+        if pool.statement_cache_size is None: pool.con = con = sqlite.connect(filename)
+        else: pool.con = con = sqlite.connect(filename, cached_statements=pool.statement_cache_size)
         con.text_factory = _text_factory
         con.create_function('power', 2, pow)
         con.create_function('rand', 0, random)
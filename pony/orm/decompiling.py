@@ -3,25 +3,41 @@ from compiler import ast
 from opcode import opname as opnames, HAVE_ARGUMENT, EXTENDED_ARG, cmp_op
 from opcode import hasconst, hasname, hasjrel, haslocal, hascompare, hasfree
 
-from pony.utils import throw
+from pony import options
+from pony.utils import throw, LRUCache
 
 ##ast.And.__repr__ = lambda self: "And(%s: %s)" % (getattr(self, 'endpos', '?'), repr(self.nodes),)
 ##ast.Or.__repr__ = lambda self: "Or(%s: %s)" % (getattr(self, 'endpos', '?'), repr(self.nodes),)
 
-ast_cache = {}
+ast_cache = LRUCache(options.DECOMPILER_CACHE_SIZE)
 
-codeobjects = {}
-
-def decompile(x):
+def get_codeobject(x):
     t = type(x)
-    if t is types.CodeType: codeobject = x
-    elif t is types.GeneratorType: codeobject = x.gi_frame.f_code
-    elif t is types.FunctionType: codeobject = x.func_code
-    else: throw(TypeError)
-    key = id(codeobject)
+    if t is types.CodeType: return x
+    elif t is types.GeneratorType: return x.gi_frame.f_code
+    elif t is types.FunctionType: return x.func_code
+    throw(TypeError)
+
+def get_code_key(codeobject):
+    # id(codeobject) cannot be used as a key, because ids of garbage collected code objects are reused
+    return (codeobject.co_code, consts_key(codeobject.co_consts), codeobject.co_names,
+            codeobject.co_varnames, codeobject.co_freevars, codeobject.co_cellvars)
+
+def consts_key(consts):
+    # type is part of the key, because 1 == 1.0 == True, but these constants give different queries
+    result = []
+    for const in consts:
+        t = type(const)
+        if t is types.CodeType: result.append(get_code_key(const))
+        elif t is tuple: result.append((t, consts_key(const)))
+        else: result.append((t, const))
+    return tuple(result)
+
+def decompile(x, key=None):
+    codeobject = get_codeobject(x)
+    if key is None: key = get_code_key(codeobject)
     result = ast_cache.get(key)
     if result is None:
-        codeobjects[key] = codeobject
         decompiler = Decompiler(codeobject)
         result = decompiler.ast, decompiler.external_names
         ast_cache[key] = result
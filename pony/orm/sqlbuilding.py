@@ -1,4 +1,5 @@
 from operator import attrgetter
+from itertools import izip
 from decimal import Decimal
 from datetime import date, datetime
 from binascii import hexlify
@@ -190,13 +191,32 @@ class SQLBuilder(object):
         return [ 'INSERT INTO ', builder.quote_name(table_name), ' (',
                  join(', ', [builder.quote_name(column) for column in columns ]),
                  ') VALUES (', join(', ', [builder(value) for value in values]), ')' ]
+    def INSERT_MANY(builder, table_name, columns, rows):
+        return [ 'INSERT INTO ', builder.quote_name(table_name), ' (',
+                 join(', ', [builder.quote_name(column) for column in columns ]),
+                 ') VALUES ', join(', ', [ ('(', join(', ', [builder(value) for value in row]), ')') for row in rows ]) ]
+    def UPDATE_MANY(builder, table_name, update_columns, key_columns, null_columns, rows, sql_types):
+        # columns of VALUES are named column1, column2 etc. Types of the first row are explicit,
+        # because otherwise the database infers column types from values of the first row
+        quote_name = builder.quote_name
+        table, alias = quote_name(table_name), quote_name('v')
+        value = lambda i: '%s.%s' % (alias, quote_name('column%d' % (i + 1)))
+        first_row = [ ('CAST(', builder(param), ' AS ', sql_type, ')') for param, sql_type in izip(rows[0], sql_types) ]
+        values = [ ('(', join(', ', first_row), ')') ] + [ builder.ROW(*row) for row in rows[1:] ]
+        offset = len(update_columns)
+        conditions = [ (table, '.', quote_name(column), ' = ', value(offset + i))
+                       for i, column in enumerate(key_columns) ]
+        conditions.extend((table, '.', quote_name(column), ' IS NULL') for column in null_columns)
+        return [ 'UPDATE ', table, '\nSET ',
+                 join(', ', [ (quote_name(column), ' = ', value(i)) for i, column in enumerate(update_columns) ]),
+                 '\nFROM (VALUES ', join(', ', values), ') AS ', alias, '\nWHERE ', join(' AND ', conditions) ]
     def UPDATE(builder, table_name, pairs, where=None):
         return [ 'UPDATE ', builder.quote_name(table_name), '\nSET ',
                  join(', ', [ (builder.quote_name(name), ' = ', builder(param)) for name, param in pairs]),
-                 where and [ '\n', builder(where) ] or [] ]
+                 where and [ '\n', builder.subquery(where) ] or [] ]
     def DELETE(builder, table_name, where=None):
         result = [ 'DELETE FROM ', builder.quote_name(table_name) ]
-        if where: result += [ '\n', builder(where) ]
+        if where: result += [ '\n', builder.subquery(where) ]
         return result
     def subquery(builder, *sections):
         builder.indent += 1
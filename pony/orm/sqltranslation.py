@@ -16,7 +16,8 @@ from pony.orm.ormtypes import \
     string_types, numeric_types, comparable_types, SetType, FuncType, MethodType, \
     get_normalized_type_of, normalize_type, coerce_types, are_comparable_types
 from pony.orm import core
-from pony.orm.core import EntityMeta, Set, JOIN, OptimizationFailed, Attribute, DescWrapper
+from pony.orm.core import EntityMeta, Set, JOIN, OptimizationFailed, Attribute, DescWrapper, \
+                          LIMIT_PARAM, OFFSET_PARAM, SEEK_PARAM
 
 def check_comparable(left_monad, right_monad, op='=='):
     t1, t2 = left_monad.type, right_monad.type
@@ -166,6 +167,8 @@ class SQLTranslator(ASTTranslator):
         translator.conditions = subquery.conditions
         translator.having_conditions = []
         translator.order = []
+        translator.key_order = None
+        translator.seek = False
         translator.aggregated = False if not optimize else True
         translator.inside_expr = False
         translator.inside_not = False
@@ -413,6 +416,7 @@ class SQLTranslator(ASTTranslator):
                 if isinstance(monad, translator.ObjectIterMonad): pass
                 elif isinstance(monad, translator.AttrMonad) and not monad.attr.nullable: pass
                 else: conditions.extend([ 'IS_NOT_NULL', column_ast ] for column_ast in monad.getsql())
+        if translator.seek: conditions.append(translator.construct_seek_condition())
         if conditions:
             sql_ast.append([ 'WHERE' ] + conditions)
 
@@ -431,16 +435,60 @@ class SQLTranslator(ASTTranslator):
         if translator.order: sql_ast.append([ 'ORDER_BY' ] + translator.order)
 
         if range:
+            # limit and offset are passed as parameters, so the same SQL serves all pages;
+            # only the presence of offset affects the text of the query
             start, stop = range
-            limit = stop - start
-            offset = start
-            assert limit is not None
-            limit_section = [ 'LIMIT', [ 'VALUE', limit ]]
-            if offset: limit_section.append([ 'VALUE', offset ])
+            assert stop is not None
+            limit_section = [ 'LIMIT', [ 'PARAM', LIMIT_PARAM ] ]
+            if start: limit_section.append([ 'PARAM', OFFSET_PARAM ])
             sql_ast = sql_ast + [ limit_section ]
 
         sql_ast = ast_transformer(sql_ast)
         return sql_ast, attr_offsets
+    def construct_include_joins(translator, sql_ast, include):
+        # Adds LEFT JOIN for each included to-one relationship and appends columns of
+        # related entity to the select list, so the related objects are loaded by the same query
+        assert sql_ast[0] == 'SELECT' and sql_ast[1][0] in ('ALL', 'DISTINCT')
+        sql_ast = sql_ast[:]
+        select_ast = sql_ast[1] = sql_ast[1][:]
+        from_ast = sql_ast[2] = [ sql_ast[2][0] ] + [ list(source) for source in sql_ast[2][1:] ]
+        conditions = []
+        if from_ast[0] != 'LEFT_JOIN':
+            for source in from_ast[2:]:
+                if len(source) == 4: conditions.append(source.pop())
+            from_ast[0] = 'LEFT_JOIN'
+        if conditions:
+            if len(sql_ast) > 3 and sql_ast[3][0] == 'WHERE': sql_ast[3] = sql_ast[3] + conditions
+            else: sql_ast.insert(3, [ 'WHERE' ] + conditions)
+        for i, source in enumerate(from_ast):
+            if i and source[0] == translator.alias: break
+        else: i = len(from_ast) - 1
+        position = i + 1
+        alias_counters = translator.subquery.alias_counters.copy()
+        aliases = { () : translator.alias }
+        include_offsets = []
+        for path in include:
+            for j in xrange(len(path)):
+                subpath = path[:j+1]
+                if subpath in aliases: continue
+                parent_alias = aliases[path[:j]]
+                attr = path[j]
+                entity = attr.py_type
+                name = entity.__name__[:max_alias_length-3].lower()
+                alias_counters[name] = alias_counters.get(name, 0) + 1
+                alias = aliases[subpath] = '%s-%d' % (name, alias_counters[name])
+                if attr.columns: join_cond = join_tables(parent_alias, alias, attr.columns, entity._pk_columns_)
+                else: join_cond = join_tables(parent_alias, alias, attr.entity._pk_columns_, attr.reverse.columns)
+                if entity._discriminator_attr_ and entity is not entity._root_:
+                    join_cond = sqland([ join_cond, entity._construct_discriminator_criteria_(alias) ])
+                from_ast.insert(position, [ alias, 'TABLE', entity._table_, join_cond ])
+                position += 1
+                columns, attr_offsets = entity._construct_select_clause_(alias)
+                shift = len(select_ast) - 1
+                select_ast.extend(columns[1:])
+                for offsets in attr_offsets.itervalues(): offsets[:] = [ offset + shift for offset in offsets ]
+                include_offsets.append((subpath, entity, attr_offsets))
+        return sql_ast, include_offsets
     def order_by_numbers(translator, numbers):
         if 0 in numbers: throw(ValueError, 'Numeric arguments of order_by() method must be non-zero')
         translator = translator.shallow_copy()
@@ -483,6 +531,68 @@ class SQLTranslator(ASTTranslator):
             for column in attr.columns:
                 order.append(desc_wrapper([ 'COLUMN', alias, column]))
         return translator
+    def order_by_key(translator, seek):
+        entity = translator.expr_type
+        if not isinstance(entity, EntityMeta) or translator.aggregated or translator.optimize: throw(TypeError,
+            'Keyset pagination is limited to queries which return simple list of objects')
+        alias = translator.alias
+        column_attrs = {}
+        for attr in entity._attrs_:
+            if attr.is_collection: continue
+            for i, column in enumerate(attr.columns): column_attrs.setdefault(column, (attr, i))
+        key_order = []
+        for item in translator.order:
+            desc = item[0] == 'DESC'
+            column_ast = desc and item[1] or item
+            if column_ast[0] != 'COLUMN' or column_ast[1] != alias or column_ast[2] not in column_attrs:
+                throw(TypeError, 'Keyset pagination requires query to be ordered by attributes of %s only'
+                                 % entity.__name__)
+            attr, i = column_attrs[column_ast[2]]
+            if attr.nullable: throw(TypeError,
+                'Keyset pagination cannot be used with nullable attribute %s' % attr)
+            key_order.append((column_ast, desc, attr, i))
+        translator = translator.shallow_copy()
+        order = translator.order = translator.order[:]
+        used_columns = set(column_ast[2] for column_ast, desc, attr, i in key_order)
+        for attr in entity._pk_attrs_:  # primary key makes the order unique
+            for i, column in enumerate(attr.columns):
+                if column in used_columns: continue
+                column_ast = [ 'COLUMN', alias, column ]
+                order.append(column_ast)
+                key_order.append((column_ast, False, attr, i))
+        translator.key_order = key_order
+        translator.seek = seek
+        return translator
+    def construct_pk_subquery_ast(translator):
+        entity = translator.expr_type
+        if not isinstance(entity, EntityMeta) or translator.aggregated or translator.groupby_monads \
+           or translator.having_conditions: throw(TypeError,
+            'Bulk update and delete are limited to queries which return simple list of objects')
+        pk_columns = entity._pk_columns_
+        select_ast = [ 'ALL' ] + [ [ 'AS', column_ast, column ]
+                                   for column_ast, column in izip(translator.expr_columns, pk_columns) ]
+        subquery_ast = [ 'SELECT', select_ast, translator.subquery.from_ast ]
+        if translator.conditions: subquery_ast.append([ 'WHERE' ] + translator.conditions)
+        # derived table is necessary for MySQL, which cannot select from the table being modified
+        select_ast = [ 'ALL' ] + [ [ 'COLUMN', 't', column ] for column in pk_columns ]
+        return [ 'SELECT', select_ast, [ 'FROM', [ 't', 'SELECT', subquery_ast[1:] ] ] ]
+    def get_key_values(translator, obj):
+        return tuple(attr.get_raw_values(attr.__get__(obj))[i] for column_ast, desc, attr, i in translator.key_order)
+    def construct_seek_condition(translator):
+        key_order = translator.key_order
+        columns = [ column_ast for column_ast, desc, attr, i in key_order ]
+        params = [ [ 'PARAM', (SEEK_PARAM, k), attr.converters[i] ]
+                   for k, (column_ast, desc, attr, i) in enumerate(key_order) ]
+        directions = set(desc for column_ast, desc, attr, i in key_order)
+        if len(columns) > 1 and len(directions) == 1 \
+           and translator.row_value_syntax == True and translator.dialect != 'Oracle':
+            return [ directions.pop() and 'LT' or 'GT', [ 'ROW' ] + columns, [ 'ROW' ] + params ]
+        conditions = []
+        for k, (column_ast, desc, attr, i) in enumerate(key_order):
+            items = [ [ 'EQ', columns[j], params[j] ] for j in xrange(k) ]
+            items.append([ desc and 'LT' or 'GT', column_ast, params[k] ])
+            conditions.append(sqland(items))
+        return sqlor(conditions)
     def apply_lambda(translator, order_by, func_ast, extractors, vartypes):
         prev_optimized = translator.optimize
         translator = deepcopy(translator)
@@ -36,6 +36,28 @@ from test_frames import *
 from test_core_multiset import *
 from test_core_find_in_cache import *
 from test_db_session import *
+from test_connection_pool import *
+from test_replicas import *
+from test_query_cache import *
+from test_keyset_pagination import *
+from test_streaming import *
+from test_hydration import *
+from test_insert_batching import *
+from test_update_batching import *
+from test_delete_batching import *
+from test_bulk_operations import *
+from test_entity_cache import *
+from test_query_result_cache import *
+from test_cache_eviction import *
+from test_prefetch import *
+from test_include import *
+from test_hooks import *
+from test_query_stats import *
+from test_nplus1 import *
+from test_explain import *
+from test_slow_query_log import *
+from test_prepared_query import *
+from test_statement_cache import *
 
 #from new_tests import *
 
@@ -0,0 +1,124 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    products = Set('Product')
+
+class Product(db.Entity):
+    name = Required(unicode, unique=True)
+    price = Required(int)
+    group = Optional(Group)
+
+class Mark(db.Entity):
+    student = Required(int)
+    subject = Required(unicode)
+    value = Required(int)
+    PrimaryKey(student, subject)
+
+db.generate_mapping(create_tables=True)
+
+def count_statements(prefix):
+    return sum(stat.db_count for sql, stat in db.local_stats.iteritems() if sql.startswith(prefix))
+
+class TestBulkOperations(unittest.TestCase):
+    def setUp(self):
+        rollback()
+        with db_session:
+            db.execute('delete from Product')
+            db.execute('delete from "Group"')
+            db.execute('delete from Mark')
+            g1 = Group(number=1)
+            g2 = Group(number=2)
+            for i in range(1, 7): Product(name=u'P%d' % i, price=i * 5, group=i % 2 and g1 or g2)
+            for i in range(1, 4):
+                Mark(student=i, subject=u'Math', value=i)
+                Mark(student=i, subject=u'Physics', value=i + 1)
+        db.local_stats.clear()
+        db_session.__enter__()
+    def tearDown(self):
+        rollback()
+        db_session.__exit__()
+    def test_1(self):
+        count = select(p for p in Product if p.price < 20).update(price=100)
+        self.assertEqual(count, 3)
+        self.assertEqual(count_statements('UPDATE'), 1)
+        self.assertEqual(count_statements('SELECT'), 0)
+        self.assertEqual(db.select('count(*) from Product where price = 100'), [ 3 ])
+    def test_2(self):
+        p1, p5 = Product.get(name=u'P1'), Product.get(name=u'P5')
+        self.assertEqual(p1.price, 5)
+        select(p for p in Product if p.price < 20).update(price=100)
+        self.assertEqual(p1.price, 100)
+        self.assertEqual(p5.price, 25)
+    def test_3(self):
+        products = select(p for p in Product)[:]
+        self.assertEqual(len(products), 6)
+        select(p for p in Product if p.price < 20).update(price=100)
+        self.assertEqual(select(p for p in Product if p.price == 100).count(), 3)
+    def test_4(self):
+        g1, g2 = Group[1], Group[2]
+        self.assertEqual(len(g1.products), 3)
+        select(p for p in Product if p.group == g1).update(group=g2)
+        self.assertEqual(len(g1.products), 0)
+        self.assertEqual(len(g2.products), 6)
+    def test_5(self):
+        p1 = Product.get(name=u'P1')
+        count = select(p for p in Product if p.group.number == 1).delete(bulk=True)
+        self.assertEqual(count, 3)
+        self.assertEqual(count_statements('DELETE'), 1)
+        self.assertEqual(p1._status_, 'deleted')
+        self.assertEqual(Product.get(name=u'P1'), None)
+        self.assertEqual(db.select('count(*) from Product'), [ 3 ])
+        self.assertEqual(len(Group[1].products), 0)
+    def test_6(self):
+        p = Product.get(name=u'P1')
+        p.price = 7
+        select(p for p in Product if p.price < 10).update(price=8)
+        self.assertEqual(db.select("price from Product where name = 'P1'"), [ 8 ])
+        self.assertEqual(p.price, 8)
+    def test_7(self):
+        count = select(p for p in Product if p.price > 10).delete()
+        self.assertEqual(count, 4)
+        self.assertEqual(count_statements('SELECT'), 1)
+        commit()
+        self.assertEqual(db.select('count(*) from Product'), [ 2 ])
+    def test_8(self):
+        x = 15
+        select(p for p in Product if p.price > x).update(price=1)
+        commit()
+        self.assertEqual(db.select('count(*) from Product where price = 1'), [ 3 ])
+    def test_9(self):
+        m = Mark[1, u'Math']
+        count = select(m for m in Mark if m.value >= 2).update(value=10)
+        self.assertEqual(count, 5)
+        self.assertEqual(m.value, 1)
+        count = select(m for m in Mark if m.subject == u'Math').delete(bulk=True)
+        self.assertEqual(count, 3)
+        self.assertEqual(m._status_, 'deleted')
+        self.assertEqual(db.select('count(*) from Mark'), [ 3 ])
+    @raises_exception(TypeError, 'Bulk update and delete are limited to queries which return simple list of objects')
+    def test_10(self):
+        select(p.price for p in Product).delete(bulk=True)
+    @raises_exception(TypeError, 'Collection attribute Group.products cannot be updated in bulk')
+    def test_11(self):
+        select(g for g in Group).update(products=[])
+    @raises_exception(TypeError, 'Primary key attribute Group.number cannot be updated in bulk')
+    def test_12(self):
+        select(g for g in Group).update(number=3)
+    @raises_exception(TypeError, "Unknown attribute 'cost'")
+    def test_13(self):
+        select(p for p in Product).update(cost=3)
+    @raises_exception(TypeError, 'Bulk delete cannot be used for Group, because of relationship attribute '
+                                 'Group.products. Use delete() without bulk=True')
+    def test_14(self):
+        select(g for g in Group if g.number == 1).delete(bulk=True)
+
+if __name__ == '__main__':
+    unittest.main()
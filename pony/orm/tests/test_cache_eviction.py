@@ -0,0 +1,75 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    students = Set('Student')
+
+class Student(db.Entity):
+    name = Required(unicode)
+    group = Required(Group)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    g1 = Group(number=1)
+    g2 = Group(number=2)
+    for i in range(1, 21): Student(id=i, name=u'S%d' % i, group=i % 2 and g1 or g2)
+
+def cached_count(entity):
+    return len(db._get_cache().indexes.get(entity._pk_, ()))
+
+class TestCacheEviction(unittest.TestCase):
+    def test_1(self):
+        with db_session(max_cache_size=5):
+            for i in range(1, 21): Student[i]
+            self.assertEqual(cached_count(Student), 5)
+            self.assertEqual(set(db._get_cache().lru.keys()), set(Student[i] for i in range(16, 21)))
+    def test_2(self):
+        with db_session(max_cache_size=5):
+            g1 = Group[1]
+            students = select(s for s in Student if s.group == g1)[:]
+            self.assertEqual(len(students), 10)
+            # group is referenced by cached students and cannot be evicted
+            self.assertTrue(cached_count(Group) >= 1)
+            self.assertEqual(Student[1].group, g1)
+    def test_3(self):
+        with db_session(max_cache_size=3):
+            s = Student[1]
+            s.name = u'X'
+            for i in range(2, 10): Student[i]
+            self.assertEqual(Student[1].name, 'X')  # changes were flushed before s was evicted
+            rollback()
+    def test_4(self):
+        with db_session(max_cache_size=3):
+            for i in range(10): Student(name=u'New', group=Group[1])
+            flush()
+            self.assertTrue(cached_count(Student) <= 3)
+            rollback()
+    def test_5(self):
+        with db_session(strict=True):
+            s = Student[1]
+            group = s.group
+        self.assertEqual(s._vals_, {})
+        self.assertEqual(group._vals_, {})
+    @raises_exception(TransactionError, 'Object Student[1] cannot be used after the database session is over')
+    def test_6(self):
+        with db_session(strict=True):
+            s = Student[1]
+        s.name
+    def test_7(self):
+        with db_session:
+            self.assertEqual(db.evict([ Student[1] ]), 1)
+            self.assertEqual(cached_count(Student), 0)
+    @raises_exception(TypeError, "'max_cache_size' parameter of db_session must be positive. Got: 0")
+    def test_8(self):
+        db_session(max_cache_size=0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+from __future__ import with_statement
+
+import unittest, sqlite3, time
+from threading import Thread
+
+from pony.orm.core import *
+from pony.orm import dbapiprovider
+from pony.orm.dbapiprovider import ConnectionPool
+from testutils import *
+
+class TestConnectionPool(unittest.TestCase):
+    def make_pool(self, **kwargs):
+        return ConnectionPool(sqlite3, ':memory:', check_same_thread=False, **kwargs)
+
+    def test_reuse(self):
+        pool = self.make_pool()
+        con = pool.connect()
+        pool.release(con)
+        self.assertIs(pool.connect(), con)
+        stats = pool.get_stats()
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['in_use'], 1)
+
+    def test_max_size(self):
+        pool = self.make_pool(pony_pool_max_size=2)
+        con1 = pool.connect()
+        con2 = pool.connect()
+        self.assertIsNot(con1, con2)
+        self.assertEqual(pool.get_stats()['size'], 2)
+
+    @raises_exception(PoolTimeoutError, 'Cannot get connection from pool in 0.01 seconds (all 1 connections are in use)')
+    def test_timeout(self):
+        pool = self.make_pool(pony_pool_max_size=1, pony_pool_timeout=0.01)
+        pool.connect()
+        pool.connect()
+
+    def test_wait(self):
+        pool = self.make_pool(pony_pool_max_size=1)
+        con = pool.connect()
+        def release():
+            time.sleep(0.05)
+            pool.release(con)
+        thread = Thread(target=release)
+        thread.start()
+        self.assertIs(pool.connect(), con)
+        thread.join()
+        stats = pool.get_stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertTrue(stats['wait_time'] > 0)
+
+    def test_drop(self):
+        pool = self.make_pool(pony_pool_max_size=1, pony_pool_timeout=0)
+        con = pool.connect()
+        pool.drop(con)
+        self.assertIsNot(pool.connect(), con)
+        self.assertEqual(pool.get_stats()['drops'], 1)
+
+    def test_idle_eviction(self):
+        pool = self.make_pool(pony_pool_min_size=1, pony_pool_max_idle_time=0)
+        con1 = pool.connect()
+        con2 = pool.connect()
+        pool.release(con1)
+        pool.release(con2)
+        time.sleep(0.01)
+        self.assertIs(pool.connect(), con2)
+        stats = pool.get_stats()
+        self.assertEqual(stats['idle_evictions'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_max_lifetime(self):
+        pool = self.make_pool(pony_pool_max_lifetime=0)
+        con = pool.connect()
+        time.sleep(0.01)
+        pool.release(con)
+        stats = pool.get_stats()
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['lifetime_evictions'], 1)
+
+    def test_disconnect(self):
+        pool = self.make_pool()
+        con = pool.connect()
+        pool.release(con)
+        pool.disconnect()
+        self.assertEqual(pool.get_stats()['size'], 0)
+        self.assertIsNot(pool.connect(), con)
+
+    @raises_exception(ValueError, 'pony_pool_min_size must be in range 0..2')
+    def test_min_size(self):
+        self.make_pool(pony_pool_min_size=3, pony_pool_max_size=2)
+
+    def test_pre_ping_1(self):
+        pool = self.make_pool(pony_pool_pre_ping=0)
+        con = pool.connect()
+        pool.release(con)
+        self.assertIs(pool.connect(), con)
+        self.assertEqual(pool.get_stats()['pings'], 1)
+
+    def test_pre_ping_2(self):
+        pool = self.make_pool(pony_pool_pre_ping=0)
+        con = pool.connect()
+        pool.release(con)
+        con.close()
+        con2 = pool.connect()
+        self.assertIsNot(con2, con)
+        stats = pool.get_stats()
+        self.assertEqual(stats['ping_failures'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_pre_ping_3(self):
+        pool = self.make_pool(pony_pool_pre_ping=60)
+        con = pool.connect()
+        pool.release(con)
+        self.assertIs(pool.connect(), con)
+        self.assertEqual(pool.get_stats()['pings'], 0)
+
+    def test_validate_idle(self):
+        pool = self.make_pool()
+        con1 = pool.connect()
+        con2 = pool.connect()
+        pool.release(con1)
+        pool.release(con2)
+        con1.close()
+        self.assertEqual(pool.validate_idle(), 1)
+        stats = pool.get_stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertIs(pool.connect(), con2)
+
+    def test_validation_thread(self):
+        pool = self.make_pool(pony_pool_validation_interval=0.01)
+        con = pool.connect()
+        pool.release(con)
+        con.close()
+        for i in range(100):
+            if pool.get_stats()['size'] == 0: break
+            time.sleep(0.01)
+        pool.stop_validation()
+        self.assertEqual(pool.get_stats()['ping_failures'], 1)
+    def test_validation_thread_stop(self):
+        prev_event = dbapiprovider.Event
+        def Event26():
+            event = prev_event()
+            wait = event.wait
+            def wait26(timeout=None): wait(timeout)  # Event.wait() returns None in Python 2.6
+            event.wait = wait26
+            return event
+        dbapiprovider.Event = Event26
+        try: pool = self.make_pool(pony_pool_validation_interval=0.01)
+        finally: dbapiprovider.Event = prev_event
+        thread = pool.validation_thread
+        pool.stop_validation()
+        thread.join(1)
+        self.assertFalse(thread.isAlive())
+
+if __name__ == '__main__':
+    unittest.main()
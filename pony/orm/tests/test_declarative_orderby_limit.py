@@ -106,5 +106,21 @@ class TestOrderbyLimit(unittest.TestCase):
         students = set(select(s for s in Student).order_by(Student.id)[:])
         self.assertEqual(students, set([Student[1], Student[2], Student[3], Student[4], Student[5]]))
 
+    def test19(self):
+        query = select(s for s in Student).order_by(Student.id)
+        self.assertEqual(query.page(2, pagesize=2), [Student[3], Student[4]])
+        sql = db.last_sql
+        self.assertEqual(query.page(3, pagesize=2), [Student[5]])
+        self.assertEqual(db.last_sql, sql)
+        self.assert_('LIMIT ? OFFSET ?' in sql)
+
+    def test20(self):
+        query = select(s for s in Student).order_by(Student.id)
+        self.assertEqual(query[:2], [Student[1], Student[2]])
+        sql = db.last_sql
+        self.assertEqual(query[:3], [Student[1], Student[2], Student[3]])
+        self.assertEqual(db.last_sql, sql)
+        self.assert_('LIMIT ?' in sql and 'OFFSET' not in sql)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,72 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    students = Set('Student')
+
+class Student(db.Entity):
+    name = Required(unicode)
+    group = Required(Group)
+
+class Person(db.Entity):
+    name = Required(unicode)
+    parent = Optional('Person', reverse='children')
+    children = Set('Person', reverse='parent')
+
+db.generate_mapping(create_tables=True)
+
+def count_deletes():
+    return sum(stat.db_count for sql, stat in db.local_stats.iteritems() if sql.startswith('DELETE'))
+
+class TestDeleteBatching(unittest.TestCase):
+    def setUp(self):
+        rollback()
+        with db_session:
+            db.execute('delete from Student')
+            db.execute('delete from "Group"')
+            db.execute('delete from Person')
+            for i in range(1, 3):
+                group = Group(number=i)
+                for j in range(5): Student(name=u'S%d%d' % (i, j), group=group)
+            parent = Person(name=u'P')
+            Person(name=u'C1', parent=parent)
+            Person(name=u'C2', parent=parent)
+        db.local_stats.clear()
+        db_session.__enter__()
+    def tearDown(self):
+        rollback()
+        db_session.__exit__()
+        db.provider.max_params_count = 200
+    def test_1(self):
+        Group[1].delete()
+        flush()
+        self.assertEqual(count_deletes(), 2)
+        self.assertEqual(db.select('count(*) from Student'), [ 5 ])
+        self.assertEqual(db.select('count(*) from "Group"'), [ 1 ])
+    def test_2(self):
+        db.provider.max_params_count = 2
+        for s in select(s for s in Student)[:5]: s.delete()
+        flush()
+        self.assertEqual(count_deletes(), 3)
+        self.assertEqual(db.select('count(*) from Student'), [ 5 ])
+    def test_3(self):
+        for p in select(p for p in Person): p.delete()
+        flush()
+        self.assertEqual(count_deletes(), 3)
+        self.assertEqual(db.select('count(*) from Person'), [ 0 ])
+    @raises_exception(UnrepeatableReadError)
+    def test_4(self):
+        students = select(s for s in Student)[:]
+        db.execute('delete from Student where id = %d' % students[1].id)
+        for s in students: s.delete()
+        flush()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+from __future__ import with_statement
+
+import unittest, time
+
+from pony.orm.core import *
+from pony.orm.core import EntityCache
+from pony.utils import LocalMemcache
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Country(db.Entity):
+    _cache_policy_ = 'readonly'
+    code = Required(unicode, unique=True)
+    name = Required(unicode)
+    cities = Set('City')
+
+class City(db.Entity):
+    name = Required(unicode)
+    country = Required(Country)
+
+class Currency(db.Entity):
+    _cache_policy_ = 'readwrite'
+    code = PrimaryKey(unicode)
+    rate = Required(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    us = Country(id=1, code=u'US', name=u'United States')
+    City(id=1, name=u'Boston', country=us)
+    Currency(code=u'USD', rate=1)
+    Currency(code=u'EUR', rate=2)
+
+def count_selects():
+    return sum(stat.db_count for sql, stat in db.local_stats.iteritems() if sql.startswith('SELECT'))
+
+class TestLocalMemcache(unittest.TestCase):
+    def test_1(self):
+        storage = LocalMemcache(2)
+        storage.set('a', 1)
+        storage.set('b', 2)
+        storage.set('c', 3)
+        self.assertEqual(storage.get('a'), None)
+        self.assertEqual(storage.get('c'), 3)
+        self.assertTrue(storage.delete('c'))
+        self.assertEqual(storage.get('c'), None)
+    def test_2(self):
+        storage = LocalMemcache()
+        storage.set('a', 1, 0.01)
+        self.assertEqual(storage.get('a'), 1)
+        time.sleep(0.02)
+        self.assertEqual(storage.get('a'), None)
+
+class TestEntityCache(unittest.TestCase):
+    def setUp(self):
+        db.entity_cache = EntityCache()
+        db.local_stats.clear()
+    def test_1(self):
+        with db_session: self.assertEqual(Country[1].name, 'United States')
+        with db_session:
+            self.assertEqual(Country[1].name, 'United States')
+            self.assertEqual(Country.get(code=u'US').id, 1)
+        self.assertEqual(count_selects(), 1)
+    def test_2(self):
+        with db_session: select(c for c in Country)[:]
+        with db_session: self.assertEqual(Country.get(code=u'US').name, 'United States')
+        self.assertEqual(count_selects(), 1)
+    def test_3(self):
+        with db_session: Country[1]
+        with db_session:
+            city = City[1]
+            self.assertEqual(city.country.name, 'United States')
+        self.assertEqual(count_selects(), 2)
+    @raises_exception(TransactionError, 'Object Country[1] cannot be modified because entity Country has read-only cache policy')
+    def test_4(self):
+        with db_session:
+            Country[1].name = u'USA'
+            flush()
+    def test_5(self):
+        with db_session: Currency[u'EUR']
+        with db_session: Currency[u'EUR'].rate = 3
+        with db_session: self.assertEqual(Currency[u'EUR'].rate, 3)
+        with db_session: self.assertEqual(Currency[u'EUR'].rate, 3)
+        self.assertEqual(count_selects(), 2)
+        with db_session: Currency[u'EUR'].rate = 2
+    def test_6(self):
+        with db_session: select(c for c in Currency)[:]
+        with db_session:
+            Currency[u'USD'].rate = 5
+            self.assertEqual(Currency[u'EUR'].rate, 2)
+            rollback()
+        with db_session: self.assertEqual(Currency[u'USD'].rate, 1)
+        self.assertEqual(count_selects(), 1)
+    def test_7(self):
+        with db_session: select(c for c in Currency)[:]
+        with db_session: select(c for c in Currency if c.code == u'USD').update(rate=10)
+        with db_session: self.assertEqual(Currency[u'USD'].rate, 10)
+        with db_session: select(c for c in Currency if c.code == u'USD').update(rate=1)
+    def test_8(self):
+        with db_session:
+            Currency[u'USD'].rate = 7
+            flush()
+            select(c for c in Currency)[:]
+            rollback()
+        with db_session: self.assertEqual(Currency[u'USD'].rate, 1)
+    def test_9(self):
+        db.entity_cache = EntityCache(ttl=0.01)
+        with db_session: Currency[u'USD']
+        time.sleep(0.02)
+        with db_session: Currency[u'USD']
+        self.assertEqual(count_selects(), 2)
+    def test_10(self):
+        with db_session:
+            City[1]
+            db.entity_cache.invalidate(Currency, [ (u'USD',) ])  # concurrent commit after the start of transaction
+            Currency[u'USD']
+        with db_session: Currency[u'USD']
+        self.assertEqual(count_selects(), 3)
+        with db_session: Currency[u'USD']
+        self.assertEqual(count_selects(), 3)
+    def test_11(self):
+        with db_session:
+            db.execute("update Currency set rate = 3 where code = 'EUR'")
+            self.assertEqual(select(c.code for c in Currency if c.rate == 3)[:], [ u'EUR' ])
+            self.assertEqual(Currency[u'EUR'].rate, 3)
+            rollback()
+        with db_session: self.assertEqual(Currency[u'EUR'].rate, 2)
+        with db_session:
+            db.execute("update Currency set rate = 4 where code = 'EUR'")
+        with db_session: self.assertEqual(Currency[u'EUR'].rate, 4)
+        with db_session: Currency[u'EUR'].rate = 2
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int, index=True)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    Person(name=u'John', age=20)
+    Person(name=u'Mike', age=30)
+
+class TestExplain(unittest.TestCase):
+    def setUp(self):
+        db.clear_query_cache()
+    @db_session
+    def test_1(self):
+        plan = select(p for p in Person if p.age > 25).explain()
+        self.assertTrue(len(plan) > 0)
+        self.assertTrue('detail' in plan[0])
+        self.assertTrue('idx_person__age' in ' '.join(row['detail'] for row in plan).lower())
+    @db_session
+    def test_2(self):
+        x = 25
+        plan = Person.select(lambda p: p.name == u'John' and p.age > x).explain()
+        self.assertTrue(isinstance(plan, list))
+    @raises_exception(NotImplementedError, 'SQLite does not support EXPLAIN ANALYZE')
+    @db_session
+    def test_3(self):
+        select(p for p in Person).explain(analyze=True)
+    @db_session
+    def test_4(self):
+        hook = db.capture_slow_plans(threshold=0)
+        try:
+            query = select(p for p in Person if p.age > 25)
+            query[:]
+            sql = query._construct_sql_and_arguments()[0]
+            stat = db.local_stats[sql]
+            self.assertTrue(stat.plan)
+            plan = stat.plan
+            query[:]
+            self.assertIs(stat.plan, plan)
+        finally: db.remove_hook('execute', hook)
+    @db_session
+    def test_5(self):
+        hook = db.capture_slow_plans(threshold=1000)
+        try:
+            query = select(p for p in Person if p.age < 25)
+            query[:]
+            sql = query._construct_sql_and_arguments()[0]
+            self.assertEqual(db.local_stats[sql].plan, None)
+        finally: db.remove_hook('execute', hook)
+    @db_session
+    def test_6(self):
+        def explain(connection, sql, arguments=None, analyze=False):
+            raise DatabaseError(Exception('no plan_table'))
+        db.provider.explain = explain
+        hook = db.capture_slow_plans(threshold=0)
+        try:
+            query = select(p for p in Person if p.name != u'test_6')
+            self.assertEqual(len(query[:]), 2)
+            stat = db.local_stats[query._construct_sql_and_arguments()[0]]
+            self.assertEqual(stat.plan, None)
+            self.assertTrue(isinstance(stat.plan_error, DatabaseError))
+        finally:
+            db.remove_hook('execute', hook)
+            del db.provider.explain
+    @db_session
+    def test_7(self):
+        hook = db.capture_slow_plans(threshold=0)
+        try:
+            query = select(p for p in Person if p.name != u'test_7')
+            for chunk in query.iter_chunks(1): pass
+            stat = db.local_stats[query._construct_sql_and_arguments()[0]]
+            self.assertEqual(stat.plan, None)
+        finally: db.remove_hook('execute', hook)
+
+if __name__ == '__main__':
+    unittest.main()
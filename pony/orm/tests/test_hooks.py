@@ -0,0 +1,110 @@
+from __future__ import with_statement
+
+import sys, unittest
+from threading import Thread
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    Person(name=u'John', age=20)
+    Person(name=u'Mike', age=30)
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.hooks = []
+    def tearDown(self):
+        for event, func in self.hooks: db.remove_hook(event, func)
+    def add_hook(self, *events):
+        def hook(database, event, data):
+            self.assertIs(database, db)
+            self.events.append((event, data))
+        for event in events:
+            db.add_hook(event, hook)
+            self.hooks.append((event, hook))
+    def get_events(self, event):
+        return [ data for e, data in self.events if e == event ]
+    def test_1(self):
+        self.add_hook('execute', 'hydrate')
+        with db_session:
+            persons = select(p for p in Person if p.age > 10)[:]
+        executed, = self.get_events('execute')
+        self.assertEqual(executed['sql'], db.last_sql)
+        self.assertEqual(executed['params_count'], 0)
+        self.assertFalse(executed['cached'])
+        self.assertTrue(executed['duration'] >= 0)
+        hydrated, = self.get_events('hydrate')
+        self.assertIs(hydrated['entity'], Person)
+        self.assertEqual(hydrated['rows_count'], 2)
+        self.assertEqual(hydrated['objects_count'], 2)
+    def test_2(self):
+        self.add_hook('execute')
+        with db_session:
+            query = select(p for p in Person if p.age > 10)
+            query[:]
+            query[:]
+        self.assertEqual([ data['cached'] for data in self.get_events('execute') ], [ False, True ])
+    def test_3(self):
+        db.clear_query_cache()
+        self.add_hook('translate')
+        x = 5
+        with db_session:
+            select(p for p in Person if p.age > x and p.name != u'test_3')[:]
+            select(p for p in Person if p.age > x and p.name != u'test_3')[:]
+        self.assertEqual([ data['cached'] for data in self.get_events('translate') ], [ False, True ])
+    def test_4(self):
+        self.add_hook('connect', 'save', 'commit', 'rollback')
+        with db_session:
+            Person(name=u'Kate', age=25)
+        with db_session:
+            Person.get(name=u'Kate').delete()
+        with db_session:
+            Person(name=u'Kate', age=25)
+            rollback()
+        self.assertEqual(len(self.get_events('connect')), 3)
+        self.assertEqual([ data['objects_count'] for data in self.get_events('save') ], [ 1, 1 ])
+        self.assertEqual([ data['modified'] for data in self.get_events('commit') ], [ True, True ])
+        self.assertEqual(len(self.get_events('rollback')), 1)
+    def test_5(self):
+        self.add_hook('execute')
+        db.remove_hook('execute', self.hooks.pop()[1])
+        with db_session: select(p for p in Person)[:]
+        self.assertEqual(self.events, [])
+    @raises_exception(ValueError, "Unknown hook event: 'fetch'")
+    def test_6(self):
+        db.add_hook('fetch', lambda database, event, data: None)
+    @raises_exception(TypeError, 'Hook must be callable. Got: 1')
+    def test_7(self):
+        db.add_hook('execute', 1)
+    def test_8(self):
+        def register():
+            for i in range(200): self.hooks.append(('translate', db.add_hook('translate', lambda *args: None)))
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [ Thread(target=register) for i in range(5) ]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+        finally: sys.setcheckinterval(check_interval)
+        self.assertEqual(len(db._hooks['translate']), 1000)
+    def test_9(self):
+        def get_hydrator(attr_offsets):  # emulates other thread which adds hook in the middle of hydration
+            self.add_hook('hydrate')
+            return None
+        Person._get_hydrator_ = staticmethod(get_hydrator)
+        try:
+            with db_session: select(p for p in Person)[:]
+        finally: del Person._get_hydrator_
+        self.assertEqual(self.events, [])
+
+if __name__ == '__main__':
+    unittest.main()
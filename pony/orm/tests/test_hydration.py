@@ -0,0 +1,80 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    students = Set('Student')
+    marks = Set('Mark')
+
+class Student(db.Entity):
+    name = Required(unicode, unique=True)
+    gpa = Optional(float)
+    group = Optional(Group)
+    number = Optional(int)
+    passport = Optional(unicode, lazy=True)
+    composite_key(group, number)
+
+class Mark(db.Entity):
+    subject = Required(unicode)
+    group = Required(Group)
+    value = Required(int)
+    PrimaryKey(subject, group)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    g1 = Group(number=1)
+    g2 = Group(number=2)
+    Student(name=u'A', gpa=3.5, group=g1, number=1)
+    Student(name=u'B', gpa=4.0, group=g1, number=2)
+    Student(name=u'C')
+    Mark(subject=u'Math', group=g1, value=5)
+
+class TestHydration(unittest.TestCase):
+    def setUp(self):
+        db_session.__enter__()
+    def tearDown(self):
+        rollback()
+        db_session.__exit__()
+    def test_1(self):
+        students = select(s for s in Student).order_by(Student.id)[:]
+        self.assertEqual([ s.name for s in students ], [ 'A', 'B', 'C' ])
+        self.assertEqual(students[0].gpa, 3.5)
+        self.assertEqual(students[2].group, None)
+        self.assertEqual(len(Student._hydrator_cache_), 1)
+        self.assertIsNot(Student._hydrator_cache_.values()[0], None)
+    def test_2(self):
+        students = select(s for s in Student)[:]
+        self.assertIs(Student.get(name=u'A'), students[0])
+        self.assertIs(Student.get(group=Group[1], number=2), students[1])
+        self.assertEqual(set(Group[1].students), set(students[:2]))
+    def test_3(self):
+        s = Student[1]
+        s.gpa = 3.0
+        with db._get_cache().flush_disabled():
+            students = select(s for s in Student)[:]
+        self.assertIs(students[0], s)
+        self.assertEqual(s.gpa, 3.0)
+        self.assertEqual(Student[2].group, Group[1])
+    def test_4(self):
+        Student[3].delete()
+        with db._get_cache().flush_disabled():
+            students = select(s for s in Student)[:]
+        self.assertEqual(set(students), set([ Student[1], Student[2] ]))
+    def test_5(self):
+        students = select(s for s in Student).for_update()[:]
+        self.assertEqual(db._get_cache().for_update, set(students))
+    def test_6(self):
+        marks = select(m for m in Mark)[:]
+        self.assertEqual(marks[0].value, 5)
+        self.assertEqual(Group[1].marks, set(marks))
+        self.assertEqual(Student[1].passport, u'')
+
+if __name__ == '__main__':
+    unittest.main()
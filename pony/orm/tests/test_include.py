@@ -0,0 +1,94 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Address(db.Entity):
+    city = Required(unicode)
+    customers = Set('Customer')
+
+class Customer(db.Entity):
+    name = Required(unicode)
+    address = Optional(Address)
+    orders = Set('Order')
+    passport = Optional('Passport')
+
+class Passport(db.Entity):
+    number = Required(unicode)
+    customer = Required(Customer)
+
+class Order(db.Entity):
+    number = Required(int)
+    customer = Required(Customer)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    a1 = Address(city=u'London')
+    a2 = Address(city=u'Paris')
+    c1 = Customer(name=u'C1', address=a1)
+    c2 = Customer(name=u'C2', address=a2)
+    c3 = Customer(name=u'C3')
+    for i, customer in enumerate([ c1, c1, c2, c3 ]): Order(number=i + 1, customer=customer)
+
+with db_session:
+    Passport(number=u'N1', customer=Customer.get(name=u'C1'))
+
+def db_count():
+    return sum(stat.db_count for stat in db.local_stats.values())
+
+class TestInclude(unittest.TestCase):
+    @db_session
+    def test_1(self):
+        count = db_count()
+        orders = select(o for o in Order).order_by(Order.number).include(lambda o: o.customer)[:]
+        self.assertEqual([ o.customer.name for o in orders ], [ u'C1', u'C1', u'C2', u'C3' ])
+        self.assertEqual(db_count() - count, 1)
+    @db_session
+    def test_2(self):
+        count = db_count()
+        orders = select(o for o in Order).order_by(Order.number).include(lambda o: o.customer.address)[:]
+        cities = [ o.customer.address and o.customer.address.city for o in orders ]
+        self.assertEqual(cities, [ u'London', u'London', u'Paris', None ])
+        self.assertEqual(db_count() - count, 1)
+    @db_session
+    def test_3(self):
+        count = db_count()
+        customers = select(c for c in Customer).order_by(Customer.name).include(lambda c: c.passport)[:]
+        self.assertEqual([ c.passport and c.passport.number for c in customers ], [ u'N1', None, None ])
+        self.assertEqual(db_count() - count, 1)
+    @db_session
+    def test_4(self):
+        query = select(o for o in Order if o.customer.name == u'C1').include(lambda o: o.customer.address)
+        self.assertEqual(set(o.number for o in query), set([ 1, 2 ]))
+        self.assertTrue('LEFT JOIN "Address"' in db.last_sql)
+    @db_session
+    def test_5(self):
+        count = db_count()
+        orders = select(o for o in Order).include(lambda o: o.customer).order_by(Order.number)[1:3]
+        self.assertEqual([ o.customer.name for o in orders ], [ u'C1', u'C2' ])
+        self.assertEqual(db_count() - count, 1)
+    @db_session
+    def test_6(self):
+        query = select(o for o in Order).include(lambda o: o.customer)
+        self.assertEqual(query.count(), 4)
+        self.assertTrue('JOIN' not in db.last_sql)
+    @raises_exception(TypeError, 'Eager loading via include() is limited to queries which return simple list of objects')
+    @db_session
+    def test_7(self):
+        select(o.number for o in Order).include(lambda o: o.customer)
+    @raises_exception(TypeError, 'Attribute Customer.orders cannot be included: only to-one relationships can be loaded using JOIN')
+    @db_session
+    def test_8(self):
+        select(c for c in Customer).include(lambda c: c.orders)
+    @raises_exception(AttributeError, 'Entity Order does not have attribute client')
+    @db_session
+    def test_9(self):
+        select(o for o in Order).include(lambda o: o.client)
+
+if __name__ == '__main__':
+    unittest.main()
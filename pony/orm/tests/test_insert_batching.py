@@ -0,0 +1,116 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    students = Set('Student')
+
+class Student(db.Entity):
+    id = PrimaryKey(int)
+    name = Required(unicode, unique=True)
+    group = Required(Group)
+    mentor = Optional('Student', reverse='mentees')
+    mentees = Set('Student', reverse='mentor')
+
+class Mark(db.Entity):
+    value = Required(int)
+
+db.generate_mapping(create_tables=True)
+
+def count_inserts():
+    return sum(stat.db_count for sql, stat in db.local_stats.iteritems() if sql.startswith('INSERT'))
+
+class TestInsertBatching(unittest.TestCase):
+    def setUp(self):
+        rollback()
+        with db_session:
+            db.execute('delete from Student')
+            db.execute('delete from "Group"')
+            db.execute('delete from Mark')
+        db.local_stats.clear()
+    def tearDown(self):
+        db.provider.max_params_count = 200
+        db.provider.multi_row_insert_syntax = True
+        db.provider.__dict__.pop('reserve_ids_sql', None)
+    def test_1(self):
+        with db_session:
+            for i in range(1, 4):
+                group = Group(number=i)
+                for j in range(3): Student(id=i*10+j, name=u'S%d%d' % (i, j), group=group)
+        self.assertEqual(count_inserts(), 2)
+        with db_session:
+            self.assertEqual(count(s for s in Student if s.group.number == 2), 3)
+            self.assertEqual(Student[21].group.number, 2)
+    def test_2(self):
+        db.provider.max_params_count = 8
+        with db_session:
+            group = Group(number=1)
+            for j in range(5): Student(id=j, name=u'S%d' % j, group=group)
+        self.assertEqual(count_inserts(), 1 + 3)
+        with db_session:
+            self.assertEqual(count(s for s in Student), 5)
+    def test_3(self):
+        db.provider.multi_row_insert_syntax = False
+        with db_session:
+            group = Group(number=1)
+            for j in range(5): Student(id=j, name=u'S%d' % j, group=group)
+        with db_session:
+            self.assertEqual(select(s.name for s in Student).order_by(1)[:], [ 'S0', 'S1', 'S2', 'S3', 'S4' ])
+    def test_4(self):
+        with db_session:
+            group = Group(number=1)
+            s1 = Student(id=1, name=u'A', group=group)
+            s2 = Student(id=2, name=u'B', group=group, mentor=s1)
+            s1.mentor = Student(id=3, name=u'C', group=group)
+        with db_session:
+            self.assertEqual(Student[1].mentor, Student[3])
+            self.assertEqual(Student[2].mentor, Student[1])
+    def test_5(self):
+        with db_session:
+            marks = [ Mark(value=i) for i in range(3) ]
+            flush()
+            self.assertEqual([ mark.id for mark in marks ], range(marks[0].id, marks[0].id + 3))
+            self.assertEqual([ mark._status_ for mark in marks ], [ 'saved' ] * 3)
+            self.assertEqual(count_inserts(), 3)
+    @raises_exception(CommitException)
+    def test_6(self):
+        with db_session:
+            group = Group(number=1)
+            Student(id=1, name=u'A', group=group)
+        with db_session:
+            Student(id=2, name=u'B', group=Group[1])
+            Student(id=1, name=u'C', group=Group[1])
+    def test_7(self):
+        with db_session:
+            group = Group(number=1)
+            Student(id=1, name=u'A', group=group)
+        with db_session:
+            Student[1].delete()
+            Student(id=2, name=u'A', group=Group[1])
+            Student(id=3, name=u'B', group=Group[1])
+        with db_session:
+            self.assertEqual(select(s.id for s in Student).order_by(1)[:], [ 2, 3 ])
+    def test_8(self):
+        def reserve_ids_sql(table_name, column_name, count):  # emulation of PostgreSQL sequence
+            return ('WITH RECURSIVE ids(id) AS (SELECT coalesce(max(%s), 0) + 1 FROM %s '
+                    'UNION ALL SELECT id + 1 FROM ids LIMIT %d) SELECT id FROM ids'
+                    % (db.provider.quote_name(column_name), db.provider.quote_name(table_name), count), None)
+        db.provider.reserve_ids_sql = reserve_ids_sql
+        with db_session:
+            marks = [ Mark(value=i) for i in range(3) ]
+            flush()
+            self.assertEqual(count_inserts(), 1)
+            ids = [ mark.id for mark in marks ]
+            self.assertEqual(ids, range(ids[0], ids[0] + 3))
+            self.assertEqual(Mark[ids[2]], marks[2])
+        with db_session:
+            self.assertEqual(select((m.id, m.value) for m in Mark).order_by(1)[:], zip(ids, range(3)))
+
+if __name__ == '__main__':
+    unittest.main()
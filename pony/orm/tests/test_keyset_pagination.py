@@ -0,0 +1,80 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    students = Set('Student')
+
+class Student(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+    group = Required(Group)
+    scholarship = Optional(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    g1 = Group(number=1)
+    g2 = Group(number=2)
+    for i, age in enumerate([ 20, 22, 20, 21, 22, 20, 23 ]):
+        Student(name=u'S%d' % (i+1), age=age, group=i % 2 and g2 or g1)
+
+class TestKeysetPagination(unittest.TestCase):
+    def setUp(self):
+        db_session.__enter__()
+    def tearDown(self):
+        rollback()
+        db_session.__exit__()
+    def test_1(self):
+        query = select(s for s in Student)
+        self.assertEqual(query.after(None, 3), [ Student[1], Student[2], Student[3] ])
+        self.assertEqual(query.after(Student[3], 3), [ Student[4], Student[5], Student[6] ])
+        self.assertEqual(query.after((6,), 3), [ Student[7] ])
+        self.assert_('OFFSET' not in db.last_sql)
+    def test_2(self):
+        query = select(s for s in Student).order_by(Student.age)
+        result = []
+        objects, key = query.page_by_key(3)
+        while True:
+            result.extend(objects)
+            if key is None: break
+            objects, key = query.page_by_key(3, key)
+        self.assertEqual([ s.id for s in result ], [ 1, 3, 6, 4, 2, 5, 7 ])
+    def test_3(self):
+        query = select(s for s in Student).order_by(desc(Student.age), Student.name)
+        objects, key = query.page_by_key(2)
+        self.assertEqual(objects, [ Student[7], Student[2] ])
+        self.assertEqual(key, (22, u'S2', 2))
+        objects, key = query.page_by_key(2, key)
+        self.assertEqual(objects, [ Student[5], Student[4] ])
+    def test_4(self):
+        query = select(s for s in Student).order_by(Student.group, Student.age)
+        self.assertEqual(query.after(Student[3], 2), [ Student[5], Student[7] ])
+    def test_5(self):
+        query = select(s for s in Student if s.age > 20).order_by(Student.age)
+        self.assertEqual(query.after(Student[4], 10), [ Student[2], Student[5], Student[7] ])
+        self.assertEqual(query[:], [ Student[4], Student[2], Student[5], Student[7] ])
+    def test_6(self):
+        query = select(s for s in Student).order_by(lambda s: s.name)
+        self.assertEqual(query.after((u'S5', 5), 1), [ Student[6] ])
+    @raises_exception(TypeError, 'Keyset pagination key must contain 2 values. Got: (20,)')
+    def test_7(self):
+        select(s for s in Student).order_by(Student.age).after((20,), 1)
+    @raises_exception(TypeError, 'Keyset pagination requires query to be ordered by attributes of Student only')
+    def test_8(self):
+        select(s for s in Student).order_by(lambda s: s.age + 1).after(None, 1)
+    @raises_exception(TypeError, 'Keyset pagination is limited to queries which return simple list of objects')
+    def test_9(self):
+        select(s.name for s in Student).after(None, 1)
+    @raises_exception(TypeError, 'Keyset pagination cannot be used with nullable attribute Student.scholarship')
+    def test_10(self):
+        select(s for s in Student).order_by(Student.scholarship).after(None, 1)
+
+if __name__ == '__main__':
+    unittest.main()
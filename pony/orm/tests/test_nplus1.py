@@ -0,0 +1,74 @@
+from __future__ import with_statement
+
+import unittest, warnings
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Customer(db.Entity):
+    name = Required(unicode, unique=True)
+    orders = Set('Order', nplus1_threshold=None)
+    passport = Optional('Passport')
+    notes = Optional(unicode, lazy=True)
+
+class Passport(db.Entity):
+    number = Required(unicode)
+    customer = Optional(Customer, column='customer_id')
+
+class Order(db.Entity):
+    number = Required(int)
+    customer = Required(Customer)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    for i in range(10):
+        customer = Customer(name=u'C%d' % i, notes=u'N%d' % i)
+        Order(number=i, customer=customer)
+
+class TestNPlusOneDetector(unittest.TestCase):
+    def run_detection(self, func, detect_nplus1=True):
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            with db_session(detect_nplus1=detect_nplus1): func()
+        return [ str(warning.message) for warning in w if issubclass(warning.category, NPlusOneWarning) ]
+    def test_1(self):
+        def func():
+            for c in Customer.select(): len(c.orders)
+        messages = self.run_detection(func)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith('Possible N+1 problem: collection Customer.orders'))
+        self.assertTrue('query.prefetch(Customer.orders)' in messages[0])
+        self.assertTrue('test_nplus1.py' in messages[0])
+    def test_2(self):
+        def func():
+            for i in range(10): Customer.get(name=u'C%d' % i)
+        messages = self.run_detection(func)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue('objects of Customer are retrieved one by one by name' in messages[0])
+    def test_3(self):
+        def func():
+            for c in Customer.select(): c.notes
+        messages = self.run_detection(func)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue('attribute Customer.notes is loaded separately' in messages[0])
+    def test_4(self):
+        def func():
+            for c in Customer.select(): c.passport
+        messages = self.run_detection(func)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue('query.prefetch(Customer.passport)' in messages[0])
+    def test_5(self):
+        def func():
+            for c in Customer.select(): len(c.orders)
+        self.assertEqual(self.run_detection(func, detect_nplus1=False), [])
+    def test_6(self):
+        def func():
+            for c in Customer.select().prefetch(Customer.orders): len(c.orders)
+            for i in range(3): Customer.get(name=u'C%d' % i)
+        self.assertEqual(self.run_detection(func), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Customer(db.Entity):
+    name = Required(unicode)
+    orders = Set('Order')
+    passport = Optional('Passport')
+
+class Passport(db.Entity):
+    number = Required(unicode)
+    customer = Required(Customer)
+
+class Order(db.Entity):
+    number = Required(int)
+    customer = Required(Customer)
+    items = Set('Item')
+
+class Item(db.Entity):
+    order = Required(Order)
+    product = Required('Product')
+    quantity = Required(int)
+
+class Product(db.Entity):
+    name = Required(unicode)
+    items = Set(Item)
+    tags = Set('Tag')
+
+class Tag(db.Entity):
+    name = Required(unicode)
+    products = Set(Product)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    t1 = Tag(name=u'T1')
+    t2 = Tag(name=u'T2')
+    products = [ Product(name=u'P%d' % i, tags=[ t1, t2 ][:i % 3]) for i in range(1, 6) ]
+    for i in range(1, 5):
+        customer = Customer(name=u'C%d' % i)
+        for j in range(1, i + 1):
+            order = Order(number=i * 10 + j, customer=customer)
+            for k in range(j): Item(order=order, product=products[(i + k) % 5], quantity=k + 1)
+
+with db_session:
+    for customer in select(c for c in Customer if c.name in (u'C1', u'C3')):
+        Passport(number=u'N' + customer.name[1:], customer=customer)
+
+def db_count():
+    return sum(stat.db_count for stat in db.local_stats.values())
+
+class TestPrefetch(unittest.TestCase):
+    @db_session
+    def test_1(self):
+        orders = select(o for o in Order).prefetch(Order.items)[:]
+        count = db_count()
+        self.assertEqual(sum(len(o.items) for o in orders), 20)
+        self.assertEqual(db_count(), count)
+        for o in orders: self.assertTrue(o._vals_['items'].is_fully_loaded)
+    @db_session
+    def test_2(self):
+        orders = select(o for o in Order).prefetch(Order.customer)[:]
+        count = db_count()
+        self.assertEqual(set(o.customer.name for o in orders), set([ u'C1', u'C2', u'C3', u'C4' ]))
+        self.assertEqual(db_count(), count)
+    @db_session
+    def test_3(self):
+        count = db_count()
+        orders = select(o for o in Order).prefetch(Order.items, Order.customer, Item.product, Product.tags)[:]
+        self.assertEqual(db_count() - count, 6)
+        names = set(t.name for o in orders for i in o.items for t in i.product.tags)
+        self.assertEqual(names, set([ u'T1', u'T2' ]))
+        self.assertEqual(db_count() - count, 6)
+    @db_session
+    def test_4(self):
+        customers = select(c for c in Customer).prefetch(Customer.passport)[:]
+        count = db_count()
+        self.assertEqual(set(c.passport.number for c in customers if c.passport), set([ u'N1', u'N3' ]))
+        self.assertEqual(db_count(), count)
+    @db_session
+    def test_5(self):
+        result = select((c, o) for c in Customer for o in c.orders).prefetch(Order.items)[:]
+        count = db_count()
+        self.assertEqual(sum(len(o.items) for c, o in result), 20)
+        self.assertEqual(db_count(), count)
+    @db_session
+    def test_6(self):
+        count = db_count()
+        result = []
+        for o in select(o for o in Order).order_by(Order.number).prefetch(Order.items)[:]: result.append(len(o.items))
+        self.assertEqual(result, [ 1, 1, 2, 1, 2, 3, 1, 2, 3, 4 ])
+        self.assertEqual(db_count() - count, 2)
+    @raises_exception(TypeError, 'Prefetching is possible only for queries which return objects')
+    @db_session
+    def test_7(self):
+        select(o.number for o in Order).prefetch(Order.items)
+    @raises_exception(TypeError, 'Attribute Item.product cannot be prefetched because query does not return objects of Item')
+    @db_session
+    def test_8(self):
+        select(o for o in Order).prefetch(Item.product)
+    @raises_exception(TypeError, 'Relationship attribute expected. Got: Order.number')
+    @db_session
+    def test_9(self):
+        select(o for o in Order).prefetch(Order.number)
+
+if __name__ == '__main__':
+    unittest.main()
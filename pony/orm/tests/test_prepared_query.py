@@ -0,0 +1,79 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+    group = Optional('Group')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    persons = Set(Person)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    g1 = Group(number=1)
+    g2 = Group(number=2)
+    Person(name=u'John', age=20, group=g1)
+    Person(name=u'Mike', age=30, group=g1)
+    Person(name=u'Mary', age=25, group=g2)
+
+older_than = Person.prepare(lambda p, age: p.age > age)
+
+@Person.prepare
+def by_name_and_group(p, name, group):
+    return p.name == name and p.group == group
+
+class TestPreparedQuery(unittest.TestCase):
+    @db_session
+    def test_1(self):
+        self.assertEqual(set(p.name for p in older_than(22)), set([ 'Mike', 'Mary' ]))
+        self.assertEqual([ p.name for p in older_than(25) ], [ 'Mike' ])
+        self.assertEqual(older_than(30), [])
+    @db_session
+    def test_2(self):
+        older_than(21)
+        older_than(22)
+        self.assertEqual(len(older_than.compiled), 1)
+        self.assertEqual(older_than(21), select(p for p in Person if p.age > 21)[:])
+    @db_session
+    def test_3(self):
+        p = by_name_and_group.get(u'Mary', Group[2])
+        self.assertEqual(p.age, 25)
+        self.assertEqual(by_name_and_group.get(u'Mary', Group[1]), None)
+    @db_session
+    def test_4(self):
+        delta = 5
+        query = Person.prepare(lambda p, age: p.age > age + delta)
+        self.assertEqual([ p.name for p in query(20) ], [ 'Mike' ])
+    @db_session
+    def test_5(self):
+        older_than(10)
+        stat = db.local_stats[db.last_sql]
+        self.assertTrue(stat.rows_count >= 3)
+    @db_session
+    def test_6(self):
+        Person(name=u'Kate', age=40)
+        self.assertEqual([ p.name for p in older_than(35) ], [ 'Kate' ])
+        rollback()
+    @raises_exception(TypeError, 'Prepared query takes exactly 1 argument (2 given)')
+    @db_session
+    def test_7(self):
+        older_than(1, 2)
+    @raises_exception(TypeError, 'Prepared query requires at least one parameter name, like Person.prepare(lambda p, x: ...)')
+    def test_8(self):
+        Person.prepare(lambda: True)
+    @raises_exception(MultipleObjectsFoundError, 'Multiple objects were found. Use Person.select(...) to retrieve them')
+    @db_session
+    def test_9(self):
+        older_than.get(0)
+
+if __name__ == '__main__':
+    unittest.main()
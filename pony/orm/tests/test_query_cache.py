@@ -0,0 +1,114 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from pony.utils import LRUCache
+from pony.orm.decompiling import decompile, get_code_key, ast_cache
+from testutils import *
+
+class TestLRUCache(unittest.TestCase):
+    def test_1(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(cache.keys(), [ 'a', 'c' ])
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get_stats(), dict(size=2, maxsize=2, hits=1, misses=1, evictions=1))
+    def test_2(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a'] = 3
+        cache['c'] = 4
+        self.assertEqual(cache.keys(), [ 'a', 'c' ])
+        self.assertEqual(cache['a'], 3)
+    @raises_exception(KeyError)
+    def test_3(self):
+        cache = LRUCache(2)
+        cache['a']
+    def test_4(self):
+        cache = LRUCache(3)
+        for key in 'abc': cache[key] = key
+        cache.resize(1)
+        self.assertEqual(cache.keys(), [ 'c' ])
+        self.assertEqual(cache.pop('c'), 'c')
+        self.assertEqual(len(cache), 0)
+    def test_5(self):
+        cache = LRUCache(None)
+        for i in range(100): cache[i] = i
+        self.assertEqual(len(cache), 100)
+        cache.clear()
+        self.assertEqual(cache.keys(), [])
+
+db = Database('sqlite', ':memory:')
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    Person(name=u'John', age=20)
+    Person(name=u'Mike', age=30)
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        db.clear_query_cache()
+        db.set_query_cache_size(translator_cache_size=1000, sql_cache_size=1000)
+    @db_session
+    def test_1(self):
+        hits = db.get_query_cache_stats()['translator']['hits']
+        for i in range(3): select(p for p in Person if p.age > i)[:]
+        stats = db.get_query_cache_stats()
+        self.assertEqual(stats['translator']['size'], 1)
+        self.assertEqual(stats['translator']['hits'] - hits, 2)
+        self.assertEqual(stats['sql']['size'], 1)
+    @db_session
+    def test_2(self):
+        db.set_query_cache_size(translator_cache_size=1, sql_cache_size=1)
+        select(p for p in Person if p.age > 20)[:]
+        select(p for p in Person if p.name == u'John')[:]
+        stats = db.get_query_cache_stats()
+        self.assertEqual(stats['translator']['size'], 1)
+        self.assertEqual(stats['sql']['size'], 1)
+        self.assertTrue(stats['translator']['evictions'] >= 1)
+    @db_session
+    def test_3(self):
+        db.set_query_cache_size(translator_cache_size=1)
+        query = select(p for p in Person).order_by(Person.name)
+        result = query.order_by(None)[:]
+        self.assertEqual(set(p.name for p in result), set([ 'John', 'Mike' ]))
+
+class TestDecompilerCache(unittest.TestCase):
+    def test_1(self):
+        f1 = lambda p: p.age > 10
+        f2 = lambda p: p.age > 10
+        self.assertEqual(get_code_key(f1.func_code), get_code_key(f2.func_code))
+        self.assertIs(decompile(f1), decompile(f2))
+    def test_2(self):
+        f1 = lambda p: p.age > 1
+        f2 = lambda p: p.age > 1.0
+        self.assertNotEqual(get_code_key(f1.func_code), get_code_key(f2.func_code))
+    def test_3(self):
+        f1 = lambda p: p.age in (1, 2)
+        f2 = lambda p: p.age in (1, 2.0)
+        self.assertNotEqual(get_code_key(f1.func_code), get_code_key(f2.func_code))
+    def test_4(self):
+        size = len(ast_cache)
+        for i in range(10):
+            func = eval('lambda p: p.age > x')
+            decompile(func)
+        self.assertTrue(len(ast_cache) <= size + 1)
+    @db_session
+    def test_5(self):
+        result = Person.select(lambda p: p.age > 25)[:]
+        self.assertEqual([ p.name for p in result ], [ 'Mike' ])
+        result = select(p for p in Person).filter(lambda p: p.age > 25)[:]
+        self.assertEqual([ p.name for p in result ], [ 'Mike' ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from pony.orm.core import QueryResultCache, get_table_names
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+
+class Tag(db.Entity):
+    name = Required(unicode)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    Person(id=1, name=u'John', age=20)
+    Person(id=2, name=u'Mike', age=30)
+    Tag(id=1, name=u'red')
+
+def count_selects():
+    return sum(stat.db_count for sql, stat in db.local_stats.iteritems() if sql.startswith('SELECT'))
+
+class TestQueryResultCache(unittest.TestCase):
+    def setUp(self):
+        db.query_result_cache = QueryResultCache()
+        db.local_stats.clear()
+    def tearDown(self):
+        db.query_result_cache = None
+    def test_1(self):
+        for i in range(3):
+            with db_session:
+                result = select(p for p in Person if p.age > 25)[:]
+                self.assertEqual([ p.name for p in result ], [ 'Mike' ])
+        self.assertEqual(count_selects(), 1)
+    def test_2(self):
+        for i in range(2):
+            with db_session:
+                self.assertEqual(select(p.name for p in Person).count(), 2)
+                self.assertEqual(select((p.name, p.age) for p in Person if p.id == 1)[:], [ ('John', 20) ])
+        self.assertEqual(count_selects(), 2)
+    def test_3(self):
+        with db_session: select(p for p in Person)[:]
+        with db_session: Person[1].age = 21
+        with db_session: self.assertEqual(select(p.age for p in Person if p.id == 1).get(), 21)
+        self.assertEqual(count_selects(), 3)
+        with db_session: Person[1].age = 20
+    def test_4(self):
+        with db_session: select(t.name for t in Tag)[:]
+        with db_session: Person[1].age = 22
+        with db_session: select(t.name for t in Tag)[:]
+        self.assertEqual(count_selects(), 2)
+        with db_session: Person[1].age = 20
+    def test_5(self):
+        with db_session:
+            self.assertEqual(select(p for p in Person).count(), 2)
+            Person(name=u'Kate', age=40)
+            flush()
+            self.assertEqual(select(p for p in Person).count(), 3)
+            rollback()
+        with db_session: self.assertEqual(select(p for p in Person).count(), 2)
+        self.assertEqual(count_selects(), 2)
+    def test_6(self):
+        with db_session: select(t for t in Tag)[:]
+        with db_session: db.execute('update Tag set name = name')
+        with db_session: select(t for t in Tag)[:]
+        self.assertEqual(count_selects(), 2)
+    def test_7(self):
+        with db_session: select(p for p in Person).random(1)
+        with db_session: select(p for p in Person).random(1)
+        self.assertEqual(count_selects(), 2)
+    def test_8(self):
+        sql_ast = [ 'SELECT', [ 'ALL', [ 'COLUMN', 'p', 'id' ] ], [ 'FROM', [ 'p', 'TABLE', 'Person' ] ],
+                    [ 'WHERE', [ 'EXISTS', [ 'FROM', [ 't', 'TABLE', 'Tag' ] ] ] ] ]
+        self.assertEqual(get_table_names(sql_ast), set([ 'Person', 'Tag' ]))
+    def test_9(self):
+        with db_session: self.assertEqual(select(t.name for t in Tag)[:], [ 'red' ])
+        with db_session: db.insert('Tag', id=2, name=u'green')
+        with db_session: self.assertEqual(set(select(t.name for t in Tag)), set([ 'red', 'green' ]))
+        self.assertEqual(count_selects(), 2)
+        with db_session: Tag[2].delete()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+from __future__ import with_statement
+
+import unittest
+from threading import Thread
+from time import time
+
+from pony.orm.core import *
+from pony.orm.core import QueryStat, get_histogram_bucket, get_histogram_bucket_bound
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    for i in range(10): Person(name=u'P%d' % i, age=20 + i)
+
+def make_stat(*durations):
+    stat = QueryStat('SELECT 1', time() - durations[0])
+    for duration in durations[1:]: stat.query_executed(time() - duration)
+    return stat
+
+class TestHistogram(unittest.TestCase):
+    def test_1(self):
+        self.assertEqual(get_histogram_bucket(0.0000005), 0)
+        for duration in 0.00001, 0.001, 0.5, 20.0:
+            bucket = get_histogram_bucket(duration)
+            self.assertTrue(duration <= get_histogram_bucket_bound(bucket) <= duration * 1.2)
+    def test_2(self):
+        stat = make_stat(*([ 0.001 ] * 98 + [ 0.1, 0.1 ]))
+        self.assertEqual(stat.db_count, 100)
+        self.assertTrue(0.00099 <= stat.percentile(50) < 0.0013)
+        self.assertTrue(0.00099 <= stat.percentile(95) < 0.0013)
+        self.assertTrue(0.099 <= stat.percentile(99) <= stat.max_time)
+    def test_3(self):
+        stat = make_stat(0.001, 0.002)
+        stat.rows_fetched(5, 0.01)
+        stat2 = make_stat(0.5)
+        stat2.rows_fetched(3, 0.02)
+        stat.merge(stat2)
+        self.assertEqual(stat.db_count, 3)
+        self.assertEqual(sum(stat.histogram.values()), 3)
+        self.assertEqual(stat.rows_count, 8)
+        self.assertAlmostEqual(stat.hydration_time, 0.03)
+        self.assertTrue(stat.percentile(100) >= 0.499)
+
+class TestQueryStats(unittest.TestCase):
+    def get_stat(self, stats, prefix):
+        stat, = [ stat for sql, stat in stats.iteritems() if sql.startswith(prefix) ]
+        return stat
+    def test_1(self):
+        db.merge_local_stats()
+        with db_session:
+            select(p for p in Person if p.age > 24)[:]
+        stat = self.get_stat(db.local_stats, 'SELECT "p"')
+        self.assertEqual(stat.rows_count, 5)
+        self.assertEqual(sum(stat.histogram.values()), stat.db_count)
+    def test_2(self):
+        sql = 'SELECT test_2'
+        def worker():
+            db._update_local_stat(sql, time())
+            db.merge_local_stats()
+        before = db.global_stats
+        threads = [ Thread(target=worker) for i in range(3) ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        stat = db.global_stats[sql]
+        prev_count = sql in before and before[sql].db_count or 0
+        self.assertEqual(stat.db_count - prev_count, 3)
+        self.assertEqual(sum(stat.histogram.values()), stat.db_count)
+    def test_3(self):
+        with db_session:
+            for i in range(5): Person.select(lambda p: p.age > 100)[:]
+            Person.select(lambda p: p.age > 100 and p.name != u'test_3')[:]
+        db.merge_local_stats()
+        top = db.get_top_stats(limit=2, sort_by='db_count')
+        self.assertEqual(len(top), 2)
+        self.assertTrue(top[0].db_count >= top[1].db_count)
+        report = db.stats_report(limit=3, sort_by='p99')
+        lines = report.split('\n')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].split()[0] == 'count' and lines[0].endswith('sql'))
+    @raises_exception(ValueError, "Unknown sort key: 'foo'")
+    def test_4(self):
+        db.get_top_stats(sort_by='foo')
+    def test_5(self):
+        def worker():
+            db._update_local_stat('SELECT test_5', time())
+            db.merge_local_stats()
+        for i in range(50):
+            thread = Thread(target=worker)
+            thread.start()
+            thread.join()
+        self.assertTrue(db.global_stats['SELECT test_5'].db_count >= 50)
+        self.assertTrue(len(db._stats_shards) <= 2)
+    def test_6(self):
+        db._update_local_stat('SELECT test_6', time())
+        db.merge_local_stats()
+        self.assertTrue('SELECT test_6' in db.global_stats)
+        db.reset_stats()
+        self.assertEqual(db.global_stats, {})
+        db._update_local_stat('SELECT test_6', time())
+        db.merge_local_stats()
+        db.global_stats = {}
+        self.assertEqual(db.global_stats, {})
+
+if __name__ == '__main__':
+    unittest.main()
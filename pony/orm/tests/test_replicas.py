@@ -0,0 +1,89 @@
+from __future__ import with_statement
+
+import unittest, os, shutil, tempfile
+
+from pony.orm.core import *
+from pony.orm.core import QueryResultCache
+from testutils import *
+
+def define_entities(db):
+    class Item(db.Entity):
+        name = Required(unicode)
+    return Item
+
+class TestReplicas(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        filenames = []
+        for name in 'primary', 'replica1', 'replica2':
+            filename = os.path.join(self.dirname, name + '.sqlite')
+            db = Database('sqlite', filename, create_db=True)
+            Item = define_entities(db)
+            db.generate_mapping(create_tables=True)
+            with db_session: Item(name=unicode(name))
+            db.disconnect()
+            filenames.append(filename)
+        self.db = Database('sqlite', filenames[0])
+        self.Item = define_entities(self.db)
+        self.db.generate_mapping()
+        self.replicas = [ self.db.add_replica(filename) for filename in filenames[1:] ]
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.dirname)
+    def get_names(self):
+        return select(item.name for item in self.Item)[:]
+    def test_1(self):
+        with db_session:
+            self.assertEqual(self.get_names(), [ 'primary' ])
+    def test_2(self):
+        with db_session(readonly=True):
+            self.assertEqual(self.get_names(), [ 'replica1' ])
+            self.assertEqual(self.Item[1].name, 'replica1')
+        with db_session(readonly=True):
+            self.assertEqual(self.get_names(), [ 'replica2' ])
+        with db_session(readonly=True):
+            self.assertEqual(self.get_names(), [ 'replica1' ])
+    def test_3(self):
+        @db_session(readonly=True)
+        def get_names():
+            return self.get_names()
+        self.assertEqual(get_names(), [ 'replica1' ])
+        self.assertEqual(self.db._replica_usage[self.replicas[0]], 0)
+    @raises_exception(TransactionError, 'Cannot save changes inside of read-only db_session')
+    def test_4(self):
+        with db_session(readonly=True):
+            self.Item(name=u'new')
+    @raises_exception(TransactionError, 'SELECT FOR UPDATE cannot be used inside of read-only db_session')
+    def test_5(self):
+        with db_session(readonly=True):
+            select(item for item in self.Item).for_update()[:]
+    def test_6(self):
+        db = self.db
+        db.replica_balancing = 'least_connections'
+        replica1, replica2 = self.replicas
+        self.assertIs(db._acquire_replica(), replica1)
+        self.assertIs(db._acquire_replica(), replica2)
+        db._release_replica(replica2)
+        self.assertIs(db._acquire_replica(), replica2)
+        db._release_replica(replica1)
+        db._release_replica(replica2)
+    def test_7(self):
+        with db_session(readonly=True):
+            with db_session:
+                self.assertEqual(self.get_names(), [ 'replica1' ])
+    def test_8(self):
+        db, Item = self.db, self.Item
+        Item._cache_policy_ = 'readonly'
+        db._has_cached_entities = True
+        with db_session(readonly=True): select(item for item in Item)[:]
+        self.assertEqual(db.entity_cache.get_row(Item, (1,)), None)
+        with db_session: select(item for item in Item)[:]
+        self.assertNotEqual(db.entity_cache.get_row(Item, (1,)), None)
+    def test_9(self):
+        db = self.db
+        db.query_result_cache = QueryResultCache()
+        with db_session(readonly=True): self.assertEqual(self.get_names(), [ 'replica1' ])
+        with db_session: self.assertEqual(self.get_names(), [ 'primary' ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+from __future__ import with_statement
+
+import unittest, os, shutil, sqlite3, tempfile
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    Person(name=u'John', age=20)
+    Person(name=u'Mike', age=30)
+
+class TestSlowQueryLog(unittest.TestCase):
+    def setUp(self):
+        db.clear_query_cache()
+        self.dirname = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    def get_rows(self, filename):
+        con = sqlite3.connect(filename)
+        try: return con.execute('select sql, arguments, call_site, db_session from pony_slow_queries').fetchall()
+        finally: con.close()
+    def test_1(self):
+        filename = os.path.join(self.dirname, 'slow.log')
+        log = db.log_slow_queries(threshold=0, filename=filename)
+        try:
+            with db_session:
+                x = 25
+                select(p for p in Person if p.age > x)[:]
+        finally: log.close()
+        self.assertEqual(log.count, 1)
+        text = open(filename).read()
+        self.assertTrue('"age" > ?' in text)
+        self.assertTrue('arguments: [25]' in text)
+        self.assertTrue('test_slow_query_log.py' in text)
+        self.assertFalse('None' in text.split('db_session:')[1].split('\n')[0])
+    def test_2(self):
+        filename = os.path.join(self.dirname, 'slow.sqlite')
+        log = db.log_slow_queries(threshold=0, sqlite_filename=filename, redact=True)
+        try: self.select_adults()
+        finally: log.close()
+        rows = self.get_rows(filename)
+        self.assertEqual(len(rows), 1)
+        sql, arguments, call_site, session = rows[0]
+        self.assertEqual(arguments, '<1 redacted>')
+        self.assertTrue('in select_adults' in call_site)
+        self.assertTrue('in select_adults' in session)
+    @db_session
+    def select_adults(self):
+        x = 18
+        return Person.select(lambda p: p.age >= x)[:]
+    def test_3(self):
+        filename = os.path.join(self.dirname, 'slow.sqlite')
+        log = db.log_slow_queries(threshold=1000, sqlite_filename=filename)
+        try: self.select_adults()
+        finally: log.close()
+        self.assertEqual(self.get_rows(filename), [])
+        self.assertFalse(log in db._hooks.get('execute', ()))
+    def test_4(self):
+        filename = os.path.join(self.dirname, 'slow.sqlite')
+        log = db.log_slow_queries(threshold=0, sqlite_filename=filename, redact=lambda args: [ '***' for arg in args ])
+        try:
+            with db_session: Person.get(name=u'John')
+        finally: log.close()
+        self.assertEqual(self.get_rows(filename)[0][1], "['***']")
+    def test_6(self):
+        filename = os.path.join(self.dirname, 'slow.sqlite')
+        log = db.log_slow_queries(threshold=0, sqlite_filename=filename)
+        try:
+            with db_session: Person[1].age += 1
+            with db_session: Person[1].age -= 1
+        finally: log.close()
+        updates = [ row for row in self.get_rows(filename) if row[0].startswith('UPDATE') ]
+        self.assertEqual(len(updates), 2)
+        for sql, arguments, call_site, session in updates: self.assertTrue('in test_6' in session)
+    @raises_exception(TypeError, 'Either filename or sqlite_filename must be specified for slow query log')
+    def test_5(self):
+        db.log_slow_queries(threshold=0)
+
+if __name__ == '__main__':
+    unittest.main()
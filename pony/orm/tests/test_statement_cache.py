@@ -0,0 +1,69 @@
+from __future__ import with_statement
+
+import unittest, sqlite3
+
+from pony.orm.core import *
+from pony.orm.dbapiprovider import ConnectionPool
+from pony.utils import LRUCache
+from testutils import *
+
+db = Database('sqlite', ':memory:', pony_statement_cache_size=3)
+
+class Person(db.Entity):
+    name = Required(unicode)
+    age = Required(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    Person(name=u'John', age=20)
+    Person(name=u'Mike', age=30)
+
+class TestStatementCache(unittest.TestCase):
+    def setUp(self):
+        db.clear_query_cache()
+    def test_1(self):
+        stats = db.get_query_cache_stats()['statements']
+        for x in 20, 25, 30:
+            with db_session: select(p for p in Person if p.age >= x)[:]
+        stats2 = db.get_query_cache_stats()['statements']
+        self.assertEqual(stats2['maxsize'], 3)
+        self.assertEqual(stats2['hits'] - stats['hits'], 2)
+        self.assertTrue(stats2['size'] <= 3)
+    def test_2(self):
+        stats = db.get_query_cache_stats()['statements']
+        with db_session:
+            for x in range(5): select(p.name for p in Person if p.age > x)[:]
+            for x in range(5): select(p.age for p in Person if p.age > x)[:]
+            for x in range(5): select(p.id for p in Person if p.age > x)[:]
+            for x in range(5): select(p for p in Person if p.age > x)[:]
+        stats2 = db.get_query_cache_stats()['statements']
+        self.assertTrue(stats2['evictions'] - stats['evictions'] >= 1)
+    def test_3(self):
+        db2 = Database('sqlite', ':memory:')
+        self.assertEqual(db2.get_query_cache_stats()['statements'], None)
+    @raises_exception(ValueError, 'pony_statement_cache_size must be positive number')
+    def test_4(self):
+        Database('sqlite', ':memory:', pony_statement_cache_size=0)
+
+class TestPoolStatementCache(unittest.TestCase):
+    def test_1(self):
+        pool = ConnectionPool(sqlite3, ':memory:', check_same_thread=False, pony_statement_cache_size=2)
+        con = pool.connect()
+        statement_cache = pool.get_statement_cache(con)
+        self.assertIs(pool.get_statement_cache(con), statement_cache)
+        statement_cache['select 1'] = True
+        statement_cache.get('select 1')
+        pool.drop(con)
+        stats = pool.get_statement_cache_stats()
+        self.assertEqual(stats['connections'], 0)
+        self.assertEqual(stats['hits'], 1)
+    def test_2(self):
+        evicted = []
+        cache = LRUCache(1, on_evict=lambda key, value: evicted.append((key, value)))
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(evicted, [ ('a', 1) ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Group(db.Entity):
+    number = PrimaryKey(int)
+    students = Set('Student')
+
+class Student(db.Entity):
+    name = Required(unicode, unique=True)
+    group = Required(Group)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    groups = [ Group(number=1), Group(number=2) ]
+    for i in range(10): Student(name=u'S%d' % i, group=groups[i % 2])
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        db_session.__enter__()
+    def tearDown(self):
+        rollback()
+        db_session.__exit__()
+    def test_1(self):
+        chunks = list(select(s for s in Student).order_by(Student.id).iter_chunks(4))
+        self.assertEqual([ len(chunk) for chunk in chunks ], [ 4, 4, 2 ])
+        self.assertEqual(chunks[0][0], Student[1])
+    def test_2(self):
+        names = list(select(s.name for s in Student if s.group.number == 1).stream(2))
+        self.assertEqual(sorted(names), [ 'S0', 'S2', 'S4', 'S6', 'S8' ])
+    def test_3(self):
+        cache = db._get_cache()
+        index = cache.indexes[Student._pk_] = cache.indexes.get(Student._pk_, {})
+        sizes = []
+        for chunk in select(s for s in Student).iter_chunks(3, evict=True):
+            sizes.append(len(index))
+        self.assertEqual(sizes, [ 3, 3, 3, 1 ])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(Student.get(name=u'S1').group.number, 2)
+    def test_4(self):
+        group = Group[1]
+        students = set(group.students)
+        self.assertEqual(len(students), 5)
+        for chunk in select(s for s in Student).iter_chunks(20, evict=True): pass
+        self.assertEqual(db._get_cache().indexes[Student._pk_], {})
+        self.assertFalse(group._vals_['students'].is_fully_loaded)
+        self.assertEqual(set(s.name for s in group.students), set([ 'S0', 'S2', 'S4', 'S6', 'S8' ]))
+    def test_5(self):
+        cache = db._get_cache()
+        self.assertEqual(cache.evict([ Group[2] ]), 1)
+        set(Group[1].students)
+        s = Student.get(name=u'S1')
+        s.name = u'X'
+        self.assertEqual(cache.evict([ Group[1], s ]), 0)
+        self.assertIs(Student.get(name=u'X'), s)
+    @raises_exception(TypeError, 'Query with SELECT FOR UPDATE cannot be streamed')
+    def test_6(self):
+        select(s for s in Student).for_update().iter_chunks(10)
+    @raises_exception(TypeError, 'Query with prefetch() cannot be streamed in SQLite, because the connection '
+                                 'cannot execute other queries until the streamed result is read to the end')
+    def test_7(self):
+        db.provider.stream_blocks_connection = True
+        try: select(s for s in Student).prefetch(Student.group).iter_chunks(10)
+        finally: del db.provider.stream_blocks_connection
+
+if __name__ == '__main__':
+    unittest.main()
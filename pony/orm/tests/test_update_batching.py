@@ -0,0 +1,110 @@
+from __future__ import with_statement
+
+import unittest
+
+from pony.orm.core import *
+from testutils import *
+
+db = Database('sqlite', ':memory:')
+
+class Item(db.Entity):
+    name = Required(unicode)
+    price = Required(int)
+    discount = Optional(int)
+
+db.generate_mapping(create_tables=True)
+
+with db_session:
+    for i in range(5): Item(name=u'Item%d' % i, price=i)
+
+def count_updates():
+    return sum(stat.db_count for sql, stat in db.local_stats.iteritems() if sql.startswith('UPDATE'))
+
+def emulate_mysql_executemany():
+    # MySQLdb executes non-INSERT statements of executemany() one by one
+    # and cursor.rowcount holds the row count of the last statement only
+    exec_sql = Database._exec_sql.__get__(db)
+    def mysql_exec_sql(sql, arguments=None, *args, **kwargs):
+        if type(arguments) is not list: return exec_sql(sql, arguments, *args, **kwargs)
+        for row_arguments in arguments: cursor = exec_sql(sql, row_arguments, *args, **kwargs)
+        return cursor
+    db._exec_sql = mysql_exec_sql
+
+class TestUpdateBatching(unittest.TestCase):
+    def setUp(self):
+        rollback()
+        db.local_stats.clear()
+        db_session.__enter__()
+    def tearDown(self):
+        rollback()
+        db_session.__exit__()
+        db.provider.executemany_rowcount = True
+        db.provider.update_from_values_syntax = False
+        db.provider.max_params_count = 200
+        db.__dict__.pop('_exec_sql', None)
+    def test_1(self):
+        items = select(i for i in Item)[:]
+        for item in items: item.price += 10
+        flush()
+        self.assertEqual(count_updates(), 1)
+        self.assertEqual(db.select('price from Item order by id'), [ 10, 11, 12, 13, 14 ])
+        self.assertEqual([ item._status_ for item in items ], [ 'saved' ] * 5)
+    def test_2(self):
+        items = select(i for i in Item).order_by(Item.id)[:]
+        items[0].price = 100
+        items[1].price = 101
+        items[2].name = u'X'
+        items[3].price = 103
+        flush()
+        self.assertEqual(count_updates(), 3)
+        self.assertEqual(db.select('price from Item order by id'), [ 100, 101, 2, 103, 4 ])
+    @raises_exception(UnrepeatableReadError, 'Some of objects Item[1], Item[2], Item[3], ... '
+                                             'were updated outside of current transaction')
+    def test_3(self):
+        items = select(i for i in Item).order_by(Item.id)[:]
+        db.execute('update Item set price = 50 where id = 2')
+        for item in items: item.price += 1
+        flush()
+    @raises_exception(UnrepeatableReadError, 'Object Item[2] was updated outside of current transaction')
+    def test_4(self):
+        db.provider.executemany_rowcount = False
+        items = select(i for i in Item).order_by(Item.id)[:]
+        db.execute('update Item set price = 50 where id = 2')
+        for item in items: item.price += 1
+        flush()
+    def test_5(self):
+        emulate_mysql_executemany()
+        db.provider.executemany_rowcount = False
+        items = select(i for i in Item).order_by(Item.id)[:]
+        for item in items: item.price += 20
+        flush()
+        self.assertEqual(db.select('price from Item order by id'), [ 20, 21, 22, 23, 24 ])
+    @raises_exception(UnrepeatableReadError)
+    def test_6(self):
+        emulate_mysql_executemany()
+        items = select(i for i in Item).order_by(Item.id)[:]
+        for item in items: item.price += 20
+        flush()
+    def test_7(self):
+        db.provider.update_from_values_syntax = True
+        db.provider.max_params_count = 10
+        items = select(i for i in Item).order_by(Item.id)[:]
+        for item in items: item.price += 30 + (item.discount or 0)  # reading of discount adds IS NULL check
+        items[4].discount = 5
+        flush()
+        self.assertEqual(count_updates(), 3)
+        self.assertEqual(len([ sql for sql in db.local_stats if 'FROM (VALUES' in sql ]), 1)
+        self.assertEqual(db.select('price, discount from Item order by id'),
+                         [ (30, None), (31, None), (32, None), (33, None), (34, 5) ])
+        self.assertEqual([ item._status_ for item in items ], [ 'saved' ] * 5)
+    @raises_exception(UnrepeatableReadError, 'Some of objects Item[1], Item[2], Item[3], ... '
+                                             'were updated outside of current transaction')
+    def test_8(self):
+        db.provider.update_from_values_syntax = True
+        items = select(i for i in Item).order_by(Item.id)[:]
+        db.execute('update Item set price = 50 where id = 2')
+        for item in items: item.price += 1
+        flush()
+
+if __name__ == '__main__':
+    unittest.main()
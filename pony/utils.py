@@ -4,7 +4,7 @@ import re, os, os.path, sys, datetime, types, linecache, warnings
 
 from itertools import count as _count
 from inspect import isfunction, ismethod
-from time import strptime
+from time import strptime, time as _time
 from os import urandom
 from codecs import BOM_UTF8, BOM_LE, BOM_BE
 from locale import getpreferredencoding
@@ -12,6 +12,7 @@ from bisect import bisect
 from collections import defaultdict
 from copy import deepcopy, _deepcopy_dispatch
 from functools import update_wrapper
+from threading import Lock
 
 # deepcopy instance method patch for Python < 2.7:
 if types.MethodType not in _deepcopy_dispatch:
@@ -135,6 +136,126 @@ def cached(f, *args, **kwargs):
     if len(_cache) == MAX_CACHE_SIZE: _cache.clear()
     return _cache.setdefault(key, f(*args, **kwargs))
 
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+class LRUCache(object):
+    def __init__(cache, maxsize=MAX_CACHE_SIZE, on_evict=None):
+        cache.maxsize = maxsize  # None means unbounded cache
+        cache.on_evict = on_evict  # called as on_evict(key, value) with lock acquired
+        cache.lock = Lock()
+        cache.data = {}
+        root = cache.root = []  # circular doubly linked list of [ prev, next, key, value ] links
+        root[:] = [ root, root, None, None ]
+        cache.hits = cache.misses = cache.evictions = 0
+    def __len__(cache):
+        return len(cache.data)
+    def __contains__(cache, key):
+        return key in cache.data
+    def get(cache, key, default=None):
+        cache.lock.acquire()
+        try:
+            link = cache.data.get(key)
+            if link is None:
+                cache.misses += 1
+                return default
+            cache.hits += 1
+            prev_link, next_link = link[PREV], link[NEXT]
+            prev_link[NEXT] = next_link
+            next_link[PREV] = prev_link
+            root = cache.root
+            last = root[PREV]
+            last[NEXT] = root[PREV] = link
+            link[PREV] = last
+            link[NEXT] = root
+            return link[VALUE]
+        finally: cache.lock.release()
+    def __getitem__(cache, key):
+        value = cache.get(key, cache)
+        if value is cache: raise KeyError(key)
+        return value
+    def __setitem__(cache, key, value):
+        cache.lock.acquire()
+        try:
+            data = cache.data
+            link = data.pop(key, None)
+            if link is not None:
+                link[PREV][NEXT] = link[NEXT]
+                link[NEXT][PREV] = link[PREV]
+            root = cache.root
+            last = root[PREV]
+            link = last[NEXT] = root[PREV] = data[key] = [ last, root, key, value ]
+            cache._shrink(cache.maxsize)
+        finally: cache.lock.release()
+    def _shrink(cache, maxsize):  # must be called with lock acquired
+        if maxsize is None: return
+        data = cache.data
+        root = cache.root
+        while len(data) > maxsize:
+            oldest = root[NEXT]
+            root[NEXT] = oldest[NEXT]
+            oldest[NEXT][PREV] = root
+            del data[oldest[KEY]]
+            cache.evictions += 1
+            if cache.on_evict is not None: cache.on_evict(oldest[KEY], oldest[VALUE])
+    def pop(cache, key, default=None):
+        cache.lock.acquire()
+        try:
+            link = cache.data.pop(key, None)
+            if link is None: return default
+            link[PREV][NEXT] = link[NEXT]
+            link[NEXT][PREV] = link[PREV]
+            return link[VALUE]
+        finally: cache.lock.release()
+    def keys(cache):
+        cache.lock.acquire()
+        try:
+            result = []
+            root = cache.root
+            link = root[NEXT]
+            while link is not root:
+                result.append(link[KEY])
+                link = link[NEXT]
+            return result
+        finally: cache.lock.release()
+    def clear(cache):
+        cache.lock.acquire()
+        try:
+            cache.data.clear()
+            root = cache.root
+            root[:] = [ root, root, None, None ]
+        finally: cache.lock.release()
+    def resize(cache, maxsize):
+        cache.lock.acquire()
+        try:
+            cache.maxsize = maxsize
+            cache._shrink(maxsize)
+        finally: cache.lock.release()
+    def get_stats(cache):
+        return dict(size=len(cache.data), maxsize=cache.maxsize,
+                    hits=cache.hits, misses=cache.misses, evictions=cache.evictions)
+
+class LocalMemcache(object):
+    # in-process storage which implements the subset of memcached client interface used by pony.orm
+    def __init__(memcache, maxsize=MAX_CACHE_SIZE):
+        memcache.data = LRUCache(maxsize)
+    def get(memcache, key):
+        entry = memcache.data.get(key)
+        if entry is None: return None
+        expire_time, value = entry
+        if expire_time and expire_time < _time():
+            memcache.data.pop(key)
+            return None
+        return value
+    def set(memcache, key, value, time=0):  # time is number of seconds, 0 means no expiration
+        memcache.data[key] = (time and _time() + time or 0, value)
+        return True
+    def delete(memcache, key):
+        return memcache.data.pop(key) is not None
+    def flush_all(memcache):
+        memcache.data.clear()
+    def get_stats(memcache):
+        return memcache.data.get_stats()
+
 def error_method(*args, **kwargs):
     raise TypeError
 